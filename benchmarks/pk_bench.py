@@ -0,0 +1,208 @@
+"""
+Benchmark for the PluralKit API client, run against the in-process stand-in from pk_standin.py.
+
+One pluralKitAPI.PKClient (with its rate limiter, retries and circuit breaker) is pointed at the stand-in and taken
+through these phases, in order, without being reset in between:
+    - healthy:    30 ms +- 10 ms, no errors
+    - degraded:   150 ms +- 100 ms, 8% 503s, 5% 502s, 2% 500s and 3% 429s with a 0.5 s Retry-After
+    - outage:     every request is a 503
+    - recovered:  healthy again, once the circuit breaker has had time to let a probe through
+
+Every phase runs two workloads, each with message IDs the client hasn't seen before, so the cache doesn't help:
+    - delete path:  --deletes deleted messages arrive at --delete-rate per second and go through a MessageDeleteQueue,
+                    like UserManagement.on_raw_message_delete. --preproxy-fraction of them are pre-proxied messages PK
+                    knows about, the rest are 404s. Cache cleanup is a no-op, the DB side is covered by pdb_bench.py.
+                    Reports lookup latency and the time from a deletion arriving to it being handled.
+    - backfill:     --backfill proxied messages looked up one after the other, like build_msg_cache.
+
+For each, reports throughput, latency percentiles, how the lookups ended (found, 404, error type) and what the stand-in
+actually answered. The stand-in's fault draws are seeded, but timings depend on the machine, so this prints and saves
+results rather than gating on a baseline.
+
+Usage (from the repo root):
+    python benchmarks/pk_bench.py [--deletes 300] [--delete-rate 100] [--backfill 100] [--rate-limit 50] [--output pk_bench.json]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+from typing import Dict, List, Any
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from utilities import pluralKitAPI
+from utilities.messageDeleteQueue import MessageDeleteQueue
+from pk_standin import Faults, Fixtures, PKStandIn
+
+HEALTHY = Faults(latency_ms=30, latency_jitter_ms=10)
+PHASES = (
+    ("healthy", HEALTHY),
+    ("degraded", Faults(latency_ms=150, latency_jitter_ms=100, error_500=0.02, error_502=0.05, error_503=0.08,
+                        rate_limit_429=0.03, retry_after=0.5)),
+    ("outage", Faults(latency_ms=30, error_503=1.0)),
+    ("recovered", HEALTHY),
+)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+class Lookups:
+    """Times and outcomes of every lookup in one workload."""
+
+    def __init__(self):
+        self.latencies_ms: List[float] = []
+        self.outcomes: Dict[str, int] = {}
+
+    async def get_message(self, client: pluralKitAPI.PKClient, message_id: int):
+        start = time.perf_counter()
+        try:
+            outcome = "found" if await client.get_message(message_id) is not None else "404"
+        except (pluralKitAPI.PKAPIUnavailable, pluralKitAPI.UnknownPKError) as e:
+            outcome = type(e).__name__
+        self.latencies_ms.append((time.perf_counter() - start) * 1000)
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def summary(self, elapsed: float) -> Dict[str, Any]:
+        latencies = sorted(self.latencies_ms)
+        return {
+            'lookups': len(latencies),
+            'lookups_per_sec': len(latencies) / elapsed if elapsed > 0 else 0.0,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'max_ms': latencies[-1] if latencies else 0.0,
+            'outcomes': dict(sorted(self.outcomes.items())),
+        }
+
+
+async def delete_path(client: pluralKitAPI.PKClient, message_ids: List[int], rate: float, concurrency: int) -> Dict[str, Any]:
+    lookups = Lookups()
+
+    async def resolve(guild_id: int, message_id: int):
+        await lookups.get_message(client, message_id)
+
+    async def cleanup(guild_id: int, ids: List[int]):
+        pass
+
+    queue = MessageDeleteQueue(resolve, cleanup, concurrency=concurrency, batch_delay=0.05)
+    queue.start()
+    start = time.perf_counter()
+    for i, message_id in enumerate(message_ids):
+        # Arrive on schedule, like gateway events would, however far behind the queue is.
+        await asyncio.sleep(max(0.0, start + i / rate - time.perf_counter()))
+        queue.add(1, message_id)
+    while queue.depth > 0:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    await queue.close()
+
+    stats = queue.stats()
+    return {
+        **lookups.summary(elapsed),
+        'deletes_per_sec': stats['cleaned'] / elapsed,
+        'queue_delay_p50_ms': stats['delay_p50_ms'],
+        'queue_delay_p95_ms': stats['delay_p95_ms'],
+        'queue_delay_max_ms': stats['delay_max_ms'],
+        'max_queue_depth': stats['max_depth'],
+        'shed': stats['shed'],
+    }
+
+
+async def backfill(client: pluralKitAPI.PKClient, message_ids: List[int]) -> Dict[str, Any]:
+    lookups = Lookups()
+    start = time.perf_counter()
+    for message_id in message_ids:
+        await lookups.get_message(client, message_id)
+    return lookups.summary(time.perf_counter() - start)
+
+
+def print_result(workload: str, result: Dict[str, Any]):
+    print(f"  {workload:<12} {result['lookups']:>7} {result['lookups_per_sec']:>9.1f} {result['p50_ms']:>9.1f} "
+          f"{result['p95_ms']:>9.1f} {result['p99_ms']:>9.1f} {result['max_ms']:>9.1f}   "
+          + ", ".join(f"{outcome} {count}" for outcome, count in result['outcomes'].items()))
+    if 'queue_delay_p95_ms' in result:
+        print(f"  {'':<12} {result['deletes_per_sec']:.1f} deletes/s, arrival to handled p50 {result['queue_delay_p50_ms']:.0f} ms, "
+              f"p95 {result['queue_delay_p95_ms']:.0f} ms, max {result['queue_delay_max_ms']:.0f} ms, "
+              f"max queue depth {result['max_queue_depth']}")
+
+
+async def run(args) -> Dict[str, Any]:
+    fixtures = Fixtures(args.seed, message_count=len(PHASES) * (args.deletes + args.backfill))
+    stand_in = PKStandIn(fixtures, HEALTHY, args.seed)
+    base_url = await stand_in.start()
+
+    client = pluralKitAPI.PKClient(base_url=base_url, rate_limit=args.rate_limit, rate_burst=max(1, int(args.rate_limit)),
+                                   breaker_reset_timeout=args.breaker_reset_timeout)
+    rng = random.Random(args.seed)
+    originals = iter(fixtures.original_ids)
+    unknown = iter(fixtures.unknown_message_ids)
+    proxied = iter(fixtures.proxied_ids[::-1])  # From the other end, so they don't share systems' lookups with the originals.
+
+    results: Dict[str, Any] = {'options': vars(args), 'phases': {}}
+    try:
+        for phase, faults in PHASES:
+            if phase == "recovered":
+                await asyncio.sleep(args.breaker_reset_timeout)
+            stand_in.set_faults(faults)
+            print(f"\n{phase}: {faults}")
+            print(f"  {'Workload':<12} {'Lookups':>7} {'Lookups/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'Max ms':>9}   Outcomes")
+
+            phase_results: Dict[str, Any] = {}
+            for workload in ("delete path", "backfill"):
+                requests_before, responses_before, retries_before = stand_in.requests, dict(stand_in.responses), client.retries
+                if workload == "delete path":
+                    message_ids = [next(originals) if rng.random() < args.preproxy_fraction else next(unknown) for _ in range(args.deletes)]
+                    result = await delete_path(client, message_ids, args.delete_rate, args.concurrency)
+                else:
+                    result = await backfill(client, [next(proxied) for _ in range(args.backfill)])
+
+                result['requests'] = stand_in.requests - requests_before
+                result['responses'] = {status: count - responses_before.get(status, 0) for status, count in sorted(stand_in.responses.items())
+                                       if count - responses_before.get(status, 0) > 0}
+                result['retries'] = client.retries - retries_before
+                result['breaker'] = client.breaker.stats()
+                phase_results[workload] = result
+                print_result(workload, result)
+                responses = ", ".join(f"{status}: {count}" for status, count in result['responses'].items())
+                print(f"  {'':<12} {result['requests']} requests to the stand-in" + (f" ({responses})" if responses else "")
+                      + f", {result['retries']} retries, breaker {result['breaker']['state']}")
+            results['phases'][phase] = phase_results
+    finally:
+        await client.close()
+        await stand_in.stop()
+
+    results['limiter'] = client.limiter.stats()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--deletes', type=int, default=300, help="Deleted messages per phase.")
+    parser.add_argument('--delete-rate', type=float, default=100, help="Deleted messages arriving per second.")
+    parser.add_argument('--preproxy-fraction', type=float, default=0.3, help="Fraction of the deleted messages PK knows about.")
+    parser.add_argument('--concurrency', type=int, default=4, help="PK lookups the delete queue makes at once.")
+    parser.add_argument('--backfill', type=int, default=100, help="Backfill lookups per phase.")
+    parser.add_argument('--rate-limit', type=float, default=50,
+                        help="Client side requests/sec. The bot defaults to 5 to be nice to the real API. The stand-in doesn't mind.")
+    parser.add_argument('--breaker-reset-timeout', type=float, default=5, help="Seconds the circuit breaker stays open.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="Also write the results as JSON here.")
+    args = parser.parse_args()
+
+    results = asyncio.get_event_loop().run_until_complete(run(args))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
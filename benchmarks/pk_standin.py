@@ -0,0 +1,203 @@
+"""
+In-process stand-in for the PluralKit API, for benchmarks and fault tests of pluralKitAPI.PKClient.
+
+Serves /v1/msg/{id} and /v1/a/{id} from a fixture set made from --seed: systems with members and linked Discord
+accounts, and proxied messages that can be looked up by either their original (pre-proxy) or their proxied message ID,
+like the real API. Anything not in the fixtures is a 404.
+
+Faults are drawn per request from their own seeded generator:
+    - latency:      every response waits latency_ms, +- up to latency_jitter_ms
+    - errors:       error_404, error_500, error_502 and error_503 are the fractions of requests that get that status
+    - rate limits:  rate_limit_429 of requests get a 429 with a Retry-After of retry_after seconds
+The faults can be changed while the server is running with set_faults(), e.g. to go from a healthy to a degraded phase.
+
+To point a bot at it, run it on its own and set "base_url" in the "pk_api" section of config.json to the URL it prints:
+    python benchmarks/pk_standin.py [--port 5005] [--latency-ms 30] [--error-503 0.1] [--rate-limit-429 0.05]
+"""
+
+import sys
+import random
+import socket
+import asyncio
+import argparse
+
+from typing import Dict, List, Optional, NamedTuple
+
+from aiohttp import web
+
+DISCORD_EPOCH_MS = 1420070400000
+
+
+class Faults(NamedTuple):
+    latency_ms: float = 0
+    latency_jitter_ms: float = 0
+    error_404: float = 0
+    error_500: float = 0
+    error_502: float = 0
+    error_503: float = 0
+    rate_limit_429: float = 0
+    retry_after: float = 1
+
+
+class Fixtures:
+    """The systems, accounts and messages the stand-in knows about. Everything is derived from the seed."""
+
+    def __init__(self, seed: int = 0, system_count: int = 200, message_count: int = 20000):
+        rng = random.Random(seed)
+        snowflake = ((1_600_000_000_000 - DISCORD_EPOCH_MS) << 22) + seed
+
+        def next_snowflake() -> int:
+            nonlocal snowflake
+            snowflake += rng.randint(1, 1 << 24)
+            return snowflake
+
+        self.systems: Dict[str, Dict] = {}
+        self.accounts: Dict[int, str] = {}  # Discord account ID -> system ID
+        self.members: Dict[str, List[Dict]] = {}  # system ID -> members
+        for _ in range(system_count):
+            system_id = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(5))
+            self.systems[system_id] = {'id': system_id, 'name': f"System {system_id}", 'description': None, 'tag': None,
+                                       'avatar_url': None, 'created': "2020-01-01T00:00:00Z", 'tz': "UTC"}
+            self.members[system_id] = [{'id': f"{system_id[:4]}{chr(97 + i)}", 'name': f"Member {i}", 'display_name': None,
+                                        'color': None, 'avatar_url': None, 'keep_proxy': False}
+                                       for i in range(rng.randint(1, 8))]
+            for _ in range(rng.choice((1, 1, 1, 2))):
+                self.accounts[next_snowflake()] = system_id
+
+        account_ids = list(self.accounts)
+        self.messages: Dict[int, Dict] = {}  # Keyed by both the original and the proxied message ID.
+        self.original_ids: List[int] = []
+        self.proxied_ids: List[int] = []
+        for _ in range(message_count):
+            sender = rng.choice(account_ids)
+            system_id = self.accounts[sender]
+            original_id, proxied_id = next_snowflake(), next_snowflake()
+            message = {'timestamp': "2020-09-13T12:26:40Z", 'id': str(proxied_id), 'original': str(original_id),
+                       'sender': str(sender), 'channel': "1", 'system': self.systems[system_id],
+                       'member': rng.choice(self.members[system_id])}
+            self.messages[original_id] = self.messages[proxied_id] = message
+            self.original_ids.append(original_id)
+            self.proxied_ids.append(proxied_id)
+
+        # IDs that aren't in PK at all, e.g. messages nobody proxied and accounts without a system.
+        self.unknown_message_ids = [next_snowflake() for _ in range(message_count)]
+        self.unknown_account_ids = [next_snowflake() for _ in range(system_count)]
+
+
+class PKStandIn:
+    """The aiohttp server. Counts every response by status, so a benchmark can check what the client actually got."""
+
+    def __init__(self, fixtures: Fixtures, faults: Faults = Faults(), seed: int = 0):
+        self.fixtures = fixtures
+        self.faults = faults
+        self._rng = random.Random(seed)
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url: Optional[str] = None
+
+        self.requests = 0
+        self.responses: Dict[int, int] = {}  # status -> count
+
+    def set_faults(self, faults: Faults):
+        self.faults = faults
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Starts serving. Port 0 picks a free port. Returns the base URL to give PKClient."""
+        app = web.Application()
+        app.router.add_get('/v1/msg/{id}', self._get_message)
+        app.router.add_get('/v1/a/{id}', self._get_account)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        await web.SockSite(self._runner, sock).start()
+        self.base_url = f"http://{host}:{sock.getsockname()[1]}/v1"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _respond(self, request: web.Request, body: Optional[Dict]) -> web.Response:
+        self.requests += 1
+        faults = self.faults
+        if faults.latency_ms > 0 or faults.latency_jitter_ms > 0:
+            jitter = self._rng.uniform(-faults.latency_jitter_ms, faults.latency_jitter_ms)
+            await asyncio.sleep(max(0.0, faults.latency_ms + jitter) / 1000)
+
+        roll = self._rng.random()
+        for status, fraction in ((429, faults.rate_limit_429), (503, faults.error_503), (502, faults.error_502),
+                                 (500, faults.error_500), (404, faults.error_404)):
+            if roll < fraction:
+                break
+            roll -= fraction
+        else:
+            status = 200 if body is not None else 404
+
+        self.responses[status] = self.responses.get(status, 0) + 1
+        if status == 200:
+            return web.json_response(body)
+        if status == 429:
+            return web.json_response({'message': "429: Too Many Requests"}, status=429, headers={'Retry-After': str(faults.retry_after)})
+        return web.json_response({'message': f"{status}"}, status=status)
+
+    async def _get_message(self, request: web.Request) -> web.Response:
+        try:
+            message_id = int(request.match_info['id'])
+        except ValueError:
+            return web.Response(status=400)
+        return await self._respond(request, self.fixtures.messages.get(message_id))
+
+    async def _get_account(self, request: web.Request) -> web.Response:
+        try:
+            account_id = int(request.match_info['id'])
+        except ValueError:
+            return web.Response(status=400)
+        system_id = self.fixtures.accounts.get(account_id)
+        return await self._respond(request, self.fixtures.systems[system_id] if system_id is not None else None)
+
+
+async def serve(args):
+    fixtures = Fixtures(args.seed, args.systems, args.messages)
+    faults = Faults(args.latency_ms, args.latency_jitter_ms, args.error_404, args.error_500, args.error_502,
+                    args.error_503, args.rate_limit_429, args.retry_after)
+    stand_in = PKStandIn(fixtures, faults, args.seed)
+    base_url = await stand_in.start(args.host, args.port)
+    print(f"Serving {len(fixtures.original_ids)} proxied messages and {len(fixtures.accounts)} accounts at {base_url}")
+    print(f"e.g. {base_url}/msg/{fixtures.original_ids[0]}  {base_url}/a/{next(iter(fixtures.accounts))}")
+    sys.stdout.flush()
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await stand_in.stop()
+
+
+def add_fault_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--latency-jitter-ms', type=float, default=0)
+    parser.add_argument('--error-404', type=float, default=0, help="Fraction of requests answered with a 404.")
+    parser.add_argument('--error-500', type=float, default=0)
+    parser.add_argument('--error-502', type=float, default=0)
+    parser.add_argument('--error-503', type=float, default=0)
+    parser.add_argument('--rate-limit-429', type=float, default=0, help="Fraction of requests answered with a 429.")
+    parser.add_argument('--retry-after', type=float, default=1, help="Retry-After sent with the 429s, in seconds.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5005)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--systems', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=20000)
+    add_fault_arguments(parser)
+    try:
+        asyncio.get_event_loop().run_until_complete(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
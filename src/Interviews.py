@@ -461,11 +461,12 @@ class Interview:
         raise NotImplementedError
         # return json.dumps(self.dump_dict, indent=4)
 
-    async def save_to_db(self):
+    async def save_to_db(self, db=None):
+        """db may be a pDB.Session to save as part of a larger unit of work. Defaults to the bot's pool."""
         self.LOG.info("Interview: save_to_db()")
         self.LOG.info(f"Saving {self.member.display_name}'s interview")
         read_rules = True if len(self.rule_confirmations) > 0 else False
-        await pDB.update_interview_all_mutable(self.bot.db, self.channel_id, self.member_id, self.question_number, self.interview_finished, self.paused, self.interview_type, read_rules, self.interview_type_prompt_msg_id)
+        await pDB.update_interview_all_mutable(db or self.bot.db, self.channel_id, self.member_id, self.question_number, self.interview_finished, self.paused, self.interview_type, read_rules, self.interview_type_prompt_msg_id)
 
     async def load_json(self, json_data: dict):
         """
@@ -587,9 +588,14 @@ class Interviews:
 
         if archive:
             await self.archive_interview_webhooks(interview, message)
+
+        # The message cache doesn't know which channel a message was in, so the IDs have to be collected before the channel is gone.
+        message_ids = [channel_message.id for channel_message in await interview.channel.history(limit=None).flatten()]
         await interview.channel.delete()
-        await pDB.delete_interview(self.bot.db, interview.channel_id, interview.member_id)
-        await backup_interviews_to_db(self)
+        await self.bot.message_cache.delete_cached_messages(interview.guild_id, message_ids)
+        async with pDB.session(self.bot.db) as db:
+            await pDB.delete_interview(db, interview.channel_id, interview.member_id)
+            await backup_interviews_to_db(self, db)
 
     async def archive_interview_webhooks(self, interview, message=None):
 
@@ -661,11 +667,12 @@ class Interviews:
     #     data = {"interviews": interviews_data}
     #     return json.dumps(data, indent=4)
 
-    async def save_to_db(self):
+    async def save_to_db(self, db=None):
         self.LOG.info("Interviews: save_to_db()")
         self.LOG.info(f"Saving {len(self.interviews)} interviews")
-        for interview in self.interviews:
-            await interview.save_to_db()
+        async with pDB.session(db or self.bot.db) as db:
+            for interview in self.interviews:
+                await interview.save_to_db(db)
 
 
     # async def load_json(self, json_data: str):
@@ -20,6 +20,8 @@ import embeds
 from embeds import std_embed
 
 from utilities.utils import get_channel, SnowFlake, backup_interviews_to_db, get_webhook, save_settings, clear_all_interviews, send_embed, is_team_member, is_team_or_potential_member, pn_embed
+from utilities.messageIndex import RecentMessageIndex
+from utilities.pluralKitAPI import PKClient, set_default_client
 from exceptions import NotTeamMember, NotMember, NotTeamOrPotentialMember
 from Interviews import Interviews, Interview
 from uiElements import BoolPage
@@ -602,6 +604,11 @@ async def on_command_error(ctx, error):
     elif isinstance(error, discord.ext.commands.BadArgument):
         await send_embed(ctx, title="Error!", desc="⚠ {}".format(error))
 
+    elif isinstance(error, pDB.QueryTimeoutError):
+        await send_embed(ctx, title="That took too long!",
+                         desc=f"⚠ The database took longer than {error.timeout:g} seconds to answer, so the search was cancelled.\n"
+                              f"Please try again with a shorter time frame, or try again later.")
+
     else:
         try:
             await ctx.send("⚠ {}".format(error))
@@ -816,10 +823,31 @@ if __name__ == '__main__':
 
         log.info("Loaded Dev config files for PNBot Dev Guild")
 
-    db_pool: asyncpg.pool.Pool = asyncio.get_event_loop().run_until_complete(pDB.create_db_pool(config['db_address']))
-    bot.db = db_pool
+    if config.get('db_backend', 'postgres') == 'sqlite':
+        import sqliteDB  # Registers itself with pDB, so every pDB call made with bot.db goes to SQLite.
+        bot.db = asyncio.get_event_loop().run_until_complete(sqliteDB.connect(config.get('sqlite_path', 'pnbot.sqlite')))
+        bot.analytics_db = bot.db  # Only one connection, so there is nothing to split the scans off on to.
+        log.info(f"Using the SQLite database at {bot.db.path}")
+    else:
+        db_pool: asyncpg.pool.Pool = asyncio.get_event_loop().run_until_complete(pDB.create_db_pool(config['db_address'], **config.get('db_pool', {})))
+        bot.db = db_pool
+        bot.analytics_db = asyncio.get_event_loop().run_until_complete(pDB.create_analytics_pool(config['db_address'], **config.get('db_analytics_pool', {})))
+    bot.config = config
+
+    asyncio.get_event_loop().run_until_complete(pDB.run_migrations(bot.db))
+
+    bot.write_spool = pDB.WriteSpool(bot.db, **config.get('write_spool', {}))
+    bot.write_spool.start()
+
+    bot.message_cache = pDB.MessageCacheBuffer(bot.db,
+                                               max_size=config.get('message_cache_flush_size', 500),
+                                               flush_interval=config.get('message_cache_flush_interval', 5),
+                                               spool=bot.write_spool,
+                                               index=RecentMessageIndex(**config.get('message_index', {})))
+    bot.message_cache.start()
 
-    asyncio.get_event_loop().run_until_complete(pDB.create_tables(bot.db))
+    bot.pk_client = PKClient(db=bot.db, **config.get('pk_api', {}))
+    set_default_client(bot.pk_client)
 
     open_interviews = Interviews(bot, guild_settings)  # ToDo: open_interviews should be a class member of bot.
     bot.open_interviews = open_interviews
@@ -10,9 +10,12 @@ import discord
 from discord.ext import commands
 
 from Interviews import Interviews
+from utilities.pluralKitAPI import PKClient
+from utilities.messageDeleteQueue import MessageDeleteQueue
 
 if TYPE_CHECKING:
     import asyncpg
+    import pDB
 
 log = logging.getLogger(__name__)
 
@@ -22,7 +25,8 @@ extensions = (
     'cogs.helpCmd',
     'cogs.roles',
     'cogs.dev',
-    'cogs.userManagementCog'
+    'cogs.userManagementCog',
+    'cogs.dbMaintenance'
 )
 
 
@@ -31,6 +35,12 @@ class PNBot(commands.Bot):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.db: Optional[asyncpg.pool.Pool] = None
+        self.analytics_db: Optional[asyncpg.pool.Pool] = None  # Small pool for staff triggered scans and reports. See pDB.create_analytics_pool().
+        self.config: Dict = {}  # Contents of config.json
+        self.message_cache: Optional[pDB.MessageCacheBuffer] = None  # Write-behind buffer in front of the messages table.
+        self.write_spool: Optional[pDB.WriteSpool] = None  # On disk fallback for message cache and join log writes. See pDB.WriteSpool.
+        self.pk_client: Optional[PKClient] = None  # Shared, keep-alive PluralKit API client.
+        self.delete_queue: Optional[MessageDeleteQueue] = None  # Deleted message handling. Owned by the UserManagement cog.
         self.open_interviews: Optional[Interviews] = None
         self._guild_settings: Dict[int, Dict] = {}  # Dict of Guild Settings acceced by
         self.primary_guild_id: int = 0
@@ -45,6 +55,19 @@ class PNBot(commands.Bot):
                 traceback.print_exc()
 
 
+    async def close(self):
+        # Clean up queued deletions and flush anything still sitting in the message cache buffer while the DB pool is still usable.
+        if self.delete_queue is not None:
+            await self.delete_queue.close()
+        if self.message_cache is not None:
+            await self.message_cache.close()
+        if self.write_spool is not None:
+            await self.write_spool.close()
+        if self.pk_client is not None:
+            await self.pk_client.close()
+        await super().close()
+
+
     def guild_settings(self, guild_id: int) -> Optional[Dict]:
         """
         Get the guild settings for a guild.
@@ -0,0 +1,110 @@
+"""
+Cog containing the background upkeep tasks for the database.
+Currently this rotates the monthly partitions of the message cache and enforces the message retention settings.
+
+Part of PNBot.
+"""
+
+import logging
+from typing import TYPE_CHECKING, Optional
+
+import pDB
+import eCommands
+from utilities.utils import is_team_member, send_embed
+
+from discord.ext import commands, tasks
+
+if TYPE_CHECKING:
+    from PNDiscordBot import PNBot
+    import asyncpg
+
+
+log = logging.getLogger(__name__)
+
+
+class DBMaintenance(commands.Cog):
+
+    def __init__(self, bot):
+
+        self.bot: 'PNBot' = bot
+        self.pool: asyncpg.pool.Pool = bot.db
+
+        self.months_ahead: int = bot.config.get('message_partitions_ahead', 3)
+        self.default_retention_days: Optional[int] = bot.config.get('message_retention_days', None)  # None == Keep forever.
+        self.detach_expired: bool = bot.config.get('message_retention_mode', 'drop') == 'detach'
+
+        self.maintenance_loop.change_interval(hours=bot.config.get('db_maintenance_interval_hours', 6))
+        self.maintenance_loop.start()
+
+    def cog_unload(self):
+        self.maintenance_loop.cancel()
+
+    async def run_maintenance(self):
+        created = await pDB.ensure_message_partitions(self.pool, self.months_ahead)
+        if created:
+            log.info(f"Created message partitions: {', '.join(created)}")
+
+        result = await pDB.apply_message_retention(self.pool, self.default_retention_days, detach=self.detach_expired)
+        if result is not None:
+            removed, deleted_rows = result
+            log.info(f"Message retention: {len(removed)} partitions {'detached' if self.detach_expired else 'dropped'}, {deleted_rows} rows deleted.")
+
+    @tasks.loop(hours=6)
+    async def maintenance_loop(self):
+        try:
+            await self.run_maintenance()
+        except Exception as e:
+            # Never let a failed run kill the loop. The next run will pick up where this one left off.
+            log.exception(f"DB maintenance failed: {e}")
+
+
+    """                        
+    --- Message Retention Commands  ---
+                                """
+    @is_team_member()
+    @commands.guild_only()
+    @eCommands.group(name="message_retention", brief="Sets / shows how long cached messages are kept for.",
+                     category="User Management")
+    async def message_retention(self, ctx: commands.Context):
+        if ctx.invoked_subcommand is None:
+            await ctx.send_help(self.message_retention)
+
+
+    @is_team_member()
+    @commands.guild_only()
+    @message_retention.command(name="set", brief="Sets the number of days cached messages are kept for.")
+    async def set_message_retention(self, ctx: commands.Context, days: int):
+        if days < 1:
+            await send_embed(ctx, desc=f"{days} is not a valid number of days.")
+            return
+
+        await pDB.upsert_message_retention_days(self.pool, ctx.guild.id, days)
+        await send_embed(ctx, desc=f"Cached messages for this server will now be kept for **{days}** days.")
+
+
+    @is_team_member()
+    @commands.guild_only()
+    @message_retention.command(name="clear", brief="Goes back to the default message retention.")
+    async def clear_message_retention(self, ctx: commands.Context):
+        await pDB.upsert_message_retention_days(self.pool, ctx.guild.id, None)
+        await send_embed(ctx, desc=f"This server now uses the default message retention ({self.retention_desc(self.default_retention_days)}).")
+
+
+    @is_team_member()
+    @commands.guild_only()
+    @message_retention.command(name="show", brief="Shows how long cached messages are kept for.")
+    async def show_message_retention(self, ctx: commands.Context):
+        settings = await pDB.get_guild_settings(self.pool, ctx.guild.id)
+        if settings is not None and settings.message_retention_days is not None:
+            msg = f"Cached messages for this server are kept for **{settings.message_retention_days}** days."
+        else:
+            msg = f"This server uses the default message retention ({self.retention_desc(self.default_retention_days)})."
+        await send_embed(ctx, desc=msg)
+
+    @staticmethod
+    def retention_desc(days: Optional[int]) -> str:
+        return "messages are kept forever" if days is None else f"{days} days"
+
+
+def setup(bot):
+    bot.add_cog(DBMaintenance(bot))
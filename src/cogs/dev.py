@@ -19,6 +19,9 @@ from contextlib import redirect_stdout
 import discord
 from discord.ext import commands
 
+import pDB
+from utilities.utils import send_long_msg
+
 if TYPE_CHECKING:
     from PNDiscordBot import PNBot
 
@@ -196,6 +199,141 @@ class Dev(commands.Cog):
                 await ctx.send(f'Unexpected error: `{e}`')
 
 
+    @commands.command(hidden=True, name='db_stats')
+    async def db_stats(self, ctx, option: Optional[str] = None):
+        """Shows per query latency stats since startup. Pass `reset` to clear them."""
+        if option == 'reset':
+            pDB.reset_query_stats()
+            await ctx.send('DB query stats have been reset.')
+            return
+
+        await send_long_msg(ctx, pDB.query_stats.format_table(), code_block=True, code_block_lang="")
+
+
+    @commands.command(hidden=True, name='pk_stats')
+    async def pk_stats(self, ctx, option: Optional[str] = None):
+        """Shows PluralKit API latency, cache, rate limiter and circuit breaker stats. Pass `reset` to clear the latency stats."""
+        client = self.bot.pk_client
+        if client is None:
+            await ctx.send('The PluralKit API client is not running.')
+            return
+
+        if option == 'reset':
+            client.stats.reset()
+            await ctx.send('PluralKit API stats have been reset.')
+            return
+
+        cache_lines = []
+        for endpoint, stats in client.cache_stats().items():
+            line = (f'{endpoint:<6} cached: {stats["size"]}, hits: {stats["hits"]}, 404 hits: {stats["negative_hits"]}, '
+                    f'misses: {stats["misses"]}, expired: {stats["expired"]}, evicted: {stats["evictions"]}')
+            if 'persisted_hits' in stats:
+                line += f', from the DB: {stats["persisted_hits"]}'
+            cache_lines.append(line)
+
+        limiter, breaker = client.limiter.stats(), client.breaker.stats()
+        guard_lines = [f'Rate limiter: {limiter["tokens"]:.1f}/{limiter["burst"]} tokens at {limiter["rate"]}/s, '
+                       f'{limiter["delayed"]}/{limiter["acquired"]} requests delayed ({limiter["total_wait"]:.1f} s total), '
+                       f'{limiter["pauses"]} Retry-After pauses, paused for {limiter["paused_for"]:.1f} s',
+                       f'Circuit breaker: {breaker["state"]}, {breaker["consecutive_failures"]} failures in a row, '
+                       f'opened {breaker["times_opened"]} times, {breaker["rejected"]} requests failed fast, '
+                       f'next probe in {breaker["retry_in"]:.0f} s',
+                       f'Retries: {client.retries}']
+
+        await send_long_msg(ctx, client.stats.format_table() + '\n\n' + '\n'.join(cache_lines + guard_lines),
+                            code_block=True, code_block_lang="")
+
+
+    @commands.command(hidden=True, name='msg_buffer')
+    async def msg_buffer(self, ctx):
+        """Shows the state of the message cache write buffer."""
+        buffer = self.bot.message_cache
+        if buffer is None:
+            await ctx.send('The message cache buffer is not running.')
+            return
+
+        index_lines = ''
+        if buffer.index is not None:
+            stats = buffer.index.stats()
+            index_lines = (f'Indexed messages:             {stats["size"]} (+{stats["filtered"]} in the filter)\n'
+                           f'Index hits:                   {stats["hits"]}\n'
+                           f'Index misses (not cached):    {stats["misses"]}\n'
+                           f'Filter hits:                  {stats["filter_hits"]} ({stats["false_positives"]} false positives)\n'
+                           f'Older than the index:         {stats["unknown"]}\n')
+
+        await ctx.send(f'```\n'
+                       f'Pending rows:                 {buffer.depth}\n'
+                       f'Rows flushed:                 {buffer.rows_flushed}\n'
+                       f'Inserts cancelled by deletes: {buffer.rows_cancelled}\n'
+                       f'{index_lines}'
+                       f'```')
+
+
+    @commands.command(hidden=True, name='delete_queue')
+    async def delete_queue(self, ctx):
+        """Shows the state of the deleted message queue."""
+        queue = self.bot.delete_queue
+        if queue is None:
+            await ctx.send('The delete queue is not running.')
+            return
+
+        stats = queue.stats()
+        await ctx.send(f'```\n'
+                       f'Queued:                       {stats["depth"]} (max {stats["max_depth"]}, limit {queue.max_size})\n'
+                       f'Deletions added:              {stats["added"]}\n'
+                       f'Duplicates coalesced:         {stats["coalesced"]}\n'
+                       f'PK lookups skipped (full):    {stats["shed"]}\n'
+                       f'PK lookups:                   {stats["resolved"]} ({stats["resolve_errors"]} errors)\n'
+                       f'Cleaned up:                   {stats["cleaned"]} in {stats["batches"]} batches ({stats["cleanup_errors"]} errors)\n'
+                       f'Queue delay:                  p50 {stats["delay_p50_ms"]:.0f} ms, p95 {stats["delay_p95_ms"]:.0f} ms, max {stats["delay_max_ms"]:.0f} ms\n'
+                       f'```')
+
+
+    @commands.command(hidden=True, name='db_spool')
+    async def db_spool(self, ctx, option: Optional[str] = None):
+        """Shows the state of the on disk write spool. Pass `drain` to replay it into the DB now."""
+        write_spool = self.bot.write_spool
+        if write_spool is None:
+            await ctx.send('The write spool is not running.')
+            return
+
+        if option == 'drain':
+            await write_spool.drain()
+
+        stats = write_spool.stats()
+        await ctx.send(f'```\n'
+                       f'Spooling writes:      {stats["active"]}\n'
+                       f'Spooled records:      {stats["depth"]} in {stats["segments"]} segments\n'
+                       f'Records not fsynced:  {stats["unsynced"]}\n'
+                       f'Records spooled:      {stats["records_spooled"]}\n'
+                       f'Records drained:      {stats["records_drained"]}\n'
+                       f'Last drain rate:      {stats["drain_rate"]:.0f} records/s\n'
+                       f'Records set aside:    {stats["records_quarantined"]}\n'
+                       f'```')
+
+
+    @commands.command(hidden=True, name='db_pool')
+    async def db_pool(self, ctx, which: str = 'main'):
+        """Shows the state of a DB connection pool. Pass `analytics` for the analytics pool."""
+        pool = self.bot.analytics_db if which == 'analytics' else self.bot.db
+        if pool is None:
+            await ctx.send(f'The {which} pool is not running.')
+            return
+
+        stats = pDB.get_pool_stats(pool)
+        await ctx.send(f'```\n'
+                       f'Connections:       {stats["size"]} (min {stats["min_size"]}, max {stats["max_size"]})\n'
+                       f'Acquired:          {stats["acquired"]}\n'
+                       f'Idle:              {stats["idle"]}\n'
+                       f'Waiting:           {stats["waiting"]}\n'
+                       f'Acquires:          {stats["acquire_count"]}\n'
+                       f'Acquire wait p50:  {stats["acquire_wait_p50_ms"]:.2f} ms\n'
+                       f'Acquire wait p99:  {stats["acquire_wait_p99_ms"]:.2f} ms\n'
+                       f'Acquire wait max:  {stats["acquire_wait_max_ms"]:.2f} ms\n'
+                       f'Registered statements: {len(pDB.STATEMENTS)}\n'
+                       f'```')
+
+
     @commands.command(hidden=True)
     async def load(self, ctx, *, module):
         """Loads a module."""
@@ -4,7 +4,11 @@ Cog containing commands for detecting & purging inactive users.
 Part of PNBot.
 """
 
+import io
+import csv
+import gzip
 import logging
+import tempfile
 from typing import TYPE_CHECKING, Optional, Dict, List, Union, Tuple
 
 import pDB
@@ -13,9 +17,10 @@ import asyncio
 import dateparser
 from utilities.pluralKitAPI import get_pk_message, PKAPIUnavailable, CouldNotConnectToPKAPI, UnknownPKError
 from utilities.roleParser import parse_csv_roles
+from utilities.messageDeleteQueue import MessageDeleteQueue
 from utilities.utils import is_team_member, send_long_msg, send_long_embed, pn_embed, get_channel
 from utilities.moreColors import pn_orange
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from embeds import std_embed, log_welcome_back
 from utilities.paginator import FieldPages, TextPages, Pages, UnnumberedPages
 
@@ -84,7 +89,8 @@ def get_users_cooldown_role_channel_and_number(cooldown_configs: List[Dict[str,
 
 
 async def isolate_inactive_member(ctx: commands.Context, member: Union[discord.User, discord.Member],
-                                  roles_to_keep: List[discord.Role]):
+                                  roles_to_keep: List[discord.Role]) -> bool:
+    """Returns False, without touching the member's roles, if the roles to remove could not be saved to the DB."""
     inactive_level_one_id: int = ctx.bot.guild_setting(ctx.guild.id, 'inactive_level_one_role_id')  # 815335443285147679
     inactive_level_two_id: int = ctx.bot.guild_setting(ctx.guild.id, 'inactive_level_two_role_id')  # 815335449194659911
 
@@ -99,7 +105,18 @@ async def isolate_inactive_member(ctx: commands.Context, member: Union[discord.U
 
         if keep is None:
             roles_to_remove.append(role)
-            await pDB.add_role_tmp_removed_from_user(ctx.bot.db, ctx.guild.id, member.id, role.id)
+
+    # Record the removed roles and the inactivity event together, before touching Discord, so a connection isn't held across the API calls.
+    async with pDB.session(ctx.bot.db) as db:
+        for role in roles_to_remove:
+            await pDB.add_role_tmp_removed_from_user(db, ctx.guild.id, member.id, role.id)
+        await pDB.add_inactivity_event(db, ctx.guild.id, member.id, current_level=1, previous_level=0, reason=None)
+
+    if not db.committed:
+        # Removing the roles anyway would leave nothing to restore them from.
+        log.error(f"Could not save the roles removed from {member.id}. Not moving them to Welcome Back.")
+        await ctx.send(f"Error! Unable to save {member.display_name}'s roles to the database. They have not been moved.")
+        return False
 
     log.info("Removing roles from user")
     roles_unable_to_remove = []
@@ -119,20 +136,7 @@ async def isolate_inactive_member(ctx: commands.Context, member: Union[discord.U
                                       desc=unremovable_roles_str))
 
     await member.add_roles(discord.Object(inactive_level_one_id), reason="Member was moved to Welcome Back due to inactivity.")
-
-    await pDB.add_inactivity_event(ctx.bot.db, ctx.guild.id, member.id, current_level=1, previous_level=0, reason=None)
-
-    welcome_back_channel_id: int = ctx.bot.guild_setting(ctx.guild.id, 'welcome_back_channel_id')
-    guild: discord.Guild = ctx.guild
-    welcome_back_ch: discord.TextChannel = guild.get_channel(welcome_back_channel_id)
-    # if welcome_back_ch is not None:
-    #     await welcome_back_ch.send("\N{Waving Hand Sign}")
-    #     await welcome_back_ch.send(f"Hey there! Long time no see {member.display_name}!!!!\n"
-    #                                f"\N{ZERO WIDTH SPACE}\n"
-    #                                f"No worries, you're not in trouble or anything, you've just been moved to this channel since it's been a while since you last spoke here at Nest. This way we can better protect our members.\n"
-    #                                f"\N{ZERO WIDTH SPACE}\n"
-    #                                f"You're still more than welcome here and we would absolutely love to get to talk to you again \N{Slightly Smiling Face}\n"
-    #                                f"Just say hi and a staff member will restore your access to the rest of the server.")
+    return True
 
 
 async def restore_inactive_member(ctx: commands.Context, member: Union[discord.User, discord.Member]):
@@ -170,14 +174,15 @@ async def restore_inactive_member(ctx: commands.Context, member: Union[discord.U
                                       desc=unaddable_roles_str))
 
     log.info("Removing stored roles from DB")
-    await pDB.delete_inactive_member_removed_roles(ctx.bot.db, ctx.guild.id, member.id)
-
-    await pDB.add_inactivity_event(ctx.bot.db, ctx.guild.id, member.id, 0, 1, None)
+    async with pDB.session(ctx.bot.db) as db:
+        await pDB.delete_inactive_member_removed_roles(db, ctx.guild.id, member.id)
+        await pDB.add_inactivity_event(db, ctx.guild.id, member.id, 0, 1, None)
     log.info("Restoration Complete")
 
 
 
-async def move_member_into_isolation_room(ctx: commands.Context, member: Union[discord.User, discord.Member], isolation_role: Union[discord.Role, discord.Object], reason="", inactive_event=False, cooldown_event=False):
+async def move_member_into_isolation_room(ctx: commands.Context, member: Union[discord.User, discord.Member], isolation_role: Union[discord.Role, discord.Object], reason="", inactive_event=False, cooldown_event=False) -> bool:
+    """Returns False, without touching the member's roles, if the roles to remove could not be saved to the DB."""
 
     log.info(f"Getting users roles from Discord")
     user_roles: List[discord.Role] = member.roles[1:]  # Get all the roles EXCEPT @everyone.
@@ -186,7 +191,19 @@ async def move_member_into_isolation_room(ctx: commands.Context, member: Union[d
     roles_to_remove = []
     for role in user_roles:
         roles_to_remove.append(role)
-        await pDB.add_role_tmp_removed_from_user(ctx.bot.db, ctx.guild.id, member.id, role.id)
+
+    # Record the removed roles (and the inactivity event) together, before touching Discord, so a connection isn't held across the API calls.
+    async with pDB.session(ctx.bot.db) as db:
+        for role in roles_to_remove:
+            await pDB.add_role_tmp_removed_from_user(db, ctx.guild.id, member.id, role.id)
+        if inactive_event:
+            await pDB.add_inactivity_event(db, ctx.guild.id, member.id, current_level=1, previous_level=0, reason=None)
+
+    if not db.committed:
+        # Removing the roles anyway would leave nothing to restore them from.
+        log.error(f"Could not save the roles removed from {member.id}. Not isolating them.")
+        await ctx.send(f"Error! Unable to save {member.display_name}'s roles to the database. They have not been moved.")
+        return False
 
     log.info("Removing roles from user")
     roles_unable_to_remove = []
@@ -206,20 +223,7 @@ async def move_member_into_isolation_room(ctx: commands.Context, member: Union[d
                                       desc=unremovable_roles_str))
 
     await member.add_roles(isolation_role, reason=reason)
-
-    if inactive_event:
-        await pDB.add_inactivity_event(ctx.bot.db, ctx.guild.id, member.id, current_level=1, previous_level=0, reason=None)
-        # welcome_back_channel_id: int = ctx.bot.guild_setting(ctx.guild.id, 'welcome_back_channel_id')
-        # guild: discord.Guild = ctx.guild
-        # welcome_back_ch: discord.TextChannel = guild.get_channel(welcome_back_channel_id)
-        # if welcome_back_ch is not None:
-        #     await welcome_back_ch.send("\N{Waving Hand Sign}")
-        #     await welcome_back_ch.send(f"Hey there! Long time no see {member.display_name}!!!!\n"
-        #                                f"\N{ZERO WIDTH SPACE}\n"
-        #                                f"No worries, you're not in trouble or anything, you've just been moved to this channel since it's been a while since you last spoke here at Nest. This way we can better protect our members.\n"
-        #                                f"\N{ZERO WIDTH SPACE}\n"
-        #                                f"You're still more than welcome here and we would absolutely love to get to talk to you again \N{Slightly Smiling Face}\n"
-        #                                f"Just say hi and a staff member will restore your access to the rest of the server.")
+    return True
 
 
 async def move_member_out_of_isolation_room(ctx: commands.Context, member: Union[discord.User, discord.Member], isolation_role: Union[discord.Role, discord.Object], reason="", inactive_event=False, cooldown_event=False):
@@ -253,10 +257,10 @@ async def move_member_out_of_isolation_room(ctx: commands.Context, member: Union
                                       desc=unaddable_roles_str))
 
     log.info("Removing stored roles from DB")
-    await pDB.delete_inactive_member_removed_roles(ctx.bot.db, ctx.guild.id, member.id)
-
-    if inactive_event:
-        await pDB.add_inactivity_event(ctx.bot.db, ctx.guild.id, member.id, 0, 1, None)
+    async with pDB.session(ctx.bot.db) as db:
+        await pDB.delete_inactive_member_removed_roles(db, ctx.guild.id, member.id)
+        if inactive_event:
+            await pDB.add_inactivity_event(db, ctx.guild.id, member.id, 0, 1, None)
 
     log.info("Restoration Complete")
 
@@ -304,10 +308,10 @@ async def move_member_out_of_isolation_room_from_react(response_channel: discord
                                     desc=unaddable_roles_str))
 
     log.info("Removing stored roles from DB")
-    await pDB.delete_inactive_member_removed_roles(db_pool, guild.id, member.id)
-
-    if inactive_event:
-        await pDB.add_inactivity_event(db_pool, guild.id, member.id, 0, 1, None)
+    async with pDB.session(db_pool) as db:
+        await pDB.delete_inactive_member_removed_roles(db, guild.id, member.id)
+        if inactive_event:
+            await pDB.add_inactivity_event(db, guild.id, member.id, 0, 1, None)
 
     log.info("Restoration Complete")
 
@@ -402,13 +406,25 @@ class IsolateInactiveMembers:
                     if self.doesMemberHaveAllRequiredRoles(self.selected_filters['required_roles'], member):
                         if member.joined_at < latest_join_date and (earliest_join_date is None or member.joined_at > earliest_join_date):
                             members_to_check.append(member)
-                            messages = await pDB.get_cached_messages_after_timestamp(self.pool, last_active, guild.id, member.id)
-                            inactive = self.doesMemberHaveFewerThanMinimumPostCount(self.selected_filters['post_count'], messages, member)
-                            if inactive:
 
-                                    join_date_msg = f"Joined: {member.joined_at.strftime('%b %d, %Y')}" if member.joined_at is not None else "Could not determine when they joined."
-                                    inact_mem_text = f"<@!{member.id}> - {member.name}#{member.discriminator}, Posts: **{len(messages)}**{last_active_msg},  {join_date_msg}"
-                                    inactive_members.append((member, inact_mem_text))
+        # One query for every candidate instead of one per member. Runs on the analytics pool so a big scan can't starve the chat handlers.
+        try:
+            post_counts = await pDB.post_counts_for_users_since(self.bot.analytics_db, guild.id, [member.id for member in members_to_check], last_active)
+        except pDB.QueryTimeoutError as e:
+            await ctx.send(f"Error! Counting posts took longer than {e.timeout:g} seconds and was cancelled. Please try again with a shorter time frame.")
+            return await self.canceled()
+        if post_counts is None:
+            # Without post counts everyone would look inactive.
+            await ctx.send("Error! Unable to retrieve post counts from the database.")
+            return await self.canceled()
+
+        for member in members_to_check:
+            post_count = post_counts[member.id]
+            inactive = self.doesMemberHaveFewerThanMinimumPostCount(self.selected_filters['post_count'], post_count)
+            if inactive:
+                join_date_msg = f"Joined: {member.joined_at.strftime('%b %d, %Y')}" if member.joined_at is not None else "Could not determine when they joined."
+                inact_mem_text = f"<@!{member.id}> - {member.name}#{member.discriminator}, Posts: **{post_count}**{last_active_msg},  {join_date_msg}"
+                inactive_members.append((member, inact_mem_text))
 
 
         inactive_members.sort(key=lambda x: x[0].joined_at, reverse=True)
@@ -445,10 +461,9 @@ class IsolateInactiveMembers:
 
         return True
 
-    def doesMemberHaveFewerThanMinimumPostCount(self, minimum_post_count: int, cached_messages: List[pDB.CachedMessage], member: Union[discord.User, discord.Member]):
+    def doesMemberHaveFewerThanMinimumPostCount(self, minimum_post_count: int, post_count: int):
 
-        members_messages = list(filter(lambda x: x.user_id == member.id, cached_messages))
-        if len(members_messages) > minimum_post_count:
+        if post_count > minimum_post_count:
             return False
         return True
 
@@ -805,12 +820,24 @@ class IsolateInactiveStaff:
                 if in_inact_one is None and in_inact_two is None:
                     if member.joined_at < latest_join_date and (earliest_join_date is None or member.joined_at > earliest_join_date):
                         members_to_check.append(member)
-                        messages = await pDB.get_cached_messages_after_timestamp(self.pool, last_active, guild.id, member.id)
-                        active = discord.utils.get(messages, user_id=member.id)
-                        if not active:
-                                join_date_msg = f"Joined: {member.joined_at.strftime('%b %d, %Y')}" if member.joined_at is not None else "Could not determine when they joined."
-                                inact_mem_text = f"<@!{member.id}> - {member.name}#{member.discriminator}, Posts: **{len(messages)}** since {last_active.strftime('%b %d, %Y')}, {join_date_msg}"
-                                inactive_members.append((member, inact_mem_text))
+
+        # One query for every candidate instead of one per member. Runs on the analytics pool so a big scan can't starve the chat handlers.
+        try:
+            post_counts = await pDB.post_counts_for_users_since(self.bot.analytics_db, guild.id, [member.id for member in members_to_check], last_active)
+        except pDB.QueryTimeoutError as e:
+            await ctx.send(f"Error! Counting posts took longer than {e.timeout:g} seconds and was cancelled. Please try again with a shorter time frame.")
+            return await self.canceled()
+        if post_counts is None:
+            # Without post counts everyone would look inactive.
+            await ctx.send("Error! Unable to retrieve post counts from the database.")
+            return await self.canceled()
+
+        for member in members_to_check:
+            post_count = post_counts[member.id]
+            if post_count == 0:
+                join_date_msg = f"Joined: {member.joined_at.strftime('%b %d, %Y')}" if member.joined_at is not None else "Could not determine when they joined."
+                inact_mem_text = f"<@!{member.id}> - {member.name}#{member.discriminator}, Posts: **{post_count}** since {last_active.strftime('%b %d, %Y')}, {join_date_msg}"
+                inactive_members.append((member, inact_mem_text))
 
         inactive_members.sort(key=lambda x: x[0].joined_at, reverse=True)
         self.selected_inactive_members = inactive_members
@@ -1072,12 +1099,25 @@ class IsolateInactiveStaff:
 
 class UserManagement(commands.Cog):
 
+    # PluralKit deletes the original message within a second or two of it being sent. Anything older than this can't be one.
+    PREPROXY_MAX_AGE = timedelta(minutes=1)
+
     def __init__(self, bot):
 
         self.bot: 'PNBot' = bot
         self.pool: asyncpg.pool.Pool = bot.db
         self._welcome_back_msg_ids_cache: Dict[int, int] = {}
 
+        self.delete_queue = MessageDeleteQueue(self.resolve_deleted_message, self.cleanup_deleted_messages,
+                                               **bot.config.get('message_delete_queue', {}))
+        self.delete_queue.start()
+        bot.delete_queue = self.delete_queue
+
+    def cog_unload(self):
+        if self.bot.delete_queue is self.delete_queue:
+            self.bot.delete_queue = None
+        asyncio.ensure_future(self.delete_queue.close())
+
     async def get_welcome_back_react_msg_id(self, guild_id: int) -> Optional[int]:
 
         # TODO: Implement cache. Cache needs to be invalidated when new msg is sent
@@ -1106,7 +1146,8 @@ class UserManagement(commands.Cog):
                 msg_con = message_contents
 
                 webhook_author_name = message.author.display_name if message.webhook_id is not None else None
-                await pDB.cache_message(self.bot.db, message.guild.id, message.id, message.author.id, msg_con, datetime.utcnow())
+                await self.bot.message_cache.cache_message(message.guild.id, message.id, message.author.id, msg_con,
+                                                           webhook_id=message.webhook_id, author_is_bot=author.bot, channel_id=message.channel.id)
 
         # await self.bot.process_commands(message)
 
@@ -1115,48 +1156,75 @@ class UserManagement(commands.Cog):
     async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
         """
         Fires on every deleted message.
-        Cleans deleted messages from cache, and updates PK messages with PK Details.
-        :param payload:
-        :type payload:
-        :return:
-        :rtype:
+        Hands the message to the delete queue, which updates PK messages with PK Details and cleans deleted messages from cache
+        in the background. See resolve_deleted_message.
         """
-        async def cleanup_message_cache():
-            if db_cached_message is not None:
-                await pDB.delete_cached_message(self.bot.db, payload.guild_id, db_cached_message.message_id)
-
         if payload.guild_id is None:
             return  # We are in a DM, Don't log the message
 
-        # # Get the cached msg from the DB (if possible). Will be None if msg does not exist in DB
-        db_cached_message = await pDB.get_cached_message(self.bot.db, payload.guild_id, payload.message_id)
+        # Sent by a bot or a webhook, or never cached? Either way PluralKit didn't delete it to proxy it, so skip the PK API.
+        self.delete_queue.add(payload.guild_id, payload.message_id,
+                              resolve=self.bot.message_cache.might_be_preproxy_message(payload.message_id))
+
+
+    def looks_like_preproxy_message(self, message_id: int) -> bool:
+        """True if a deleted message could have been deleted by PluralKit to proxy it, judging only by the cache and the message's age."""
+        if not self.bot.message_cache.might_be_preproxy_message(message_id):
+            return False
+        return datetime.now(timezone.utc) - pDB.datetime_from_snowflake(message_id) < self.PREPROXY_MAX_AGE
+
 
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        """
+        Fires when messages are purged.
+        Queued like single deletes. Only the ones that could still be pre-proxied messages are checked with the PK API.
+        """
+        if payload.guild_id is None:
+            return
+
+        for message_id in payload.message_ids:
+            self.delete_queue.add(payload.guild_id, message_id, resolve=self.looks_like_preproxy_message(message_id))
+
+
+    async def resolve_deleted_message(self, guild_id: int, message_id: int):
+        """Called by the delete queue. If the message was a pre-proxied message, the proxied message gets its PK details."""
         try:
-            pk_msg = await get_pk_message(payload.message_id)
-            pk_api_errors = False
-            if pk_msg is not None and self.verify_message_is_preproxy_message(payload.message_id, pk_msg):
+            pk_msg = await get_pk_message(message_id)
+            if pk_msg is not None and self.verify_message_is_preproxy_message(message_id, pk_msg):
                 # We have confirmed that the message is a pre-proxied message.
-                await self.update_cache_pk_message_details(payload.guild_id, pk_msg)
-                await cleanup_message_cache()
-                return  # Message was a pre-proxied message deleted by PluralKit. Return instead of logging message.
+                await self.update_cache_pk_message_details(guild_id, pk_msg)
 
         except PKAPIUnavailable as e:
             # await miscUtils.log_error_msg(self.bot, e)
             log.error(e)
-            pk_api_errors = True
 
         except UnknownPKError as e:
             # await miscUtils.log_error_msg(self.bot, e)
             log.error(e)
-            pk_api_errors = True
 
-        await cleanup_message_cache()
+
+    async def cleanup_deleted_messages(self, guild_id: int, message_ids: List[int]):
+        """Called by the delete queue. Deleting a message that was never cached is harmless, and the message cache's index keeps most of those from reaching the DB."""
+        await self.bot.message_cache.delete_cached_messages(guild_id, message_ids)
+
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        """
+        The message cache doesn't record which channel a message was in, so only the messages still held by the cache's index
+        can be cleaned up here. Interviews.close_interview cleans up interview channels in full.
+        """
+        message_ids = self.bot.message_cache.recent_channel_message_ids(channel.id)
+        if len(message_ids) > 0:
+            log.info(f"Removing {len(message_ids)} cached messages from deleted channel {channel.id}")
+            await self.bot.message_cache.delete_cached_messages(channel.guild.id, message_ids)
 
 
     @commands.Cog.listener()
     async def on_member_join(self, member: Union[discord.User, discord.Member]):
         log.info(f"Member Joined. Logging.")
-        await pDB.add_join_event(self.pool, member.guild.id, member.id)
+        await self.bot.write_spool.add_join_event(member.guild.id, member.id)
         await asyncio.sleep(10)
         # TODO: Find and parse the GG Join Log
 
@@ -1287,15 +1355,15 @@ class UserManagement(commands.Cog):
         # TODO: Remove verbose Logging once feature deemed to be stable .
         logging.debug(
             f"Updating msg: {message_id} with Sender ID: {sender_discord_id}, System ID: {system_pk_id}, Member ID: {member_pk_id}")
-        await pDB.update_cached_message_pk_details(self.bot.db, guild_id, message_id, system_pk_id, member_pk_id,
-                                                   sender_discord_id)
+        await self.bot.message_cache.update_cached_message_pk_details(guild_id, message_id, system_pk_id, member_pk_id,
+                                                                      sender_discord_id)
 
         if len(error_msg) > 0:
             # await miscUtils.log_error_msg(self.bot, error_msg, header=error_header)
             log.error(error_msg)
 
 
-    async def add_cache_pk_message_details(self, guild_id: int, pk_response: Dict, timestamp, content):
+    async def add_cache_pk_message_details(self, guild_id: int, pk_response: Dict, content):
 
         error_msg = []
         if 'id' in pk_response:  # Message ID (Discord Snowflake) of the proxied message
@@ -1336,7 +1404,7 @@ class UserManagement(commands.Cog):
         # await pDB.update_cached_message_pk_details(self.bot.db, guild_id, message_id, system_pk_id, member_pk_id,
         #                                            sender_discord_id)
         try:
-            await pDB.cache_pk_message(self.bot.db, guild_id, message_id, sender_discord_id, content, timestamp, system_pk_id, member_pk_id)
+            await self.bot.message_cache.cache_pk_message(guild_id, message_id, sender_discord_id, content, system_pk_id, member_pk_id)
         except Exception as e:
             log.error(e)
 
@@ -1469,11 +1537,12 @@ class UserManagement(commands.Cog):
                                  f"Moving {member.display_name} to Welcome Back.\nWorking.... Please Wait.... Moving Member #{i + 1} / {len(members)}.")
                 await msg.edit(embed=embed)
 
-                await isolate_inactive_member(ctx, member, [])
+                moved = await isolate_inactive_member(ctx, member, [])
                 # await self.temp_remove_roles(ctx, member, "Member has been determined to be inactive.", [])
                 # await member.add_roles(discord.Object(inactive_level_one_id), reason="Member has been determined to be inactive.")
 
-                moved_members.append(member)
+                if moved:
+                    moved_members.append(member)
 
         embed = pn_embed(f"Member Moving Complete.",
                          f"Moved {len(moved_members)} Members into Welcome Back.")
@@ -1788,7 +1857,7 @@ class UserManagement(commands.Cog):
                 total_msg_count += 1
                 if not message.author.bot:
                     log.info("Adding Norm msg to cache")
-                    await pDB.cache_message(self.pool, guild.id, message.id, message.author.id, message.content, message.created_at)
+                    await self.bot.message_cache.cache_message(guild.id, message.id, message.author.id, message.content)
 
                 elif message.webhook_id is not None:
                     # log.info("Found Web Hook MSG")
@@ -1799,8 +1868,7 @@ class UserManagement(commands.Cog):
                             # We have confirmed that the message is a pre-proxied message.
                             # await self.update_cache_pk_message_details(payload.guild_id, pk_msg)
                             log.info("Adding PK msg to cache")
-                            await self.add_cache_pk_message_details(guild.id, pk_response, message.created_at, message.content)
-                            await asyncio.sleep(0.2)
+                            await self.add_cache_pk_message_details(guild.id, pk_response, message.content)
 
                     except PKAPIUnavailable as e:
                         # await miscUtils.log_error_msg(self.bot, e)
@@ -1825,6 +1893,67 @@ class UserManagement(commands.Cog):
         await asyncio.sleep(1)
 
 
+    @commands.is_owner()
+    @commands.guild_only()
+    @eCommands.command(name="rebuild_post_counts",
+                       brief="Rebuilds the daily post count rollup for this server from the message cache.",
+                       category="User Management", hidden=True)
+    async def rebuild_post_counts(self, ctx: commands.Context):
+        status_msg = await ctx.send(embed=std_embed("Rebuilding post counts...", "Recounting the cached messages for this server, one day at a time."))
+        rows = await pDB.rebuild_member_daily_activity(self.pool, ctx.guild.id)
+        if rows is None:
+            await status_msg.edit(embed=std_embed("Rebuild failed!", "Check the logs for details."))
+            return
+        await status_msg.edit(embed=std_embed("Post counts rebuilt!", f"The rollup now holds **{rows}** user days for this server."))
+
+
+    @commands.is_owner()
+    @commands.guild_only()
+    @eCommands.command(name="export_msg_cache",
+                       brief="Exports the cached messages for this server as a gzipped CSV file.",
+                       examples=['30 days ago', "4/5/2020"],
+                       category="User Management", hidden=True)
+    async def export_msg_cache(self, ctx: commands.Context, *, how_long_ago: str):
+        timestamp = dateparser.parse(how_long_ago, settings={'TIMEZONE': 'UTC'})
+
+        if timestamp is None:
+            await ctx.send(f"Error! Unable to determine when {how_long_ago} is!")
+            return
+
+        status_msg = await ctx.send(embed=std_embed("Exporting message cache...", f"Exporting messages since {timestamp.strftime('%b %d, %Y, %I:%M %p UTC')}."))
+
+        # Streamed straight to a temp file so the size of the export doesn't matter. The file is deleted when it is closed,
+        # which the with block does however the export ends.
+        msg_count = 0
+        with tempfile.TemporaryFile() as export_file:
+            try:
+                with gzip.GzipFile(fileobj=export_file, mode='wb') as gz_file, io.TextIOWrapper(gz_file, encoding='utf-8', newline='') as text_file:
+                    writer = csv.writer(text_file)
+                    writer.writerow(["message_id", "user_id", "timestamp", "system_pkid", "member_pkid", "content"])
+                    async for batch in pDB.iter_cached_messages_after_timestamp(self.bot.analytics_db, timestamp, ctx.guild.id):
+                        for msg in batch:
+                            writer.writerow([msg.message_id, msg.user_id, datetime.utcfromtimestamp(msg.ts).isoformat(),
+                                             msg.system_pkid, msg.member_pkid, msg.content])
+                        msg_count += len(batch)
+            except pDB.QueryTimeoutError as e:
+                await status_msg.edit(embed=std_embed("Export failed!", f"Reading the messages took longer than {e.timeout:g} seconds and was cancelled. Please try again with a shorter time frame."))
+                return
+            except Exception:
+                # The iterator isn't wrapped by db_deco, so DB errors (and running out of disk for the temp file) end up here.
+                log.exception(f"Error exporting the message cache for {ctx.guild.id} after {msg_count} messages.")
+                await status_msg.edit(embed=std_embed("Export failed!", "Check the logs for details."))
+                return
+
+            file_size = export_file.tell()
+            if file_size > ctx.guild.filesize_limit:
+                await status_msg.edit(embed=std_embed("Export too large!", f"{msg_count} messages came to {file_size / 1024 / 1024:.1f} MB, which is more than Discord will accept. Try a shorter time frame."))
+                return
+
+            export_file.seek(0)
+            await ctx.send(file=discord.File(export_file, filename=f"msg_cache_{ctx.guild.id}_{timestamp.strftime('%Y%m%d')}.csv.gz"))
+            await status_msg.edit(embed=std_embed("Export complete!", f"Exported **{msg_count}** messages."))
+
+
     @is_team_member()
     @commands.guild_only()
     @eCommands.command(name="list_nonmembers",
@@ -1980,9 +2109,10 @@ class UserManagement(commands.Cog):
                                       "***Working.... Please Wait....***")
                     await progress_msg.edit(embed=embed)
                 """MOVE USER INTO COOLDOWN"""
-                await move_member_into_isolation_room(ctx, member, selected_cooldown_role, reason="Member is being moved into Cooldown", cooldown_event=True)
+                moved = await move_member_into_isolation_room(ctx, member, selected_cooldown_role, reason="Member is being moved into Cooldown", cooldown_event=True)
                 members_left_to_move.remove(member)
-                members_in_cooldown.append(member)
+                if moved:
+                    members_in_cooldown.append(member)
 
             members_in_cd_st = "\n".join([member.display_name for member in members_in_cooldown])
 
@@ -2120,23 +2250,14 @@ class UserManagement(commands.Cog):
         status_msg = await ctx.send(embed=std_embed("Searching for posts..",
                                                     f"Searching for posts since {timestamp.strftime('%b %d, %Y, %I:%M %p UTC')}.\nRetrieving message counts..."))
 
-        messages = await pDB.get_all_cached_messages_after_timestamp(self.bot.db, timestamp, ctx.guild.id)
-        # await asyncio.sleep(1)
-
-        progress_str = f"Rummaging through {len(messages)} messages.\n" \
-                       f"**Processing! Processing!! Processing!!!**"
-
-        embed = std_embed("Searching for posts.......", progress_str)
-        await status_msg.edit(embed=embed)
-        # await ctx.send(embed=embed)
-        # await asyncio.sleep(1)
-
-        post_count = 0
-
-        guild: discord.Guild = ctx.guild
-        for msg in messages:
-            if msg.user_id == member.id:
-                post_count += 1
+        try:
+            post_count = await pDB.count_posts_since(self.bot.analytics_db, ctx.guild.id, member.id, timestamp)
+        except pDB.QueryTimeoutError as e:
+            await status_msg.edit(embed=std_embed("Error!", f"Counting posts took longer than {e.timeout:g} seconds and was cancelled. Please try again with a shorter time frame."))
+            return
+        if post_count is None:
+            await status_msg.edit(embed=std_embed("Error!", "Unable to retrieve the post count from the database."))
+            return
 
         join_date_msg = f"They last joined PN on {member.joined_at.strftime('%b %d, %Y, %I:%M %p UTC')}" if member.joined_at is not None else "Could not determine when they joined."
         await status_msg.edit(embed=std_embed("Finished searching for posts!",
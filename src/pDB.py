@@ -1,132 +1,538 @@
+import re
 import aiosqlite
 import logging
 import time
+import asyncio
 import functools
+import itertools
+
+from contextlib import asynccontextmanager
+from types import ModuleType
 
 import asyncpg
 
-from datetime import datetime
-from typing import TYPE_CHECKING, Optional, List, Dict
+from datetime import datetime, date, timedelta, timezone
+from typing import TYPE_CHECKING, Optional, List, Dict, Tuple, Callable, Awaitable, AsyncIterator, Iterable, NamedTuple
 from dataclasses import dataclass, field
 
 import discord
 
+from utilities.latencyStats import LatencyStats, LatencyHistogram
+from utilities.spool import Spool, Record
+from utilities.messageIndex import RecentMessageIndex, IndexedMessage
+
 
 log = logging.getLogger("PNBot.pDB")
 
 
+# Per function latency stats for everything wrapped in db_deco. See get_query_stats().
+query_stats = LatencyStats()
+
+
+class QueryTimeoutError(Exception):
+    """Raised (instead of returning None) when a query on the analytics pool runs past its statement timeout."""
+
+    def __init__(self, query_name: str, timeout: float):
+        self.query_name = query_name
+        self.timeout = timeout
+        super().__init__(f"{query_name} took longer than {timeout:g} seconds and was cancelled.")
+
+
+# Other storage backends (see sqliteDB.py). handle type -> module with the same functions as this one.
+_backends: Dict[type, ModuleType] = {}
+
+
+def register_backend(module: ModuleType, *handle_types: type):
+    """Routes every pDB call made with one of handle_types in place of the pool to the function of the same name in module."""
+    for handle_type in handle_types:
+        _backends[handle_type] = module
+
+
+def _backend_for(pool) -> Optional[ModuleType]:
+    return _backends.get(type(pool))
+
+
 def db_deco(func):
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
+        backend = _backend_for(args[0]) if len(args) > 0 else None
+        if backend is not None:
+            return await getattr(backend, func.__name__)(*args, **kwargs)
+
         start_time = time.perf_counter()
+        error = True
         try:
             response = await func(*args, **kwargs)
-            end_time = time.perf_counter()
-            if len(args) > 1:
-                log.info("DB Query {} from {} in {:.3f} ms.".format(func.__name__, args[1], (end_time - start_time) * 1000))
-            else:
-                log.info("DB Query {} in {:.3f} ms.".format(func.__name__, (end_time - start_time) * 1000))
+            error = False
+            if log.isEnabledFor(logging.DEBUG):
+                if len(args) > 1:
+                    log.debug("DB Query {} from {} in {:.3f} ms.".format(func.__name__, args[1], (time.perf_counter() - start_time) * 1000))
+                else:
+                    log.debug("DB Query {} in {:.3f} ms.".format(func.__name__, (time.perf_counter() - start_time) * 1000))
             return response
+        except asyncio.TimeoutError as e:
+            # Hit the client side command_timeout. asyncpg has already asked the server to cancel the query.
+            if len(args) > 0 and _is_analytics(args[0]):
+                raise QueryTimeoutError(func.__name__, _analytics_timeout(args[0])) from e
+            # On the main pool it's just another DB error. Raising would take the event handler down with it.
+            if len(args) > 0 and isinstance(args[0], Session):
+                args[0].timed_out = True
+            if not _fail_session(args, e):
+                log.exception("Database query timed out: {}".format(func.__name__))
+        except asyncpg.exceptions.QueryCanceledError as e:
+            if len(args) > 0 and _is_analytics(args[0]):
+                raise QueryTimeoutError(func.__name__, _analytics_timeout(args[0])) from e
+            if not _fail_session(args, e):
+                log.exception("Error attempting database query: {}".format(func.__name__))
         # except Exception:
-        except asyncpg.exceptions.PostgresError:
-            log.exception("Error attempting database query: {} for server: {}".format(func.__name__, args[1]))
+        except asyncpg.exceptions.PostgresError as e:
+            if not _fail_session(args, e):
+                if len(args) > 1:
+                    log.exception("Error attempting database query: {} for server: {}".format(func.__name__, args[1]))
+                else:
+                    log.exception("Error attempting database query: {}".format(func.__name__))
+        finally:
+            query_stats.record(func.__name__, (time.perf_counter() - start_time) * 1000, error)
     return wrapper
 
 
-async def create_db_pool(uri: str) -> asyncpg.pool.Pool:
+def _fail_session(args: tuple, error: BaseException) -> bool:
+    """
+    Marks the session the call was made with (if any) as failed, so it is rolled back.
+    Returns True if the error came from writes the session had queued. Session.flush has already logged those.
+    """
+    if len(args) == 0 or not isinstance(args[0], Session):
+        return False
+    args[0].failed = True
+    return args[0].flush_error is error
+
+
+def get_query_stats() -> Dict[str, Dict[str, float]]:
+    """
+    Latency stats for every DB function called since startup (or the last reset), keyed by function name.
+    Each entry has count, errors, mean_ms, p50_ms, p95_ms, p99_ms and max_ms.
+    """
+    return query_stats.snapshot()
+
+
+def reset_query_stats():
+    query_stats.reset()
+
+
+# ---------- Query Layer ---------- #
+# Every pDB statement is declared once with statement(). Each connection prepares a statement the first time it runs it
+# and keeps it in asyncpg's per connection statement cache, which create_db_pool sizes to hold all of them, so after
+# that the hot paths never pay for parsing or planning. DDL and the other maintenance-only SQL is still run ad hoc.
+#
+# They are left to the statement cache rather than kept as PreparedStatement objects, as asyncpg invalidates those
+# every time a connection goes back to the pool.
+
+class Statement:
+    __slots__ = ('name', 'query', 'expected_index', 'allow_seq_scan')
+
+    def __init__(self, name: str, query: str, expected_index: Optional[str] = None, allow_seq_scan: bool = False):
+        self.name = name
+        self.query = query
+        self.expected_index = expected_index  # Index the plan is expected to use. Checked by benchmarks/explain_plans.py.
+        self.allow_seq_scan = allow_seq_scan  # The statement is meant to read a whole table (or a whole small one).
+
+    def __repr__(self):
+        return f"Statement({self.name!r})"
+
+
+STATEMENTS: Dict[str, Statement] = {}
+
+
+def statement(name: str, query: str, expected_index: Optional[str] = None, allow_seq_scan: bool = False) -> Statement:
+    """
+    Registers a statement. Connections prepare it on first use and keep it in their statement cache.
+    expected_index and allow_seq_scan describe the plan the statement should get, see benchmarks/explain_plans.py.
+    """
+    if name in STATEMENTS:
+        raise ValueError(f"A statement named {name} has already been registered.")
+    stmt = STATEMENTS[name] = Statement(name, query, expected_index, allow_seq_scan)
+    return stmt
+
+
+async def _execute(conn: asyncpg.connection.Connection, stmt: Statement, *args) -> str:
+    """Runs a statement and returns its status string, like Connection.execute."""
+    return await conn.execute(stmt.query, *args)
+
+
+async def _execute_batched(conn: asyncpg.connection.Connection, stmt: Statement, *args):
+    """Like _execute, but for writes whose result isn't needed. In a Session it is queued so it can be batched with other calls of the same statement."""
+    if isinstance(conn, Session):
+        await conn.defer(stmt, args)
+    else:
+        await conn.execute(stmt.query, *args)
+
+
+async def _executemany(conn: asyncpg.connection.Connection, stmt: Statement, args: list):
+    await conn.executemany(stmt.query, args)
+
+
+async def _fetch(conn: asyncpg.connection.Connection, stmt: Statement, *args) -> List[asyncpg.Record]:
+    return await conn.fetch(stmt.query, *args)
+
+
+async def _fetchrow(conn: asyncpg.connection.Connection, stmt: Statement, *args) -> Optional[asyncpg.Record]:
+    return await conn.fetchrow(stmt.query, *args)
+
+
+async def _fetchval(conn: asyncpg.connection.Connection, stmt: Statement, *args):
+    return await conn.fetchval(stmt.query, *args)
+
+
+def _cursor(conn: asyncpg.connection.Connection, stmt: Statement, *args) -> asyncpg.cursor.CursorFactory:
+    """Server side cursor. Must be used inside a transaction."""
+    return conn.cursor(stmt.query, *args)
+
+
+class _PoolCounters:
+    __slots__ = ('waiting', 'acquire_wait')
+
+    def __init__(self):
+        self.waiting = 0  # Callers currently waiting on pool.acquire()
+        self.acquire_wait = LatencyHistogram()  # How long acquiring a connection took.
+
+
+_pool_counters: Dict[int, _PoolCounters] = {}  # id(pool) -> counters. Pools live for the lifetime of the bot.
+
+
+@asynccontextmanager
+async def _acquire(pool: asyncpg.pool.Pool):
+    """
+    pool.acquire() that keeps track of how many callers are waiting for a connection and for how long.
+    If pool is a Session, the session is used as the connection instead.
+    """
+    if isinstance(pool, Session):
+        yield pool
+        return
+
+    counters = _pool_counters.get(id(pool))
+    if counters is None:
+        counters = _pool_counters[id(pool)] = _PoolCounters()
+
+    counters.waiting += 1
+    start_time = time.perf_counter()
+    try:
+        conn = await pool.acquire()
+    finally:
+        counters.waiting -= 1
+        counters.acquire_wait.record((time.perf_counter() - start_time) * 1000)
+
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+
+def get_pool_stats(pool: asyncpg.pool.Pool) -> Dict[str, float]:
+    """Current connection counts for a pool, plus how long callers have had to wait to acquire a connection."""
+    backend = _backend_for(pool)
+    if backend is not None:
+        return backend.get_pool_stats(pool)
+
+    size = pool.get_size()
+    idle = pool.get_idle_size()
+    counters = _pool_counters.get(id(pool), _PoolCounters())
+    return {
+        'min_size': pool.get_min_size(),
+        'max_size': pool.get_max_size(),
+        'size': size,
+        'acquired': size - idle,
+        'idle': idle,
+        'waiting': counters.waiting,
+        'acquire_count': counters.acquire_wait.count,
+        'acquire_wait_p50_ms': counters.acquire_wait.percentile(50),
+        'acquire_wait_p99_ms': counters.acquire_wait.percentile(99),
+        'acquire_wait_max_ms': counters.acquire_wait.max_ms,
+    }
+
+
+async def create_db_pool(uri: str, min_size: int = 2, max_size: int = 10, statement_cache_size: int = 100,
+                         command_timeout: Optional[float] = 60, max_inactive_connection_lifetime: float = 300,
+                         max_queries: int = 50000) -> asyncpg.pool.Pool:
+    """
+    Creates the connection pool. The keyword arguments come from the optional "db_pool" section of config.json.
+    statement_cache_size is raised if needed so the registered statements always fit, with room left for the ad hoc SQL.
+    """
+    statement_cache_size = max(statement_cache_size, len(STATEMENTS) + 32)
+    pool: asyncpg.pool.Pool = await asyncpg.create_pool(uri, min_size=min_size, max_size=max_size,
+                                                        statement_cache_size=statement_cache_size,
+                                                        command_timeout=command_timeout,
+                                                        max_inactive_connection_lifetime=max_inactive_connection_lifetime,
+                                                        max_queries=max_queries)
+
+    return pool
+
+
+# --- Analytics Pool --- #
+# Staff triggered scans and reports run on their own small pool so they can never take every connection
+# away from the gateway handlers. Queries on it are cancelled once they pass the statement timeout,
+# and the pDB function raises QueryTimeoutError so the command can tell the user instead of hanging.
+# Any pDB function can be routed to it by passing bot.analytics_db as the pool.
 
-    # FIXME: Error Handling
+_analytics_pools: Dict[int, float] = {}  # id(pool) -> statement timeout in seconds.
 
-    pool: asyncpg.pool.Pool = await asyncpg.create_pool(uri)
 
+def _analytics_timeout(pool) -> Optional[float]:
+    if isinstance(pool, Session):
+        return pool.analytics_timeout
+    return _analytics_pools.get(id(pool))
+
+
+def _is_analytics(pool) -> bool:
+    return _analytics_timeout(pool) is not None
+
+
+async def create_analytics_pool(uri: str, max_size: int = 2, statement_timeout: float = 30,
+                                max_inactive_connection_lifetime: float = 60) -> asyncpg.pool.Pool:
+    """
+    Creates the analytics pool. The keyword arguments come from the optional "db_analytics_pool" section of config.json.
+    statement_timeout (seconds) is enforced by the server. The client gives up a few seconds later in case the server doesn't.
+    Connections are only opened while a report is running.
+    """
+    pool: asyncpg.pool.Pool = await asyncpg.create_pool(uri, min_size=0, max_size=max_size,
+                                                        statement_cache_size=len(STATEMENTS) + 32,
+                                                        command_timeout=statement_timeout + 5,
+                                                        max_inactive_connection_lifetime=max_inactive_connection_lifetime,
+                                                        server_settings={'statement_timeout': str(int(statement_timeout * 1000)),
+                                                                         'application_name': 'PNBot analytics'})
+    _analytics_pools[id(pool)] = statement_timeout
     return pool
 
+
+# ---------- Sessions ---------- #
+
+class Session:
+    """
+    A unit of work. Every pDB function accepts a Session in place of the pool, in which case it runs on the session's
+    connection, inside the session's transaction.
+
+    Writes that don't return anything are queued, and consecutive writes of the same statement go out as one executemany.
+    The queue is flushed before anything else runs on the connection and when the session commits.
+    Use pDB.session() to get one.
+    """
+
+    def __init__(self, conn: asyncpg.connection.Connection):
+        self.conn = conn
+        self.failed = False  # Set by db_deco when a query in the session errors. The session is then rolled back.
+        self.analytics_timeout: Optional[float] = None  # Statement timeout, if the session is on the analytics pool.
+        self.committed = False
+        self.flush_error: Optional[BaseException] = None  # The error from the last queued write that failed.
+        self.timed_out = False  # Set when a query in the session hit the pool's command_timeout.
+        self._pending_stmt: Optional[Statement] = None
+        self._pending_args: List[tuple] = []
+
+    async def defer(self, stmt: Statement, args: tuple):
+        if self._pending_stmt is not stmt:
+            await self.flush()
+            self._pending_stmt = stmt
+        self._pending_args.append(args)
+
+    async def flush(self):
+        if self._pending_stmt is None:
+            return
+
+        stmt, pending_args = self._pending_stmt, self._pending_args
+        self._pending_stmt = None
+        self._pending_args = []
+        try:
+            if len(pending_args) == 1:
+                await self.conn.execute(stmt.query, *pending_args[0])
+            else:
+                await self.conn.executemany(stmt.query, pending_args)
+        except (asyncpg.exceptions.PostgresError, asyncio.TimeoutError) as e:
+            # The function that queued the writes has already returned, and whatever triggered the flush isn't what failed.
+            log.exception(f"Error attempting database query: {stmt.name} ({len(pending_args)} queued in a session)")
+            self.failed = True
+            self.timed_out = self.timed_out or isinstance(e, asyncio.TimeoutError)
+            self.flush_error = e
+            raise
+
+    # The parts of the Connection API used by pDB. Each one flushes the queue first so everything runs in order.
+    async def execute(self, query: str, *args, **kwargs) -> str:
+        await self.flush()
+        return await self.conn.execute(query, *args, **kwargs)
+
+    async def executemany(self, query: str, args, **kwargs):
+        await self.flush()
+        return await self.conn.executemany(query, args, **kwargs)
+
+    async def fetch(self, query: str, *args, **kwargs) -> List[asyncpg.Record]:
+        await self.flush()
+        return await self.conn.fetch(query, *args, **kwargs)
+
+    async def fetchrow(self, query: str, *args, **kwargs) -> Optional[asyncpg.Record]:
+        await self.flush()
+        return await self.conn.fetchrow(query, *args, **kwargs)
+
+    async def fetchval(self, query: str, *args, **kwargs):
+        await self.flush()
+        return await self.conn.fetchval(query, *args, **kwargs)
+
+    async def cursor(self, query: str, *args, **kwargs) -> asyncpg.cursor.Cursor:
+        await self.flush()
+        return await self.conn.cursor(query, *args, **kwargs)
+
+    async def copy_records_to_table(self, table_name: str, **kwargs) -> str:
+        await self.flush()
+        return await self.conn.copy_records_to_table(table_name, **kwargs)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """A savepoint inside the session's transaction. Queued writes are flushed on the way in and out."""
+        await self.flush()
+        async with self.conn.transaction():
+            yield
+            await self.flush()
+
+    def __getattr__(self, item):
+        return getattr(self.conn, item)
+
+
+@asynccontextmanager
+async def session(pool) -> AsyncIterator[Session]:
+    """
+    Runs every pDB call made with the session on one connection and commits them together:
+
+        async with pDB.session(bot.db) as db:
+            await pDB.add_role_tmp_removed_from_user(db, guild_id, user_id, role_id)
+            await pDB.add_inactivity_event(db, guild_id, user_id, 1, 0, None)
+
+    If any of the calls fail (they still log and return None as usual), or the block raises, nothing is committed.
+    Passing a Session in place of the pool joins that session instead of starting a new one.
+    """
+    backend = _backend_for(pool)
+    if backend is not None:
+        async with backend.session(pool) as db_session:
+            yield db_session
+        return
+
+    if isinstance(pool, Session):
+        yield pool
+        return
+
+    async with _acquire(pool) as conn:
+        db_session = Session(conn)
+        db_session.analytics_timeout = _analytics_pools.get(id(pool))
+        transaction = conn.transaction()
+        await transaction.start()
+        try:
+            yield db_session
+        except BaseException:
+            await transaction.rollback()
+            raise
+
+        if not db_session.failed:
+            try:
+                await db_session.flush()
+            except (asyncpg.exceptions.PostgresError, asyncio.TimeoutError):
+                pass  # Logged by flush(), which also marks the session as failed.
+
+        if db_session.failed:
+            log.warning("Rolling back database session due to an earlier error.")
+            await transaction.rollback()
+        else:
+            await transaction.commit()
+            db_session.committed = True
+
+
 # ---------- Interview Methods ---------- #
 
 # --- Inserts --- #
 
 # region Join Interview DB Functions
 
+_ADD_NEW_INTERVIEW = statement("add_new_interview", "INSERT INTO interviews(guild_id, member_id, user_name, channel_id, question_number, interview_finished, paused, interview_type, read_rules, join_ts, interview_type_msg_id) VALUES($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)")
+
+
 @db_deco
 async def add_new_interview(pool: asyncpg.pool.Pool, sid: int, member_id: int, username: str, channel_id: int,
                                   question_number: int = 0, interview_finished: bool = False, paused: bool = False,
                                   interview_type: str = 'unknown', read_rules: bool = False, join_ts: datetime = None,
                                   interview_type_msg_id = None):
 
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
         # Convert ts to str
         if join_ts is None:
             join_ts = datetime.utcnow()
 
         ts = join_ts.timestamp()
-        await conn.execute(
-            "INSERT INTO interviews(guild_id, member_id, user_name, channel_id, question_number, interview_finished, paused, interview_type, read_rules, join_ts, interview_type_msg_id) VALUES($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)",
-            sid, member_id, username, channel_id, question_number, interview_finished, paused, interview_type, read_rules, ts, interview_type_msg_id)
+        await _execute_batched(conn, _ADD_NEW_INTERVIEW, sid, member_id, username, channel_id, question_number, interview_finished, paused, interview_type, read_rules, ts, interview_type_msg_id)
 
 
 # --- Updates --- #
+_UPDATE_INTERVIEW_ALL_MUTABLE = statement("update_interview_all_mutable", "UPDATE interviews SET question_number = $1, interview_finished = $2, paused = $3, interview_type = $4, read_rules = $5 WHERE channel_id = $6 AND member_id = $7 AND interview_type_msg_id = $8", expected_index="interviews_pkey")
+
+
 @db_deco
 async def update_interview_all_mutable(pool: asyncpg.pool.Pool, cid: int, mid: int, question_number: int, interview_finished: bool, paused: bool, interview_type: str, read_rules: bool, interview_type_msg_id: Optional[int]):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        await conn.execute(
-            "UPDATE interviews SET question_number = $1, interview_finished = $2, paused = $3, interview_type = $4, read_rules = $5 WHERE channel_id = $6 AND member_id = $7 AND interview_type_msg_id = $8",
-            question_number, interview_finished, paused, interview_type, read_rules, cid, mid, interview_type_msg_id)
+        await _execute_batched(conn, _UPDATE_INTERVIEW_ALL_MUTABLE, question_number, interview_finished, paused, interview_type, read_rules, cid, mid, interview_type_msg_id)
+
+
+_UPDATE_INTERVIEW_QUESTION_NUMBER = statement("update_interview_question_number", "UPDATE interviews SET question_number = $1 WHERE channel_id = $2 AND member_id = $3", expected_index="interviews_pkey")
 
 
 @db_deco
 async def update_interview_question_number(pool: asyncpg.pool.Pool, cid: int, mid: int, question_number: int):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        await conn.execute(
-            "UPDATE interviews SET question_number = $1 WHERE channel_id = $2 AND member_id = $3",
-             question_number, cid, mid)
+        await _execute_batched(conn, _UPDATE_INTERVIEW_QUESTION_NUMBER, question_number, cid, mid)
+
+
+_UPDATE_INTERVIEW_FINISHED = statement("update_interview_finished", "UPDATE interviews SET interview_finished = $1 WHERE channel_id = $2 AND member_id = $3", expected_index="interviews_pkey")
 
 
 @db_deco
 async def update_interview_finished(pool: asyncpg.pool.Pool, cid: int, mid: int, interview_finished: bool):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        await conn.execute(
-            "UPDATE interviews SET interview_finished = $1 WHERE channel_id = $2 AND member_id = $3",
-            interview_finished, cid, mid)
+        await _execute_batched(conn, _UPDATE_INTERVIEW_FINISHED, interview_finished, cid, mid)
+
+
+_UPDATE_INTERVIEW_PAUSED = statement("update_interview_paused", "UPDATE interviews SET paused = $1 WHERE channel_id = $2 AND member_id = $3", expected_index="interviews_pkey")
 
 
 @db_deco
 async def update_interview_paused(pool: asyncpg.pool.Pool, cid: int, mid: int, paused: bool):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        await conn.execute(
-            "UPDATE interviews SET paused = $1 WHERE channel_id = $2 AND member_id = $3",
-            paused, cid, mid)
+        await _execute_batched(conn, _UPDATE_INTERVIEW_PAUSED, paused, cid, mid)
+
+
+_UPDATE_INTERVIEW_TYPE = statement("update_interview_type", "UPDATE interviews SET interview_type = $1 WHERE channel_id = $2 AND member_id = $3", expected_index="interviews_pkey")
 
 
 @db_deco
 async def update_interview_type(pool: asyncpg.pool.Pool, cid: int, mid: int, interview_type: str):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        await conn.execute(
-            "UPDATE interviews SET interview_type = $1 WHERE channel_id = $2 AND member_id = $3",
-            interview_type, cid, mid)
+        await _execute_batched(conn, _UPDATE_INTERVIEW_TYPE, interview_type, cid, mid)
+
+
+_UPDATE_INTERVIEW_READ_RULES = statement("update_interview_read_rules", "UPDATE interviews SET read_rules = $1 WHERE channel_id = $2 AND member_id = $3", expected_index="interviews_pkey")
 
 
 @db_deco
 async def update_interview_read_rules(pool: asyncpg.pool.Pool, cid: int, mid: int, read_rules: bool):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        await conn.execute(
-            "UPDATE interviews SET read_rules = $1 WHERE channel_id = $2 AND member_id = $3",
-            read_rules, cid, mid)
+        await _execute_batched(conn, _UPDATE_INTERVIEW_READ_RULES, read_rules, cid, mid)
+
+
+_UPDATE_INTERVIEW_TYPE_MSG_ID = statement("update_interview_type_msg_id", "UPDATE interviews SET interview_type_msg_id = $1 WHERE channel_id = $2 AND member_id = $3", expected_index="interviews_pkey")
 
 
 @db_deco
 async def update_interview_type_msg_id(pool: asyncpg.pool.Pool, cid: int, mid: int, interview_type_msg_id: int):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        await conn.execute(
-            "UPDATE interviews SET interview_type_msg_id = $1 WHERE channel_id = $2 AND member_id = $3",
-            interview_type_msg_id, cid, mid)
+        await _execute_batched(conn, _UPDATE_INTERVIEW_TYPE_MSG_ID, interview_type_msg_id, cid, mid)
 
 
 
@@ -199,11 +605,14 @@ class InterviewData:
 #         return rows
 
 
+_GET_ALL_INTERVIEWS = statement("get_all_interviews", "SELECT * from interviews", allow_seq_scan=True)
+
+
 @db_deco
 async def get_all_interviews(pool: asyncpg.pool.Pool) -> List[Dict]:  #  -> List[InterviewData]:
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        raw_rows = await conn.fetch("SELECT * from interviews")
+        raw_rows = await _fetch(conn, _GET_ALL_INTERVIEWS)
         # rows = [dict(zip(interview_row_map, row)) for row in raw_rows]
         rows = []
         for row in raw_rows:
@@ -212,13 +621,14 @@ async def get_all_interviews(pool: asyncpg.pool.Pool) -> List[Dict]:  #  -> List
 
 
 # --- Deletes --- #
+_DELETE_INTERVIEW = statement("delete_interview", "DELETE FROM interviews WHERE channel_id = $1 AND member_id = $2", expected_index="interviews_pkey")
+
+
 @db_deco
 async def delete_interview(pool: asyncpg.pool.Pool, cid: int, mid: int):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        await conn.execute(
-            "DELETE FROM interviews WHERE channel_id = $1 AND member_id = $2",
-            cid, mid)
+        await _execute_batched(conn, _DELETE_INTERVIEW, cid, mid)
 
 # endregion
 
@@ -238,25 +648,32 @@ class GuildDBSettings:
     guild_id: int
     raid_level: int
     welcome_back_react_msg_id: Optional[int]
+    message_retention_days: Optional[int] = None
+
+
+_UPSERT_RAID_LEVEL = statement("upsert_raid_level", """
+    INSERT INTO guild_settings(guild_id, raid_level) VALUES($1, $2)
+    ON CONFLICT(guild_id)
+    DO UPDATE SET raid_level = EXCLUDED.raid_level
+""", expected_index="guild_settings_pkey")
 
 
 @db_deco
 async def upsert_raid_level(pool: asyncpg.pool.Pool, sid: int, raid_level: int):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
 
-        await conn.execute("""
-                            INSERT INTO guild_settings(guild_id, raid_level) VALUES($1, $2)
-                            ON CONFLICT(guild_id)
-                            DO UPDATE SET raid_level = EXCLUDED.raid_level
-                            """, sid, raid_level)
+        await _execute_batched(conn, _UPSERT_RAID_LEVEL, sid, raid_level)
+
+
+_GET_RAID_LEVEL = statement("get_raid_level", " SELECT * from guild_settings WHERE guild_id = $1", expected_index="guild_settings_pkey")
 
 
 @db_deco
 async def get_raid_level(pool: asyncpg.pool.Pool, sid: int) -> int:
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        row = await conn.fetchrow(" SELECT * from guild_settings WHERE guild_id = $1", sid)
+        row = await _fetchrow(conn, _GET_RAID_LEVEL, sid)
         # interview_dict = dict(zip(interview_row_map, row))
 
         if row is not None:
@@ -266,23 +683,29 @@ async def get_raid_level(pool: asyncpg.pool.Pool, sid: int) -> int:
 
 
 
+_UPSERT_WELCOME_BACK_REACT_MSG_ID = statement("upsert_welcome_back_react_msg_id", """
+    INSERT INTO guild_settings(guild_id, welcome_back_react_msg_id) VALUES($1, $2)
+    ON CONFLICT(guild_id)
+    DO UPDATE SET welcome_back_react_msg_id = EXCLUDED.welcome_back_react_msg_id
+""", expected_index="guild_settings_pkey")
+
+
 @db_deco
 async def upsert_welcome_back_react_msg_id(pool: asyncpg.pool.Pool, guild_id: int, message_id: Optional[int]):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
 
-        await conn.execute("""
-                            INSERT INTO guild_settings(guild_id, welcome_back_react_msg_id) VALUES($1, $2)
-                            ON CONFLICT(guild_id)
-                            DO UPDATE SET welcome_back_react_msg_id = EXCLUDED.welcome_back_react_msg_id
-                            """, guild_id, message_id)
+        await _execute_batched(conn, _UPSERT_WELCOME_BACK_REACT_MSG_ID, guild_id, message_id)
+
+
+_GET_GUILD_SETTINGS = statement("get_guild_settings", " SELECT * from guild_settings WHERE guild_id = $1", expected_index="guild_settings_pkey")
 
 
 @db_deco
 async def get_guild_settings(pool: asyncpg.pool.Pool, guild_id: int) -> Optional[GuildDBSettings]:
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        row = await conn.fetchrow(" SELECT * from guild_settings WHERE guild_id = $1", guild_id)
+        row = await _fetchrow(conn, _GET_GUILD_SETTINGS, guild_id)
         return GuildDBSettings(**row) if row is not None else None
 
 
@@ -290,8 +713,7 @@ async def get_guild_settings(pool: asyncpg.pool.Pool, guild_id: int) -> Optional
 
 # region Role DB Functions
 
-@dataclass
-class AllowedRole:
+class AllowedRole(NamedTuple):
     """Data Storage for Allowed Role"""
     role_id: int
     guild_id: int
@@ -299,21 +721,38 @@ class AllowedRole:
     description: Optional[str]
     emoji: Optional[int]
 
+    columns = "role_id, guild_id, cat_id, description, emoji"
+
     # async def remove(self, pool: asyncpg.pool.Pool, role_id: int):
     #     await delete_role(pool, self.guild_id, role_id)
     async def remove(self, pool: asyncpg.pool.Pool):
         await delete_role(pool, self.guild_id, self.role_id)
 
 
-@dataclass
 class RoleCategory:
-    cat_id: int
-    guild_id: int
-    cat_name: str
-    cat_position: int
-    description: Optional[str]
-    pool: Optional[asyncpg.pool.Pool]
-    roles: Optional[List[AllowedRole]] = None
+    """Data Storage for Role Category. Mutable, so it uses __slots__ rather than a NamedTuple like the other row types."""
+    __slots__ = ('cat_id', 'guild_id', 'cat_name', 'cat_position', 'description', 'pool', 'roles')
+
+    columns = "cat_id, guild_id, cat_name, cat_position, description"
+
+    def __init__(self, cat_id: int, guild_id: int, cat_name: str, cat_position: int, description: Optional[str],
+                 pool: Optional[asyncpg.pool.Pool], roles: Optional[List[AllowedRole]] = None):
+        self.cat_id = cat_id
+        self.guild_id = guild_id
+        self.cat_name = cat_name
+        self.cat_position = cat_position
+        self.description = description
+        self.pool = pool
+        self.roles = roles
+
+    def __repr__(self):
+        return f"RoleCategory(cat_id={self.cat_id!r}, guild_id={self.guild_id!r}, cat_name={self.cat_name!r}, " \
+               f"cat_position={self.cat_position!r}, description={self.description!r}, roles={self.roles!r})"
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
 
 
     @property
@@ -442,13 +881,16 @@ class RoleCategories:
 
         self.sort()
 
+_GET_ROLE_CATS = statement("get_role_cats", f"SELECT {RoleCategory.columns} from role_categories WHERE guild_id = $1", expected_index="role_categories_guild_idx")
+
+
 @db_deco
 async def get_role_cats(pool: asyncpg.pool.Pool, gid: int) -> RoleCategories:  # List[RoleCategory]:
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        raw_rows = await conn.fetch("SELECT * from role_categories WHERE guild_id = $1", gid)
+        raw_rows = await _fetch(conn, _GET_ROLE_CATS, gid)
 
-        cats = RoleCategories(cats=[RoleCategory(**row, pool=pool) for row in raw_rows], guild_id=gid, pool=pool)
+        cats = RoleCategories(cats=[RoleCategory(*row, pool) for row in raw_rows], guild_id=gid, pool=pool)
         cats.sort()
         return cats
 
@@ -464,196 +906,1002 @@ async def get_role_cats(pool: asyncpg.pool.Pool, gid: int) -> RoleCategories:  #
 #         return cats
 
 
+_GET_ROLES_IN_CAT = statement("get_roles_in_cat", f"SELECT {AllowedRole.columns} from allowed_roles where cat_id = $1", expected_index="allowed_roles_cat_idx")
+
+
 @db_deco
 async def get_roles_in_cat(pool: asyncpg.pool.Pool, cat_id: int) -> List[AllowedRole]:
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        raw_rows = await conn.fetch("SELECT * from allowed_roles where cat_id = $1", cat_id)
+        raw_rows = await _fetch(conn, _GET_ROLES_IN_CAT, cat_id)
+
+        return [AllowedRole(*row) for row in raw_rows]
 
-        return [AllowedRole(**row) for row in raw_rows]
+
+_GET_ROLES_IN_GUILD = statement("get_roles_in_guild", f"SELECT {AllowedRole.columns} from allowed_roles where guild_id = $1", expected_index="allowed_roles_guild_idx")
 
 
 @db_deco
 async def get_roles_in_guild(pool: asyncpg.pool.Pool, gid: int) -> List[AllowedRole]:
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        raw_rows = await conn.fetch("SELECT * from allowed_roles where guild_id = $1", gid)
+        raw_rows = await _fetch(conn, _GET_ROLES_IN_GUILD, gid)
+
+        return [AllowedRole(*row) for row in raw_rows]
 
-        return [AllowedRole(**row) for row in raw_rows]
+
+_UPSERT_ROLE = statement("upsert_role", """
+    INSERT INTO allowed_roles(role_id, guild_id, cat_id, description) VALUES($1, $2, $3, $4)
+    ON CONFLICT(role_id)
+    DO UPDATE SET cat_id = EXCLUDED.cat_id, description = EXCLUDED.description
+""", expected_index="allowed_roles_pkey")
 
 
 @db_deco
 async def upsert_role(pool: asyncpg.pool.Pool, gid: int, role_id: int, cat_id: int, desc: Optional[str]):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
 
-        await conn.execute("""
-                            INSERT INTO allowed_roles(role_id, guild_id, cat_id, description) VALUES($1, $2, $3, $4)
-                            ON CONFLICT(role_id)
-                            DO UPDATE SET cat_id = EXCLUDED.cat_id, description = EXCLUDED.description
-                            """, role_id, gid, cat_id, desc)
+        await _execute_batched(conn, _UPSERT_ROLE, role_id, gid, cat_id, desc)
+
+
+_MOVE_ROLE = statement("move_role", "UPDATE allowed_roles SET cat_id = $1 WHERE role_id = $2 AND guild_id = $3", expected_index="allowed_roles_pkey")
 
 
 @db_deco
 async def move_role(pool: asyncpg.pool.Pool, gid: int, role_id: int, new_cat_id: int):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        await conn.execute(
-            "UPDATE allowed_roles SET cat_id = $1 WHERE role_id = $2 AND guild_id = $3",
-             new_cat_id, role_id, gid)
+        await _execute_batched(conn, _MOVE_ROLE, new_cat_id, role_id, gid)
+
+
+_DELETE_ROLE = statement("delete_role", "DELETE FROM allowed_roles WHERE role_id = $1 AND guild_id = $2", expected_index="allowed_roles_pkey")
 
 
 @db_deco
 async def delete_role(pool: asyncpg.pool.Pool, gid: int, role_id: int):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        await conn.execute(
-            "DELETE FROM allowed_roles WHERE role_id = $1 AND guild_id = $2",
-            role_id, gid)
+        await _execute_batched(conn, _DELETE_ROLE, role_id, gid)
+
+
+_ADD_ROLE_CAT = statement("add_role_cat", """
+    INSERT INTO role_categories(guild_id, cat_name, description, cat_position) VALUES($1, $2, $3, $4)
+""")
 
 
 @db_deco
 async def add_role_cat(pool: asyncpg.pool.Pool, gid: int, name: str, description: str, position: int):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
 
-        await conn.execute("""
-                            INSERT INTO role_categories(guild_id, cat_name, description, cat_position) VALUES($1, $2, $3, $4)
-                            """, gid, name, description, position)
+        await _execute_batched(conn, _ADD_ROLE_CAT, gid, name, description, position)
+
+
+_RENAME_ROLE_CAT = statement("rename_role_cat", """
+    UPDATE role_categories SET cat_name = $1 WHERE cat_id = $2
+""", expected_index="role_categories_pkey")
 
 
 @db_deco
 async def rename_role_cat(pool: asyncpg.pool.Pool, cat_id: int, cat_name: str):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
 
-        await conn.execute("""
-                           UPDATE role_categories SET cat_name = $1 WHERE cat_id = $2
-                            """, cat_name, cat_id)
+        await _execute_batched(conn, _RENAME_ROLE_CAT, cat_name, cat_id)
+
+
+_CHANGE_DESCRIPTION_ROLE_CAT = statement("change_description_role_cat", """
+    UPDATE role_categories SET description = $1 WHERE cat_id = $2
+""", expected_index="role_categories_pkey")
 
 
 @db_deco
 async def change_description_role_cat(pool: asyncpg.pool.Pool, cat_id: int, description: str):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
 
-        await conn.execute("""
-                           UPDATE role_categories SET description = $1 WHERE cat_id = $2
-                            """, description, cat_id)
+        await _execute_batched(conn, _CHANGE_DESCRIPTION_ROLE_CAT, description, cat_id)
+
+
+_MOVE_ROLE_CAT = statement("move_role_cat", """
+    UPDATE role_categories SET cat_position = $1 WHERE cat_id = $2
+""", expected_index="role_categories_pkey")
 
 
 @db_deco
 async def move_role_cat(pool: asyncpg.pool.Pool, cat_id: int, cat_pos: int):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
 
-        await conn.execute("""
-                           UPDATE role_categories SET cat_position = $1 WHERE cat_id = $2
-                            """, cat_pos, cat_id)
+        await _execute_batched(conn, _MOVE_ROLE_CAT, cat_pos, cat_id)
+
+
+_DELETE_ROLE_CAT = statement("delete_role_cat", "DELETE FROM role_categories WHERE cat_id = $1", expected_index="role_categories_pkey")
 
 
 @db_deco
 async def delete_role_cat(pool: asyncpg.pool.Pool, gid: int, cat_id: int):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
-        await conn.execute(
-            "DELETE FROM role_categories WHERE cat_id = $1",
-             cat_id)
+        await _execute_batched(conn, _DELETE_ROLE_CAT, cat_id)
 
 # endregion
 
 # region Cached Messages DB Functions
 # ----- Cached Messages DB Functions ----- #
 
-@dataclass
-class CachedMessage:
+class CachedMessage(NamedTuple):
     message_id: int
     guild_id: int
     user_id: int
-    ts: datetime
+    ts: int
     content: str
     system_pkid: Optional[str]
     member_pkid: Optional[str]
     pk_system_account_id: Optional[int]
 
+    columns = "message_id, guild_id, user_id, ts, content, system_pkid, member_pkid, pk_system_account_id"
+
+
+_SQL_TS_TO_DAY = "(to_timestamp(ts) AT TIME ZONE 'UTC')::date"  # UTC day of a messages.ts, as used by member_daily_activity.
+
 
 @db_deco
-async def cache_message(pool, sid: int, message_id: int, author_id: int, content: str, timestamp: datetime):
-    if timestamp is None:
-        log.info("FDSF")
-    msg_ts = timestamp.timestamp()
-    async with pool.acquire() as conn:
-        await conn.execute("INSERT INTO messages(guild_id, message_id, user_id, content, ts) VALUES($1, $2, $3, $4, $5)", sid, message_id, author_id, content, msg_ts)
+async def cache_message(pool, sid: int, message_id: int, author_id: int, content: str):
+    async with _acquire(pool) as conn:
+        await _insert_messages_and_activity(conn, [(message_id, sid, author_id, ts_from_snowflake(message_id), content, None, None)])
 
 
 @db_deco
-async def cache_pk_message(pool, sid: int, message_id: int, author_id: int, content: str, timestamp: datetime, system_pkid:str, member_pkid:str):
-    """Only use for history population. Timestamp must be in UTC"""
-    msg_ts = timestamp.timestamp()
-    async with pool.acquire() as conn:
-        await conn.execute("INSERT INTO messages(guild_id, message_id, user_id, content, ts, system_pkid, member_pkid) VALUES($1, $2, $3, $4, $5, $6, $7)", sid, message_id, author_id, content, msg_ts, system_pkid, member_pkid)
+async def cache_pk_message(pool, sid: int, message_id: int, author_id: int, content: str, system_pkid:str, member_pkid:str):
+    """Only use for history population."""
+    async with _acquire(pool) as conn:
+        await _insert_messages_and_activity(conn, [(message_id, sid, author_id, ts_from_snowflake(message_id), content, system_pkid, member_pkid)])
+
+
+_GET_CACHED_MESSAGE = statement("get_cached_message", f"SELECT {CachedMessage.columns} FROM messages WHERE message_id = $1 AND ts BETWEEN $2 AND $3", expected_index="messages_message_id_ts_key")
 
 
 @db_deco
 async def get_cached_message(pool, sid: int, message_id: int) -> Optional[CachedMessage]:
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM messages WHERE message_id = $1", message_id)
-        return CachedMessage(**row) if row is not None else None
+    async with _acquire(pool) as conn:
+        row = await _fetchrow(conn, _GET_CACHED_MESSAGE, message_id, *_snowflake_ts_range([message_id]))
+        return CachedMessage(*row) if row is not None else None
+
+
+_GET_CACHED_MESSAGES_AFTER_TIMESTAMP = statement("get_cached_messages_after_timestamp", f" SELECT {CachedMessage.columns} from messages where ts > $1 and guild_id = $2 AND user_id = $3", expected_index="messages_guild_user_ts_idx")
 
 
 @db_deco
 async def get_cached_messages_after_timestamp(pool, timestamp: datetime, sid: int, user_id: int) -> List[CachedMessage]:
     """ Timestamp must be in UTC"""
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         # now = datetime.now()
         # offset = timedelta(hours=hours)
         # before = now - offset
-        before = timestamp.timestamp()
-        raw_rows = await conn.fetch(" SELECT * from messages where ts > $1 and guild_id = $2 AND user_id = $3", before, sid, user_id)
-        messages = [CachedMessage(**row) for row in raw_rows]
+        before = _utc_ts(timestamp)
+        raw_rows = await _fetch(conn, _GET_CACHED_MESSAGES_AFTER_TIMESTAMP, before, sid, user_id)
+        messages = [CachedMessage(*row) for row in raw_rows]
         return messages
 
 
+_GET_ALL_CACHED_MESSAGES_AFTER_TIMESTAMP = statement("get_all_cached_messages_after_timestamp", f" SELECT {CachedMessage.columns} from messages where ts > $1 and guild_id = $2", expected_index="messages_guild_ts_idx")
+
+
 @db_deco
 async def get_all_cached_messages_after_timestamp(pool, timestamp: datetime, sid: int) -> List[CachedMessage]:
     """ Timestamp must be in UTC"""
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         # now = datetime.now()
         # offset = timedelta(hours=hours)
         # before = now - offset
-        before = timestamp.timestamp()
-        raw_rows = await conn.fetch(" SELECT * from messages where ts > $1 and guild_id = $2", before, sid)
-        messages = [CachedMessage(**row) for row in raw_rows]
+        before = _utc_ts(timestamp)
+        raw_rows = await _fetch(conn, _GET_ALL_CACHED_MESSAGES_AFTER_TIMESTAMP, before, sid)
+        messages = [CachedMessage(*row) for row in raw_rows]
         return messages
 
 
+_ITER_GUILD_CACHED_MESSAGES = statement("iter_guild_cached_messages", f"SELECT {CachedMessage.columns} FROM messages WHERE ts > $1 AND guild_id = $2 ORDER BY ts", expected_index="messages_guild_ts_idx")
+_ITER_USER_CACHED_MESSAGES = statement("iter_user_cached_messages", f"SELECT {CachedMessage.columns} FROM messages WHERE ts > $1 AND guild_id = $2 AND user_id = $3 ORDER BY ts", expected_index="messages_guild_user_ts_idx")
+
+
+async def iter_cached_messages_after_timestamp(pool, timestamp: datetime, sid: int, user_id: Optional[int] = None,
+                                              batch_size: int = 1000) -> AsyncIterator[List[CachedMessage]]:
+    """
+    Streaming version of get_all_cached_messages_after_timestamp / get_cached_messages_after_timestamp.
+    Yields the messages in ts order, `batch_size` at a time, from a server side cursor so only one batch is ever held in memory.
+    Holds a connection and an open transaction until the iteration finishes, so don't do slow work between batches.
+    Timestamp must be in UTC
+    """
+    backend = _backend_for(pool)
+    if backend is not None:
+        async for batch in backend.iter_cached_messages_after_timestamp(pool, timestamp, sid, user_id, batch_size):
+            yield batch
+        return
+
+    before = _utc_ts(timestamp)
+    start_time = time.perf_counter()
+    row_count = 0
+    async with _acquire(pool) as conn:
+        conn: asyncpg.connection.Connection
+        async with conn.transaction():  # Server side cursors only live as long as the transaction they were opened in.
+            if user_id is None:
+                cursor = await _cursor(conn, _ITER_GUILD_CACHED_MESSAGES, before, sid)
+            else:
+                cursor = await _cursor(conn, _ITER_USER_CACHED_MESSAGES, before, sid, user_id)
+
+            while True:
+                try:
+                    rows = await cursor.fetch(batch_size)
+                except (asyncpg.exceptions.QueryCanceledError, asyncio.TimeoutError) as e:
+                    if _is_analytics(pool):
+                        raise QueryTimeoutError("iter_cached_messages_after_timestamp", _analytics_timeout(pool)) from e
+                    raise
+                if len(rows) == 0:
+                    break
+                row_count += len(rows)
+                yield [CachedMessage(*row) for row in rows]
+
+    query_stats.record("iter_cached_messages_after_timestamp", (time.perf_counter() - start_time) * 1000)
+    log.debug(f"Streamed {row_count} cached messages in {(time.perf_counter() - start_time) * 1000:.3f} ms.")
+
+
+_LOCK_CACHED_MESSAGE_OWNER = statement("lock_cached_message_owner", "SELECT guild_id, user_id, ts FROM messages WHERE message_id = $1 AND ts BETWEEN $2 AND $3 FOR UPDATE", expected_index="messages_message_id_ts_key")
+_UPDATE_CACHED_MESSAGE_PK_DETAILS = statement("update_cached_message_pk_details", "UPDATE messages SET system_pkid = $1, member_pkid = $2, user_id = $3 WHERE message_id = $4 AND ts BETWEEN $5 AND $6", expected_index="messages_message_id_ts_key")
+
+
 @db_deco
 async def update_cached_message_pk_details(pool, sid: int, message_id: int, system_pkid: str, member_pkid: str,
                                            pk_system_account_id: int):
-    async with pool.acquire() as conn:
-        await conn.execute("UPDATE messages SET system_pkid = $1, member_pkid = $2, user_id = $3 WHERE message_id = $4",
-                           system_pkid, member_pkid, pk_system_account_id, message_id)
+    ts_range = _snowflake_ts_range([message_id])
+    async with _acquire(pool) as conn:
+        conn: asyncpg.connection.Connection
+        async with conn.transaction():
+            old_rows = await _fetch(conn, _LOCK_CACHED_MESSAGE_OWNER, message_id, *ts_range)
+            await _execute(conn, _UPDATE_CACHED_MESSAGE_PK_DETAILS, system_pkid, member_pkid, pk_system_account_id, message_id, *ts_range)
+
+            # The message now belongs to the account that owns the PK system. Move its post over in the rollup.
+            for row in old_rows:
+                if row['user_id'] != pk_system_account_id:
+                    day = _ts_to_day(row['ts'])
+                    await _add_daily_activity(conn, [(row['guild_id'], row['user_id'], day, -1),
+                                                     (row['guild_id'], pk_system_account_id, day, 1)])
+
+
+_DELETE_CACHED_MESSAGE = statement("delete_cached_message", f"""
+    WITH deleted AS (
+        DELETE FROM messages WHERE message_id = $1 AND ts BETWEEN $2 AND $3 RETURNING guild_id, user_id, ts
+    )
+    UPDATE member_daily_activity a SET post_count = a.post_count - d.posts
+    FROM (SELECT guild_id, user_id, {_SQL_TS_TO_DAY} AS day, COUNT(*) AS posts FROM deleted GROUP BY 1, 2, 3) d
+    WHERE a.guild_id = d.guild_id AND a.user_id = d.user_id AND a.day = d.day
+""", expected_index="messages_message_id_ts_key")
 
 
 @db_deco
 async def delete_cached_message(pool, sid: int, message_id: int):
-    async with pool.acquire() as conn:
-        await conn.execute("DELETE FROM messages WHERE message_id = $1", message_id)
+    async with _acquire(pool) as conn:
+        await _execute_batched(conn, _DELETE_CACHED_MESSAGE, message_id, *_snowflake_ts_range([message_id]))
+
+
+_DELETE_CACHED_MESSAGES = statement("delete_cached_messages", f"""
+    WITH deleted AS (
+        DELETE FROM messages WHERE message_id = ANY($1::BIGINT[]) AND ts BETWEEN $2 AND $3 RETURNING guild_id, user_id, ts
+    )
+    UPDATE member_daily_activity a SET post_count = a.post_count - d.posts
+    FROM (SELECT guild_id, user_id, {_SQL_TS_TO_DAY} AS day, COUNT(*) AS posts FROM deleted GROUP BY 1, 2, 3) d
+    WHERE a.guild_id = d.guild_id AND a.user_id = d.user_id AND a.day = d.day
+""", expected_index="messages_message_id_ts_key")
+
+
+@db_deco
+async def delete_cached_messages(pool, sid: int, message_ids: List[int]):
+    """Deletes a batch of cached messages with one statement. IDs that aren't cached are ignored."""
+    if len(message_ids) == 0:
+        return
+    async with _acquire(pool) as conn:
+        await _execute(conn, _DELETE_CACHED_MESSAGES, message_ids, *_snowflake_ts_range(message_ids))
+
+
+_GET_CACHED_MESSAGE_IDS = statement("get_cached_message_ids", "SELECT message_id FROM messages WHERE message_id = ANY($1::BIGINT[]) AND ts BETWEEN $2 AND $3", expected_index="messages_message_id_ts_key")
+
+
+@db_deco
+async def cache_messages_bulk(pool, records: List[tuple]) -> int:
+    """
+    Writes a batch of message rows with a single COPY, leaving out messages that are already cached.
+    Each record must be in MessageCacheBuffer.columns order, with ts from ts_from_snowflake.
+    Only pass records as a keyword so db_deco does not format the whole batch into the log.
+    """
+    async with _acquire(pool) as conn:
+        conn: asyncpg.connection.Connection
+        try:
+            async with conn.transaction():
+                # Re-running build_msg_cache or replaying the spool hands us messages we already have, possibly stored with a different ts.
+                timestamps = [record[3] for record in records]
+                cached = await _fetch(conn, _GET_CACHED_MESSAGE_IDS, [record[0] for record in records],
+                                      min(timestamps) - _SNOWFLAKE_TS_SKEW, max(timestamps) + _SNOWFLAKE_TS_SKEW)
+                if len(cached) > 0:
+                    cached_ids = {row['message_id'] for row in cached}
+                    records = [record for record in records if record[0] not in cached_ids]
+                    if len(records) == 0:
+                        return 0
+
+                await conn.copy_records_to_table('messages', records=records, columns=MessageCacheBuffer.columns)
+
+                activity: Dict[Tuple[int, int, date], int] = {}
+                for record in records:
+                    key = (record[1], record[2], _ts_to_day(record[3]))
+                    activity[key] = activity.get(key, 0) + 1
+                await _add_daily_activity(conn, [(*key, posts) for key, posts in activity.items()])
+        except asyncpg.exceptions.UniqueViolationError:
+            # COPY is all or nothing. Fall back to an insert that skips any messages that are already cached.
+            return await _insert_messages_and_activity(conn, records)
+    return len(records)
+
+
+# --- Daily Activity Rollup --- #
+# member_daily_activity holds the number of cached messages per guild, user and UTC day.
+# Every path that adds, removes or re-attributes a cached message updates it in the same transaction.
+
+def _ts_to_day(ts: int) -> date:
+    return datetime.utcfromtimestamp(ts).date()
+
+
+def _utc_ts(timestamp: datetime) -> int:
+    """Naive datetimes are taken to be UTC, which is what the rest of the bot passes around."""
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp())
+
+
+DISCORD_EPOCH_MS = 1420070400000  # 2015-01-01 UTC, where the timestamp in a Discord snowflake counts from.
+_DISCORD_EPOCH = datetime.fromtimestamp(DISCORD_EPOCH_MS / 1000, tz=timezone.utc)
+
+
+def snowflake_from_datetime(timestamp: datetime, high: bool = False) -> int:
+    """
+    The lowest (or with high=True, the highest) snowflake Discord could have generated in the millisecond of timestamp.
+    `message_id > snowflake_from_datetime(t, high=True)` matches messages created after t. Naive datetimes are taken to be UTC.
+    """
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    discord_ms = max((timestamp - _DISCORD_EPOCH) // timedelta(milliseconds=1), 0)
+    return (discord_ms << 22) + ((1 << 22) - 1 if high else 0)
+
+
+def datetime_from_snowflake(snowflake: int) -> datetime:
+    """When a snowflake was generated, as an aware UTC datetime."""
+    return _DISCORD_EPOCH + timedelta(milliseconds=snowflake >> 22)
+
+
+def ts_from_snowflake(snowflake: int) -> int:
+    """
+    The ts a cached message is stored with: when Discord created it, as a UTC epoch timestamp.
+    Taking it from the message ID means every path that caches a message writes the same (message_id, ts) pair.
+    """
+    return ((snowflake >> 22) + DISCORD_EPOCH_MS) // 1000
+
+
+# Rows cached before ts came from the message ID hold the time the bot received the message, which can be a little later.
+_SNOWFLAKE_TS_SKEW = 300
+
+
+def _snowflake_ts_range(message_ids: List[int]) -> Tuple[int, int]:
+    """The ts range the cached rows of these messages can have. Bounding lookups by it lets Postgres skip the other partitions."""
+    return ts_from_snowflake(min(message_ids)) - _SNOWFLAKE_TS_SKEW, ts_from_snowflake(max(message_ids)) + _SNOWFLAKE_TS_SKEW
+
+
+_ADD_DAILY_ACTIVITY = statement("add_daily_activity", """
+    INSERT INTO member_daily_activity(guild_id, user_id, day, post_count) VALUES($1, $2, $3, $4)
+    ON CONFLICT(guild_id, user_id, day)
+    DO UPDATE SET post_count = member_daily_activity.post_count + EXCLUDED.post_count
+""", expected_index="member_daily_activity_pkey")
+
+
+async def _add_daily_activity(conn: asyncpg.connection.Connection, changes: List[Tuple[int, int, date, int]]):
+    """
+    Applies (guild_id, user_id, day, post_count delta) changes to the rollup.
+    Rows are always locked in key order, so concurrent flushes that touch the same members wait on each other instead of deadlocking.
+    """
+    await _executemany(conn, _ADD_DAILY_ACTIVITY, sorted(changes))
+
+
+_INSERT_MESSAGES_AND_ACTIVITY = statement("insert_messages_and_activity", f"""
+    WITH inserted AS (
+        INSERT INTO messages(message_id, guild_id, user_id, ts, content, system_pkid, member_pkid)
+        SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::bigint[], $5::text[], $6::text[], $7::text[])
+            AS r(message_id, guild_id, user_id, ts, content, system_pkid, member_pkid)
+        WHERE NOT EXISTS (SELECT 1 FROM messages m WHERE m.message_id = r.message_id
+                          AND m.ts BETWEEN r.ts - {_SNOWFLAKE_TS_SKEW} AND r.ts + {_SNOWFLAKE_TS_SKEW})
+        ON CONFLICT(message_id, ts)
+        DO NOTHING
+        RETURNING guild_id, user_id, ts
+    )
+    INSERT INTO member_daily_activity(guild_id, user_id, day, post_count)
+    SELECT guild_id, user_id, {_SQL_TS_TO_DAY}, COUNT(*) FROM inserted GROUP BY 1, 2, 3 ORDER BY 1, 2, 3
+    ON CONFLICT(guild_id, user_id, day)
+    DO UPDATE SET post_count = member_daily_activity.post_count + EXCLUDED.post_count
+""", expected_index="messages_message_id_ts_key")
+
+
+async def _insert_messages_and_activity(conn: asyncpg.connection.Connection, records: List[tuple]) -> int:
+    """
+    Inserts message records (in MessageCacheBuffer.columns order), skipping ones that are already cached, and counts only the new ones in the rollup.
+    A message counts as cached if there is a row with its ID within _SNOWFLAKE_TS_SKEW of its ts, which also catches rows stored with the receive time.
+    """
+    columns = list(zip(*records))
+    await _execute(conn, _INSERT_MESSAGES_AND_ACTIVITY, *columns)
+    return len(records)
+
+
+async def _fill_member_daily_activity(conn: asyncpg.connection.Connection):
+    """Counts every cached message into the rollup in one transaction. Only for filling it when it is created."""
+    async with conn.transaction():
+        # Blocks concurrent flushes until the fill commits. Their messages aren't visible to it, so they must add their own counts afterwards.
+        await conn.execute("LOCK TABLE member_daily_activity IN EXCLUSIVE MODE")
+        await conn.execute(f"""
+                           INSERT INTO member_daily_activity(guild_id, user_id, day, post_count)
+                           SELECT guild_id, user_id, {_SQL_TS_TO_DAY}, COUNT(*) FROM messages
+                           GROUP BY 1, 2, 3
+                           """)
+
+
+# A loose index scan: one index probe per guild instead of reading every message.
+_GET_MESSAGE_GUILD_IDS = statement("get_message_guild_ids", """
+    WITH RECURSIVE guilds AS (
+        (SELECT guild_id FROM messages ORDER BY guild_id LIMIT 1)
+        UNION ALL
+        SELECT (SELECT m.guild_id FROM messages m WHERE m.guild_id > g.guild_id ORDER BY m.guild_id LIMIT 1)
+        FROM guilds g WHERE g.guild_id IS NOT NULL
+    )
+    SELECT guild_id FROM guilds WHERE guild_id IS NOT NULL
+""", expected_index="messages_guild_ts_idx")
+_GET_GUILD_MESSAGE_TS_RANGE = statement("get_guild_message_ts_range", "SELECT min(ts), max(ts) FROM messages WHERE guild_id = $1", expected_index="messages_guild_ts_idx")
+_GET_GUILD_FIRST_ACTIVITY_DAY = statement("get_guild_first_activity_day", "SELECT min(day) FROM member_daily_activity WHERE guild_id = $1", expected_index="member_daily_activity_guild_day_idx")
+_DELETE_GUILD_DAILY_ACTIVITY = statement("delete_guild_daily_activity", "DELETE FROM member_daily_activity WHERE guild_id = $1 AND day = $2", expected_index="member_daily_activity_guild_day_idx")
+_RECOUNT_GUILD_DAILY_ACTIVITY = statement("recount_guild_daily_activity", """
+    INSERT INTO member_daily_activity(guild_id, user_id, day, post_count)
+    SELECT guild_id, user_id, $2::date, COUNT(*) FROM messages WHERE guild_id = $1 AND ts >= $3 AND ts < $4 GROUP BY guild_id, user_id
+""", expected_index="messages_guild_ts_idx")
+_REBUILD_MEMBER_DAILY_ACTIVITY = statement("rebuild_member_daily_activity", "SELECT COUNT(*) FROM member_daily_activity WHERE $1::bigint IS NULL OR guild_id = $1", expected_index="member_daily_activity_guild_day_idx")
+
+
+async def _recount_guild_day(conn: asyncpg.connection.Connection, guild_id: int, day: date):
+    start_ts = _utc_ts(datetime.combine(day, datetime.min.time()))
+    async with conn.transaction():
+        # Blocks concurrent flushes while this one day is recounted. Their messages aren't visible to the recount, so they must add their own counts afterwards.
+        await conn.execute("LOCK TABLE member_daily_activity IN EXCLUSIVE MODE")
+        await _execute(conn, _DELETE_GUILD_DAILY_ACTIVITY, guild_id, day)
+        await _execute(conn, _RECOUNT_GUILD_DAILY_ACTIVITY, guild_id, day, start_ts, start_ts + 86400)
+
+
+@db_deco
+async def rebuild_member_daily_activity(pool, guild_id: Optional[int] = None) -> int:
+    """
+    Recomputes the rollup from the messages table for one guild, or for every guild if guild_id is None. Returns the number of rollup rows.
+
+    Only the days a guild still has cached messages for are recomputed, one day per transaction, so flushes are never held up
+    for longer than one day's recount. Rollup rows from before that are kept, as retention has already expired their messages.
+    For the same reason the first day is kept too if there are older rollup rows, since retention may have cut it partway through.
+    """
+    async with _acquire(pool) as conn:
+        conn: asyncpg.connection.Connection
+        if guild_id is None:
+            guild_ids = [row['guild_id'] for row in await _fetch(conn, _GET_MESSAGE_GUILD_IDS)]
+        else:
+            guild_ids = [guild_id]
+
+        for rebuild_guild_id in guild_ids:
+            first_ts, last_ts = await _fetchrow(conn, _GET_GUILD_MESSAGE_TS_RANGE, rebuild_guild_id)
+            if first_ts is None:
+                continue
+            day, last_day = _ts_to_day(first_ts), _ts_to_day(last_ts)
+            first_rollup_day = await _fetchval(conn, _GET_GUILD_FIRST_ACTIVITY_DAY, rebuild_guild_id)
+            if first_rollup_day is not None and first_rollup_day < day:
+                day += timedelta(days=1)
+
+            while day <= last_day:
+                await _recount_guild_day(conn, rebuild_guild_id, day)
+                day += timedelta(days=1)
+
+        return await _fetchval(conn, _REBUILD_MEMBER_DAILY_ACTIVITY, guild_id)
+
+
+def _post_count_window(timestamp: datetime) -> Tuple[int, date, int]:
+    """
+    Splits "since timestamp" into the partial first day, which has to be counted from messages,
+    and the whole days after it, which come from the rollup.
+    Returns (since_ts, first_full_day, first_full_day_ts).
+    """
+    since_ts = _utc_ts(timestamp)
+    first_full_day = _ts_to_day(since_ts) + timedelta(days=1)
+    first_full_day_ts = _utc_ts(datetime.combine(first_full_day, datetime.min.time()))
+    return since_ts, first_full_day, first_full_day_ts
+
+
+_COUNT_POSTS_SINCE = statement("count_posts_since", """
+    SELECT
+    (SELECT COALESCE(SUM(post_count), 0) FROM member_daily_activity WHERE guild_id = $1 AND user_id = $2 AND day >= $3)
+    + (SELECT COUNT(*) FROM messages WHERE guild_id = $1 AND user_id = $2 AND ts > $4 AND ts < $5)
+""", expected_index="messages_guild_user_ts_idx")
+
+
+@db_deco
+async def count_posts_since(pool, guild_id: int, user_id: int, timestamp: datetime) -> int:
+    """ Number of cached messages a user has posted since timestamp. Timestamp must be in UTC"""
+    since_ts, first_full_day, first_full_day_ts = _post_count_window(timestamp)
+    async with _acquire(pool) as conn:
+        conn: asyncpg.connection.Connection
+        return await _fetchval(conn, _COUNT_POSTS_SINCE, guild_id, user_id, first_full_day, since_ts, first_full_day_ts)
+
+
+_POST_COUNTS_FOR_USERS_SINCE = statement("post_counts_for_users_since", """
+    SELECT user_id, SUM(posts)::bigint AS posts FROM (
+        SELECT user_id, post_count AS posts FROM member_daily_activity WHERE guild_id = $1 AND user_id = ANY($5::bigint[]) AND day >= $2
+        UNION ALL
+        SELECT user_id, COUNT(*) AS posts FROM messages WHERE guild_id = $1 AND user_id = ANY($5::bigint[]) AND ts > $3 AND ts < $4 GROUP BY user_id
+    ) p
+    GROUP BY user_id
+""", expected_index="messages_guild_user_ts_idx")
+
+
+@db_deco
+async def post_counts_for_users_since(pool, guild_id: int, user_ids: List[int], timestamp: datetime) -> Dict[int, int]:
+    """
+    Number of cached messages each of `user_ids` has posted in a guild since timestamp, in a single grouped query. Timestamp must be in UTC
+    Every requested user is included, with 0 for users that have not posted.
+    """
+    since_ts, first_full_day, first_full_day_ts = _post_count_window(timestamp)
+    async with _acquire(pool) as conn:
+        conn: asyncpg.connection.Connection
+        rows = await _fetch(conn, _POST_COUNTS_FOR_USERS_SINCE, guild_id, first_full_day, since_ts, first_full_day_ts, user_ids)
+        post_counts = {user_id: 0 for user_id in user_ids}
+        post_counts.update({row['user_id']: row['posts'] for row in rows})
+        return post_counts
+
+
+_GET_NUMBER_OF_ROWS_IN_MESSAGES = statement("get_number_of_rows_in_messages", "SELECT COUNT(*) FROM messages", allow_seq_scan=True)
 
 
 @db_deco
 async def get_number_of_rows_in_messages(pool, table: str = "messages") -> int:  # Slow! But only used for g!top so okay.
-    async with pool.acquire() as conn:
-        num_of_rows = await conn.fetchval("SELECT COUNT(*) FROM messages")
+    async with _acquire(pool) as conn:
+        num_of_rows = await _fetchval(conn, _GET_NUMBER_OF_ROWS_IN_MESSAGES)
         return num_of_rows
 
+
+class MessageCacheBuffer:
+    """
+    Write-behind buffer that sits in front of the message cache.
+
+    New messages are held in memory and written to the messages table with one COPY once `max_size` rows are pending,
+    or every `flush_interval` seconds, whichever comes first.
+    Deletes and PK updates for rows that are still pending are applied in memory instead of hitting the DB.
+    If a WriteSpool is given, everything that does have to go to the DB goes through it.
+    If a RecentMessageIndex is given, deletes and lookups of messages it knows were never cached don't go to the DB at all.
+    Bulk deletes go to the DB `delete_batch_size` message IDs per statement.
+    """
+
+    columns = ('message_id', 'guild_id', 'user_id', 'ts', 'content', 'system_pkid', 'member_pkid')
+
+    def __init__(self, pool: asyncpg.pool.Pool, max_size: int = 500, flush_interval: float = 5.0,
+                 spool: Optional['WriteSpool'] = None, index: Optional[RecentMessageIndex] = None, delete_batch_size: int = 1000):
+        self.pool = pool
+        self.spool = spool
+        self.index = index
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.delete_batch_size = delete_batch_size
+
+        self._pending: Dict[int, list] = {}  # message_id -> row. Dicts keep insertion order, so COPY order matches arrival order.
+        self._in_flight: Dict[int, list] = {}  # Rows taken by the flush that is currently running.
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+
+        self.rows_flushed = 0
+        self.rows_cancelled = 0
+
+    @property
+    def depth(self) -> int:
+        """The number of rows waiting to be written to the DB."""
+        return len(self._pending) + len(self._in_flight)
+
+    def start(self):
+        """Starts the timed flush loop."""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_loop())
+
+    async def close(self):
+        """Stops the timed flush loop and writes out everything that is still pending. Call before shutting down."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("Error flushing the message cache buffer.")
+
+    async def flush(self):
+        async with self._flush_lock:
+            if len(self._pending) == 0:
+                return
+
+            self._in_flight, self._pending = self._pending, {}
+            try:
+                records = [tuple(row) for row in self._in_flight.values()]
+                if self.spool is not None:
+                    written = await self.spool.cache_messages_bulk(records)
+                else:
+                    written = await cache_messages_bulk(self.pool, records=records)
+                    if written is None:
+                        written = await self._write_rows_one_by_one(records)
+                self.rows_flushed += written
+            except BaseException:
+                # Put the rows back so the next flush tries them again. Anything cached or updated since takes precedence.
+                self._pending = {**self._in_flight, **self._pending}
+                raise
+            finally:
+                self._in_flight = {}
+
+    async def _write_rows_one_by_one(self, records: List[tuple]) -> int:
+        """For a batch the DB rejected. Writes its rows one at a time, so only the rows the DB rejects themselves are lost."""
+        written = 0
+        dropped = 0
+        for record in records:
+            result = await cache_messages_bulk(self.pool, records=[record])
+            if result is None:
+                dropped += 1
+            else:
+                written += result
+        if dropped > 0:
+            log.error(f"Dropped {dropped} of {len(records)} message cache rows that the DB rejected.")
+        return written
+
+    async def _add(self, row: list):
+        self._pending[row[0]] = row
+        if len(self._pending) >= self.max_size:
+            await self.flush()
+
+    async def _wait_for_in_flight(self, message_id: int):
+        """If the message is part of the flush that is currently running, wait for that flush to land in the DB."""
+        if message_id in self._in_flight:
+            async with self._flush_lock:
+                pass
+
+    # --- Message Cache Interface --- #
+
+    async def cache_message(self, sid: int, message_id: int, author_id: int, content: str,
+                            webhook_id: Optional[int] = None, author_is_bot: bool = False, channel_id: Optional[int] = None):
+        """Buffered version of pDB.cache_message."""
+        if self.index is not None:
+            self.index.add(message_id, IndexedMessage(sid, author_id, webhook_id, author_is_bot, channel_id))
+        await self._add([message_id, sid, author_id, ts_from_snowflake(message_id), content, None, None])
+
+    async def cache_pk_message(self, sid: int, message_id: int, author_id: int, content: str, system_pkid: str, member_pkid: str):
+        """Buffered version of pDB.cache_pk_message. Only use for history population."""
+        if self.index is not None:
+            self.index.add(message_id, IndexedMessage(sid, author_id, None, False))
+        await self._add([message_id, sid, author_id, ts_from_snowflake(message_id), content, system_pkid, member_pkid])
+
+    async def get_cached_message(self, sid: int, message_id: int) -> Optional[CachedMessage]:
+        row = self._pending.get(message_id) or self._in_flight.get(message_id)
+        if row is not None:
+            return CachedMessage(*row, None)
+
+        index_result = self.index.check(message_id) if self.index is not None else None
+        if index_result == RecentMessageIndex.NOT_CACHED:
+            return None
+
+        cached_message = await get_cached_message(self.pool, sid, message_id)
+        if cached_message is None and index_result == RecentMessageIndex.MAYBE:
+            self.index.record_false_positive()
+        return cached_message
+
+    def recent_channel_message_ids(self, channel_id: int) -> List[int]:
+        """The cached messages from a channel that the index still holds. Empty without an index."""
+        if self.index is None:
+            return []
+        return self.index.channel_message_ids(channel_id)
+
+    def might_be_preproxy_message(self, message_id: int) -> bool:
+        """
+        False if the index can tell that the message can't be one PluralKit deleted to proxy it.
+        That is when it was sent by a webhook or a bot, or was never cached (every message with content or attachments is).
+        """
+        if self.index is None:
+            return True
+        entry = self.index.get(message_id)
+        if entry is not None:
+            return entry.webhook_id is None and not entry.author_is_bot
+        return self.index.peek(message_id) != RecentMessageIndex.NOT_CACHED
+
+    async def update_cached_message_pk_details(self, sid: int, message_id: int, system_pkid: str, member_pkid: str,
+                                               pk_system_account_id: int):
+        await self._wait_for_in_flight(message_id)  # If that flush fails, the row is back in _pending afterwards.
+        row = self._pending.get(message_id)
+        if row is not None:
+            # Matches the DB version, which re-attributes the message to the account that owns the PK system.
+            row[2] = pk_system_account_id
+            row[5] = system_pkid
+            row[6] = member_pkid
+            return
+
+        if self.spool is not None:
+            await self.spool.update_cached_message_pk_details(sid, message_id, system_pkid, member_pkid, pk_system_account_id)
+        else:
+            await update_cached_message_pk_details(self.pool, sid, message_id, system_pkid, member_pkid, pk_system_account_id)
+
+    async def delete_cached_message(self, sid: int, message_id: int):
+        """Safe to call for messages that were never cached. The index keeps most of those from reaching the DB."""
+        index_result = None
+        if self.index is not None:
+            index_result = self.index.check(message_id)
+            self.index.discard(message_id)
+
+        if self._pending.pop(message_id, None) is not None:
+            # Never made it to the DB. Cancelling the insert is all that is needed.
+            self.rows_cancelled += 1
+            return
+
+        if message_id not in self._in_flight:
+            if index_result == RecentMessageIndex.NOT_CACHED:
+                return
+            if index_result == RecentMessageIndex.MAYBE and (self.spool is None or not self.spool.active):
+                # Aged out of the index. Confirm with a lookup, so a false positive is counted and costs no delete.
+                if await get_cached_message(self.pool, sid, message_id) is None:
+                    self.index.record_false_positive()
+                    return
+
+        await self._wait_for_in_flight(message_id)
+        if self._pending.pop(message_id, None) is not None:
+            # The flush it was part of failed and put it back.
+            self.rows_cancelled += 1
+            return
+
+        if self.spool is not None:
+            await self.spool.delete_cached_message(sid, message_id)
+        else:
+            await delete_cached_message(self.pool, sid, message_id)
+
+    async def delete_cached_messages(self, sid: int, message_ids: Iterable[int]):
+        """
+        Bulk version of delete_cached_message, for purges and deleted channels.
+        Pending rows are cancelled in memory and IDs the index knows were never cached are dropped. The rest are deleted
+        with one statement per batch. Filter positives aren't confirmed first, they only cost a no-op in that statement.
+        """
+        to_delete: List[int] = []
+        for message_id in message_ids:
+            index_result = None
+            if self.index is not None:
+                index_result = self.index.check(message_id)
+                self.index.discard(message_id)
+
+            if self._pending.pop(message_id, None) is not None:
+                self.rows_cancelled += 1
+            elif message_id in self._in_flight or index_result != RecentMessageIndex.NOT_CACHED:
+                to_delete.append(message_id)
+
+        if any(message_id in self._in_flight for message_id in to_delete):
+            async with self._flush_lock:
+                pass
+            # Rows from a flush that failed are back in _pending and can still be cancelled there.
+            requeued = [message_id for message_id in to_delete if self._pending.pop(message_id, None) is not None]
+            if len(requeued) > 0:
+                self.rows_cancelled += len(requeued)
+                requeued = set(requeued)
+                to_delete = [message_id for message_id in to_delete if message_id not in requeued]
+
+        for i in range(0, len(to_delete), self.delete_batch_size):
+            batch = to_delete[i:i + self.delete_batch_size]
+            if self.spool is not None:
+                await self.spool.delete_cached_messages(sid, batch)
+            else:
+                await delete_cached_messages(self.pool, sid, batch)
+
 # endregion
 
 
-# region Members DB Functions
+# region Message Partition Maintenance Functions
+
+# The messages table is range partitioned by month on ts. Everything from before partitioning lives in messages_legacy,
+# which covers (MINVALUE, first monthly boundary). Partitions are named messages_pYYYY_MM.
 
 @dataclass
-class DBMember:
+class MessagePartition:
+    name: str
+    lower_ts: Optional[int]  # None == MINVALUE
+    upper_ts: Optional[int]  # None == MAXVALUE
+
+
+def _month_start(dt: datetime) -> datetime:
+    return datetime(dt.year, dt.month, 1, tzinfo=timezone.utc)
+
+
+def _add_months(dt: datetime, months: int) -> datetime:
+    month_index = dt.month - 1 + months
+    return dt.replace(year=dt.year + month_index // 12, month=month_index % 12 + 1)
+
+
+def _parse_partition_bound(value: str) -> Optional[int]:
+    value = value.strip("' ")
+    return None if value in ("MINVALUE", "MAXVALUE") else int(value)
+
+
+_GET_MESSAGE_PARTITIONS = statement("get_message_partitions", """
+    SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'messages'::regclass
+""")
+
+
+async def _get_message_partitions(conn: asyncpg.connection.Connection) -> List[MessagePartition]:
+    rows = await _fetch(conn, _GET_MESSAGE_PARTITIONS)
+    partitions = []
+    for row in rows:
+        match = re.match(r"FOR VALUES FROM \((.+)\) TO \((.+)\)", row['bound'])
+        if match is None:
+            continue
+        partitions.append(MessagePartition(row['relname'], _parse_partition_bound(match.group(1)), _parse_partition_bound(match.group(2))))
+    partitions.sort(key=lambda p: p.lower_ts if p.lower_ts is not None else -2**63)
+    return partitions
+
+
+async def _create_missing_message_partitions(conn: asyncpg.connection.Connection, months_ahead: int) -> List[str]:
+    existing = await _get_message_partitions(conn)
+    covered_until = max((p.upper_ts for p in existing if p.upper_ts is not None), default=None)
+
+    created = []
+    month = _month_start(datetime.now(timezone.utc))
+    for _ in range(months_ahead + 1):
+        start_ts = int(month.timestamp())
+        next_month = _add_months(month, 1)
+        end_ts = int(next_month.timestamp())
+        if covered_until is None or start_ts >= covered_until:
+            name = f"messages_p{month:%Y_%m}"
+            await conn.execute(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF messages FOR VALUES FROM ({start_ts}) TO ({end_ts})")
+            created.append(name)
+        month = next_month
+    return created
+
+
+@db_deco
+async def get_message_partitions(pool) -> List[MessagePartition]:
+    async with _acquire(pool) as conn:
+        conn: asyncpg.connection.Connection
+        return await _get_message_partitions(conn)
+
+
+@db_deco
+async def ensure_message_partitions(pool, months_ahead: int = 3) -> List[str]:
+    """Creates the partitions for this month and the next `months_ahead` months if they do not exist yet. Returns the names of any new partitions."""
+    async with _acquire(pool) as conn:
+        conn: asyncpg.connection.Connection
+        async with conn.transaction():
+            # Keeps two bot instances from racing each other on the same month.
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_ID)
+            return await _create_missing_message_partitions(conn, months_ahead)
+
+
+_UPSERT_MESSAGE_RETENTION_DAYS = statement("upsert_message_retention_days", """
+    INSERT INTO guild_settings(guild_id, message_retention_days) VALUES($1, $2)
+    ON CONFLICT(guild_id)
+    DO UPDATE SET message_retention_days = EXCLUDED.message_retention_days
+""", expected_index="guild_settings_pkey")
+
+
+@db_deco
+async def upsert_message_retention_days(pool: asyncpg.pool.Pool, guild_id: int, retention_days: Optional[int]):
+    async with _acquire(pool) as conn:
+        conn: asyncpg.connection.Connection
+
+        await _execute_batched(conn, _UPSERT_MESSAGE_RETENTION_DAYS, guild_id, retention_days)
+
+
+_GET_MESSAGE_RETENTION_OVERRIDES = statement("get_message_retention_overrides", "SELECT guild_id, message_retention_days FROM guild_settings WHERE message_retention_days IS NOT NULL", allow_seq_scan=True)
+_DELETE_EXPIRED_DEFAULT_RETENTION_MESSAGES = statement("delete_expired_default_retention_messages", """
+    DELETE FROM messages WHERE (message_id, ts) IN (
+        SELECT message_id, ts FROM messages
+        WHERE message_id > $1 AND ts < $2 AND guild_id <> ALL($3::bigint[])
+        ORDER BY message_id
+        LIMIT $4
+    )
+    RETURNING message_id
+""", expected_index="messages_message_id_ts_key", allow_seq_scan=True)  # Maintenance only. A batch can walk a lot of rows the other guilds still keep.
+_DELETE_EXPIRED_GUILD_MESSAGES = statement("delete_expired_guild_messages", "DELETE FROM messages WHERE guild_id = $1 AND ts < $2", expected_index="messages_guild_ts_idx")
+
+
+async def _delete_expired_default_retention_messages(conn: asyncpg.connection.Connection, cutoff_ts: int,
+                                                     excluded_guild_ids: List[int], batch_size: int) -> int:
+    """
+    Deletes the messages older than cutoff_ts from every guild but excluded_guild_ids, `batch_size` rows per statement
+    so no single delete holds its locks for long. Each batch carries on from the highest message_id the last one deleted.
+    """
+    deleted_rows = 0
+    after_message_id = 0
+    while True:
+        rows = await _fetch(conn, _DELETE_EXPIRED_DEFAULT_RETENTION_MESSAGES, after_message_id, cutoff_ts, excluded_guild_ids, batch_size)
+        deleted_rows += len(rows)
+        if len(rows) < batch_size:
+            return deleted_rows
+        after_message_id = max(row['message_id'] for row in rows)
+
+
+@db_deco
+async def apply_message_retention(pool, default_retention_days: Optional[int], detach: bool = False,
+                                  delete_batch_size: int = 10000) -> Tuple[List[str], int]:
+    """
+    Removes cached messages that are older than their guilds retention window.
+    Guilds without a message_retention_days setting use `default_retention_days`. None means keep forever.
+
+    Whole partitions are dropped (or detached and left in place as stand-alone tables if `detach` is set)
+    once they are past the retention window of every guild.
+    Guilds with a shorter window than that have their older messages deleted row by row, which only touches the partitions involved.
+    So do the expired messages in messages_legacy, which spans everything from before partitioning and so won't be dropped for years.
+    member_daily_activity is left alone, so post counts outlive the cached messages themselves.
+
+    Returns the removed partitions and the number of rows deleted.
+    """
+    async with _acquire(pool) as conn:
+        conn: asyncpg.connection.Connection
+        now = datetime.now(timezone.utc)
+
+        rows = await _fetch(conn, _GET_MESSAGE_RETENTION_OVERRIDES)
+        overrides: Dict[int, int] = {row['guild_id']: row['message_retention_days'] for row in rows}
+
+        removed_partitions = []
+        deleted_rows = 0
+        legacy_upper_ts = None  # Set while messages_legacy is still attached.
+        if default_retention_days is not None:
+            longest_window = max([default_retention_days, *overrides.values()])
+            partition_cutoff = int((now - timedelta(days=longest_window)).timestamp())
+
+            for partition in await _get_message_partitions(conn):
+                if partition.upper_ts is not None and partition.upper_ts <= partition_cutoff:
+                    if detach:
+                        await conn.execute(f"ALTER TABLE messages DETACH PARTITION {partition.name}")
+                    else:
+                        await conn.execute(f"DROP TABLE {partition.name}")
+                    log.info(f"{'Detached' if detach else 'Dropped'} expired message partition {partition.name}")
+                    removed_partitions.append(partition.name)
+                elif partition.lower_ts is None:
+                    legacy_upper_ts = partition.upper_ts
+
+            default_cutoff = int((now - timedelta(days=default_retention_days)).timestamp())
+            if longest_window > default_retention_days:
+                # Guilds using the default have a shorter window than the partitions do.
+                deleted_rows += await _delete_expired_default_retention_messages(conn, default_cutoff, list(overrides.keys()), delete_batch_size)
+            elif legacy_upper_ts is not None:
+                # Monthly partitions are dropped in time, but the legacy one isn't. Capping the cutoff at its upper bound keeps this to messages_legacy.
+                deleted_rows += await _delete_expired_default_retention_messages(conn, min(default_cutoff, legacy_upper_ts),
+                                                                                 list(overrides.keys()), delete_batch_size)
+        else:
+            longest_window = None
+
+        for guild_id, retention_days in overrides.items():
+            guild_cutoff = int((now - timedelta(days=retention_days)).timestamp())
+            if longest_window is not None and retention_days >= longest_window:
+                if legacy_upper_ts is None:
+                    continue  # Partition drops already take care of this guild.
+                guild_cutoff = min(guild_cutoff, legacy_upper_ts)  # Only its messages_legacy rows are left to delete.
+            status = await _execute(conn, _DELETE_EXPIRED_GUILD_MESSAGES, guild_id, guild_cutoff)
+            deleted_rows += int(status.split()[-1])
+
+        return removed_partitions, deleted_rows
+
+# endregion
+
+
+# region Members DB Functions
+
+class DBMember(NamedTuple):
     user_id: int
     guild_id: int
     internal_user_id: int
@@ -664,71 +1912,73 @@ class DBMember:
     become_member: bool
     soft_banned: bool
 
+    columns = "user_id, guild_id, internal_user_id, join_count, inactive_l1_count, inactive_l2_count, post_count, became_member, soft_banned"
+
+
+_UPSERT_NEW_MEMBER = statement("upsert_new_member", """
+    INSERT INTO members(user_id, guild_id, internal_user_id) VALUES($1, $2, $3)
+    ON CONFLICT(guild_id, user_id)
+    DO UPDATE 
+    SET join_count = members.join_count + 1
+""", expected_index="members_pkey")
+
 
 @db_deco
 async def upsert_new_member(pool: asyncpg.pool.Pool, guild_id: int, user_id: int, pn_user_id: int):
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         conn: asyncpg.connection.Connection
 
-        await conn.execute("""
-                            INSERT INTO members(user_id, guild_id, internal_user_id) VALUES($1, $2, $3)
-                            ON CONFLICT(guild_id, user_id)
-                            DO UPDATE 
-                            SET join_count = join_count + 1
-                            """, user_id, guild_id, pn_user_id)
+        await _execute_batched(conn, _UPSERT_NEW_MEMBER, user_id, guild_id, pn_user_id)
+
+
+_GET_MEMBER = statement("get_member", f"SELECT {DBMember.columns} FROM members WHERE guild_id = $1 and user_id = $2", expected_index="members_pkey")
 
 
 @db_deco
 async def get_member(pool, guild_id: int, user_id: int) -> Optional[DBMember]:
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM members WHERE guild_id = $1 and user_id = $2", guild_id, user_id)
-        return DBMember(**row) if row is not None else None
+    async with _acquire(pool) as conn:
+        row = await _fetchrow(conn, _GET_MEMBER, guild_id, user_id)
+        return DBMember(*row) if row is not None else None
+
+
+_GET_LINKED_MEMBERS = statement("get_linked_members", f"SELECT {DBMember.columns} FROM members WHERE guild_id = $1 and internal_user_id = $2", expected_index="members_guild_internal_user_idx")
 
 
 @db_deco
 async def get_linked_members(pool, guild_id: int, pn_user_id: int) -> List[DBMember]:
-    async with pool.acquire() as conn:
-        raw_rows = await conn.fetch("SELECT * FROM members WHERE guild_id = $1 and internal_user_id = $2", guild_id, pn_user_id)
-        members = [DBMember(**row) for row in raw_rows]
+    async with _acquire(pool) as conn:
+        raw_rows = await _fetch(conn, _GET_LINKED_MEMBERS, guild_id, pn_user_id)
+        members = [DBMember(*row) for row in raw_rows]
         return members
 
 
+_UPDATE_MEMBER = statement("update_member", """
+    UPDATE members SET inactive_l1_count = inactive_l1_count + $3,
+                       inactive_l2_count = inactive_l2_count + $4,
+                       post_count = post_count + $5,
+                       became_member = became_member OR $6
+    WHERE guild_id = $1 and user_id = $2
+""", expected_index="members_pkey")
+
+
 @db_deco
 async def update_member(pool, guild_id: int, user_id: int, increment_L1_count: bool = False, increment_L2_count: bool = False,
                         increase_post_count: int = 0, set_membership: bool = False):
-    async with pool.acquire() as conn:
-        if increment_L1_count:
-            await conn.execute(
-                "UPDATE members SET inactive_l1_count = inactive_l1_count + 1 WHERE guild_id = $1 and user_id = $2",
-                guild_id, user_id)
-
-        if increment_L2_count:
-            await conn.execute(
-                "UPDATE members SET inactive_l2_count = inactive_l2_count + 1 WHERE guild_id = $1 and user_id = $2",
-                guild_id, user_id)
+    if not (increment_L1_count or increment_L2_count or increase_post_count or set_membership):
+        return
 
-        if increment_L1_count:
-            await conn.execute(
-                "UPDATE members SET inactive_l1_count = inactive_l1_count + 1 WHERE guild_id = $1 and user_id = $2",
-                guild_id, user_id)
+    async with _acquire(pool) as conn:
+        await _execute_batched(conn, _UPDATE_MEMBER, guild_id, user_id, int(increment_L1_count), int(increment_L2_count),
+                       increase_post_count, set_membership)
 
-        if increase_post_count:
-            await conn.execute(
-                "UPDATE members SET post_count = post_count + $3 WHERE guild_id = $1 and user_id = $2",
-                guild_id, user_id, increase_post_count)
 
-        if set_membership:
-            await conn.execute(
-                "UPDATE members SET became_member = TRUE WHERE guild_id = $1 and user_id = $2",
-                guild_id, user_id)
+_UPDATE_MEMBER_SOFTBAN = statement("update_member_softban", "UPDATE members SET soft_banned = $3 WHERE guild_id = $1 and user_id = $2", expected_index="members_pkey")
 
 
 @db_deco
 async def update_member_softban(pool, guild_id: int, user_id: int, ban: bool):
-    async with pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE members SET soft_banned = $3 WHERE guild_id = $1 and user_id = $2",
-            guild_id, user_id, ban)
+    async with _acquire(pool) as conn:
+        await _execute_batched(conn, _UPDATE_MEMBER_SOFTBAN, guild_id, user_id, ban)
 
 
 # endregion
@@ -736,8 +1986,7 @@ async def update_member_softban(pool, guild_id: int, user_id: int, ban: bool):
 
 # region Inactivity History DB Functions
 
-@dataclass
-class InactivityEvent:
+class InactivityEvent(NamedTuple):
     id: int
     user_id: int
     guild_id: int
@@ -746,6 +1995,8 @@ class InactivityEvent:
     reason: str
     ts: int
 
+    columns = "id, user_id, guild_id, current_level, previous_level, reason, ts"
+
     @property
     def timestamp(self):
         return datetime.utcfromtimestamp(self.ts)
@@ -792,26 +2043,33 @@ class InactivityEvent:
 
 
 
+_ADD_INACTIVITY_EVENT = statement("add_inactivity_event", """
+    INSERT INTO 
+                                  inactivity_history(user_id, guild_id, current_level, previous_level, reason, ts) VALUES($1, $2, $3, $4, $5, $6)
+""")
+
+
 @db_deco
 async def add_inactivity_event(pool: asyncpg.pool.Pool, guild_id: int, user_id: int, current_level: int, previous_level: int,
                                reason: Optional[str] = None, event_ts: Optional[datetime] = None):
     if event_ts is None:
         event_ts = datetime.utcnow()
-    ts = event_ts.timestamp()
+    ts = _utc_ts(event_ts)
 
     if reason is None:
         reason = "No Reason Given"
 
-    async with pool.acquire() as conn:
-        await conn.execute("""INSERT INTO 
-                              inactivity_history(user_id, guild_id, current_level, previous_level, reason, ts) VALUES($1, $2, $3, $4, $5, $6)
-                           """, user_id, guild_id, current_level, previous_level, reason, ts)
+    async with _acquire(pool) as conn:
+        await _execute_batched(conn, _ADD_INACTIVITY_EVENT, user_id, guild_id, current_level, previous_level, reason, ts)
+
+_GET_INACTIVITY_EVENTS = statement("get_inactivity_events", f"SELECT {InactivityEvent.columns} FROM inactivity_history WHERE guild_id = $1 and user_id = $2 ORDER BY id", expected_index="inactivity_history_guild_user_idx")
+
 
 @db_deco
 async def get_inactivity_events(pool, guild_id: int, user_id: int) -> List[InactivityEvent]:
-    async with pool.acquire() as conn:
-        raw_rows = await conn.fetch("SELECT * FROM inactivity_history WHERE guild_id = $1 and user_id = $2", guild_id, user_id)
-        events = [InactivityEvent(**row) for row in raw_rows]
+    async with _acquire(pool) as conn:
+        raw_rows = await _fetch(conn, _GET_INACTIVITY_EVENTS, guild_id, user_id)
+        events = [InactivityEvent(*row) for row in raw_rows]
         return events
 
 
@@ -830,58 +2088,69 @@ async def get_inactivity_events(pool, guild_id: int, user_id: int) -> List[Inact
 
 # region Current Inactive Members Functions
 
-@dataclass
-class InactiveMember:
+class InactiveMember(NamedTuple):
     user_id: int
     guild_id: int
     inactivity_level: int
     ts: int
 
+    columns = "user_id, guild_id, inactivity_level, ts"
+
     @property
     def timestamp(self):
         return datetime.utcfromtimestamp(self.ts)
 
 
 
+_UPSERT_INACTIVE_USER = statement("upsert_inactive_user", """
+    INSERT INTO current_inactive_members(user_id, guild_id, inactivity_level, ts) VALUES($1, $2, $3, $4)
+    ON CONFLICT(guild_id, user_id)
+    DO UPDATE 
+    SET inactivity_level = EXCLUDED.inactivity_level, ts = EXCLUDED.ts
+""", expected_index="current_inactive_members_pkey")
+
+
 @db_deco
 async def upsert_inactive_user(pool: asyncpg.pool.Pool, guild_id: int, user_id: int, inactivity_level: int,
                                event_ts: Optional[datetime] = None):
     if event_ts is None:
         event_ts = datetime.utcnow()
-    ts = event_ts.timestamp()
+    ts = _utc_ts(event_ts)
+
+    async with _acquire(pool) as conn:
+        await _execute_batched(conn, _UPSERT_INACTIVE_USER, user_id, guild_id, inactivity_level, ts)
+
 
-    async with pool.acquire() as conn:
-        await conn.execute("""
-                            INSERT INTO current_inactive_members(user_id, guild_id, inactivity_level, ts) VALUES($1, $2, $3, $4)
-                            ON CONFLICT(guild_id, user_id)
-                            DO UPDATE 
-                            SET inactivity_level = EXCLUDED.inactivity_level, ts = EXCLUDED.ts
-                            """, user_id, guild_id, inactivity_level, ts)
+_GET_INACTIVE_USER = statement("get_inactive_user", f"SELECT {InactiveMember.columns} FROM current_inactive_members WHERE guild_id = $1 and user_id = $2", expected_index="current_inactive_members_pkey")
 
 
 @db_deco
 async def get_inactive_user(pool, guild_id: int, user_id: int) -> Optional[InactiveMember]:
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM current_inactive_members WHERE guild_id = $1 and user_id = $2", guild_id, user_id)
-        return InactiveMember(**row) if row is not None else None
+    async with _acquire(pool) as conn:
+        row = await _fetchrow(conn, _GET_INACTIVE_USER, guild_id, user_id)
+        return InactiveMember(*row) if row is not None else None
+
+
+_REMOVE_INACTIVE_USER = statement("remove_inactive_user", "DELETE FROM current_inactive_members WHERE guild_id = $1 AND user_id = $2", expected_index="current_inactive_members_pkey")
 
 
 @db_deco
 async def remove_inactive_user(pool, guild_id: int, user_id: int):
-    async with pool.acquire() as conn:
-        await conn.execute("DELETE FROM current_inactive_members WHERE guild_id = $1 AND user_id = $2", guild_id, user_id)
+    async with _acquire(pool) as conn:
+        await _execute_batched(conn, _REMOVE_INACTIVE_USER, guild_id, user_id)
 
 # endregion
 
 
 # region Temp Removed Member Roles Functions
 
-@dataclass
-class RoleRemovedFromUser:
+class RoleRemovedFromUser(NamedTuple):
     user_id: int
     guild_id: int
     role_id: int
 
+    columns = "user_id, guild_id, role_id"
+
     @property
     def id(self):
         return self.role_id
@@ -890,38 +2159,46 @@ class RoleRemovedFromUser:
         return hash(self.id)
 
 
+_ADD_ROLE_TMP_REMOVED_FROM_USER = statement("add_role_tmp_removed_from_user", """
+    INSERT INTO temp_removed_member_roles(user_id, guild_id, role_id) VALUES($1, $2, $3)
+    ON CONFLICT(user_id, role_id)
+    DO NOTHING
+""")
+
+
 @db_deco
 async def add_role_tmp_removed_from_user(pool: asyncpg.pool.Pool, guild_id: int, user_id: int, role_id: int):
+    """Already having the role recorded (e.g. from an earlier isolation that was never undone) is not an error."""
+    async with _acquire(pool) as conn:
+        await _execute_batched(conn, _ADD_ROLE_TMP_REMOVED_FROM_USER, user_id, guild_id, role_id)
+
 
-    async with pool.acquire() as conn:
-        await conn.execute("""INSERT INTO
-                              temp_removed_member_roles(user_id, guild_id, role_id) VALUES($1, $2, $3)
-                           """, user_id, guild_id, role_id)
-        # await conn.execute("""
-        #                     INSERT INTO temp_removed_member_roles(user_id, guild_id, role_id) VALUES($1, $2, $3)
-        #                     ON CONFLICT(guild_id, user_id, role_id)
-        #                     DO NOTHING
-        #                     """, user_id, guild_id, role_id)
+_GET_ROLES_TMP_REMOVED_FROM_USER = statement("get_roles_tmp_removed_from_user", f"SELECT {RoleRemovedFromUser.columns} FROM temp_removed_member_roles WHERE guild_id = $1 and user_id = $2", expected_index="temp_removed_member_roles_guild_user_idx")
 
 
 @db_deco
 async def get_roles_tmp_removed_from_user(pool, guild_id: int, user_id: int) -> List[RoleRemovedFromUser]:
-    async with pool.acquire() as conn:
-        raw_rows = await conn.fetch("SELECT * FROM temp_removed_member_roles WHERE guild_id = $1 and user_id = $2",
-                                    guild_id, user_id)
+    async with _acquire(pool) as conn:
+        raw_rows = await _fetch(conn, _GET_ROLES_TMP_REMOVED_FROM_USER, guild_id, user_id)
 
-        roles = [RoleRemovedFromUser(**row) for row in raw_rows]
+        roles = [RoleRemovedFromUser(*row) for row in raw_rows]
         return roles
 
 
+_DELETE_ROLE_TMP_REMOVED_FROM_ALL_USER = statement("delete_role_tmp_removed_from_all_user", "DELETE FROM temp_removed_member_roles WHERE guild_id = $1 AND role_id = $2", expected_index="temp_removed_member_roles_guild_role_idx")
+
+
 @db_deco
 async def delete_role_tmp_removed_from_all_user(pool, guild_id: int, role_id: int):
     """
     This function removes a role from all entries in the temp_removed_member_roles Table.
     It is to be used when a role is deleted from the guild.
     """
-    async with pool.acquire() as conn:
-        await conn.execute("DELETE FROM temp_removed_member_roles WHERE guild_id = $1 AND role_id = $2", guild_id, role_id)
+    async with _acquire(pool) as conn:
+        await _execute_batched(conn, _DELETE_ROLE_TMP_REMOVED_FROM_ALL_USER, guild_id, role_id)
+
+
+_DELETE_INACTIVE_MEMBER_REMOVED_ROLES = statement("delete_inactive_member_removed_roles", "DELETE FROM temp_removed_member_roles WHERE guild_id = $1 AND user_id = $2", expected_index="temp_removed_member_roles_guild_user_idx")
 
 
 @db_deco
@@ -930,8 +2207,8 @@ async def delete_inactive_member_removed_roles(pool, guild_id: int, user_id: int
     This function removes all role from a specific user in the temp_removed_member_roles Table.
     It is to be used when a member leaves or when giving the roles back.
     """
-    async with pool.acquire() as conn:
-        await conn.execute("DELETE FROM temp_removed_member_roles WHERE guild_id = $1 AND user_id = $2", guild_id, user_id)
+    async with _acquire(pool) as conn:
+        await _execute_batched(conn, _DELETE_INACTIVE_MEMBER_REMOVED_ROLES, guild_id, user_id)
 
 
 # endregion
@@ -939,8 +2216,7 @@ async def delete_inactive_member_removed_roles(pool, guild_id: int, user_id: int
 
 # region Join Log Functions
 
-@dataclass
-class JoinLogEvent:
+class JoinLogEvent(NamedTuple):
     id: int
     user_id: int
     guild_id: int
@@ -950,43 +2226,358 @@ class JoinLogEvent:
     invite_id: str
     invite_name: Optional[str]
 
+    columns = "id, user_id, guild_id, ts, inviter_id, invite_id, invite_name"
+
     @property
     def timestamp(self):
         return datetime.utcfromtimestamp(self.ts)
 
 
+_ADD_JOIN_EVENT = statement("add_join_event", """
+    INSERT INTO 
+                                  join_log(user_id, guild_id, ts) VALUES($1, $2, $3)
+""")
+
+
 @db_deco
 async def add_join_event(pool: asyncpg.pool.Pool, guild_id: int, user_id: int, event_ts: Optional[datetime] = None):
 
     if event_ts is None:
         event_ts = datetime.utcnow()
-    ts = event_ts.timestamp()
+    ts = _utc_ts(event_ts)
 
-    async with pool.acquire() as conn:
-        await conn.execute("""INSERT INTO 
-                              join_log(user_id, guild_id, ts) VALUES($1, $2, $3)
-                           """, user_id, guild_id, ts)
+    async with _acquire(pool) as conn:
+        await _execute_batched(conn, _ADD_JOIN_EVENT, user_id, guild_id, ts)
+
+
+_UPDATE_JOIN_EVENT = statement("update_join_event", "UPDATE join_log SET inviter_id = $1, invite_id = $2, invite_name = $3 WHERE guild_id = $4 AND user_id = $5", expected_index="join_log_guild_user_idx")
 
 
 @db_deco
 async def update_join_event(pool: asyncpg.pool.Pool, guild_id: int, user_id: int, inviter_id: int, invite_id: str,
                          invite_name: Optional[str] = None):
-    async with pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE join_log SET inviter_id = $1, invite_id = $2, invite_name = $3 WHERE guild_id = $4 AND user_id = $5",
-             inviter_id, invite_id, invite_name, guild_id, user_id)
+    async with _acquire(pool) as conn:
+        await _execute_batched(conn, _UPDATE_JOIN_EVENT, inviter_id, invite_id, invite_name, guild_id, user_id)
+
+_GET_JOIN_EVENTS = statement("get_join_events", f"SELECT {JoinLogEvent.columns} FROM join_log WHERE guild_id = $1 and user_id = $2", expected_index="join_log_guild_user_idx")
+
 
 @db_deco
 async def get_join_events(pool, guild_id: int, user_id: int) -> List[JoinLogEvent]:
-    async with pool.acquire() as conn:
-        raw_rows = await conn.fetch("SELECT * FROM join_log WHERE guild_id = $1 and user_id = $2",
-                                    guild_id, user_id)
+    async with _acquire(pool) as conn:
+        raw_rows = await _fetch(conn, _GET_JOIN_EVENTS, guild_id, user_id)
 
-        join_logs = [JoinLogEvent(**row) for row in raw_rows]
+        join_logs = [JoinLogEvent(*row) for row in raw_rows]
         return join_logs
 
 # endregion
 
+
+# region PluralKit Account Functions
+
+# Persisted tier of pluralKitAPI.PKClient's /a/ cache, so Discord account -> PK system lookups survive restarts.
+
+class PKAccount(NamedTuple):
+    account_id: int
+    system_pkid: Optional[str]  # None if the account has no PK system.
+    system: Optional[str]  # The PK API's system object, as JSON.
+    fetched_ts: int  # When the PK API was asked.
+
+    columns = "account_id, system_pkid, system, fetched_ts"
+
+
+_GET_PK_ACCOUNT = statement("get_pk_account", f"SELECT {PKAccount.columns} FROM pk_accounts WHERE account_id = $1", expected_index="pk_accounts_pkey")
+
+
+@db_deco
+async def get_pk_account(pool, account_id: int) -> Optional[PKAccount]:
+    async with _acquire(pool) as conn:
+        row = await _fetchrow(conn, _GET_PK_ACCOUNT, account_id)
+        return PKAccount(*row) if row is not None else None
+
+
+_UPSERT_PK_ACCOUNT = statement("upsert_pk_account", """
+    INSERT INTO pk_accounts(account_id, system_pkid, system, fetched_ts) VALUES($1, $2, $3, $4)
+    ON CONFLICT(account_id) DO UPDATE SET system_pkid = EXCLUDED.system_pkid, system = EXCLUDED.system, fetched_ts = EXCLUDED.fetched_ts
+""", expected_index="pk_accounts_pkey")
+
+
+@db_deco
+async def upsert_pk_account(pool, account_id: int, system_pkid: Optional[str], system: Optional[str], fetched_ts: int):
+    async with _acquire(pool) as conn:
+        await _execute_batched(conn, _UPSERT_PK_ACCOUNT, account_id, system_pkid, system, fetched_ts)
+
+# endregion
+
+
+# region Write Spool
+
+# What a write raises when the DB can't be reached at all, rather than rejecting the write.
+_DB_UNAVAILABLE_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.exceptions.PostgresConnectionError,
+                          asyncpg.exceptions.CannotConnectNowError, asyncpg.exceptions.TooManyConnectionsError,
+                          asyncpg.exceptions.ConnectionDoesNotExistError)
+
+
+class WriteSpool:
+    """
+    Keeps message cache and join log writes from being lost (or holding up event handlers) while the DB is slow or down.
+
+    Writes go straight to the DB while it is healthy. Once a write fails, takes longer than `latency_threshold_ms`,
+    or finds the pool with no free connections, it and every write after it go to an on disk Spool instead.
+    A background task replays the spool into the DB in the order the writes were made, one segment per transaction,
+    and writes go back to the DB once the spool is empty. A segment the DB rejects is replayed one record at a time,
+    and only the records it keeps rejecting are set aside.
+
+    While writes are being spooled, reads (e.g. get_cached_message) will not see them.
+    """
+
+    def __init__(self, pool: asyncpg.pool.Pool, directory: str = "data/spool", latency_threshold_ms: float = 500,
+                 drain_interval: float = 5.0, fsync_interval: float = 1.0, segment_max_records: int = 10000,
+                 max_replay_attempts: int = 3):
+        self.pool = pool
+        self.spool = Spool(directory, segment_max_records)
+        self.latency_threshold_ms = latency_threshold_ms
+        self.drain_interval = drain_interval
+        self.fsync_interval = fsync_interval
+        self.max_replay_attempts = max_replay_attempts  # A record the DB keeps rejecting is set aside after this many tries.
+
+        self._degraded = self.spool.depth > 0
+        self._drain_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        self.records_spooled = 0
+        self.records_drained = 0
+        self.records_quarantined = 0
+        self.drain_rate = 0.0  # Records per second while replaying the last segment.
+
+    @property
+    def active(self) -> bool:
+        """True while writes are going to the spool instead of the DB."""
+        return self._degraded or self.spool.depth > 0 or self._pool_exhausted()
+
+    def _pool_exhausted(self) -> bool:
+        stats = get_pool_stats(self.pool)
+        return stats['idle'] == 0 and stats['waiting'] > 0
+
+    def _degrade(self, reason: str):
+        if not self._degraded:
+            log.warning(f"Spooling message cache and join log writes to disk: {reason}")
+        self._degraded = True
+
+    def _append(self, kind: str, values: list):
+        self.spool.append(kind, values)
+        self.records_spooled += 1
+
+    async def _write(self, kind: str, values: list, write: Callable[[Session], Awaitable]):
+        """Runs `write` in its own session, or spools the record if the DB can't take it right now."""
+        if self.active:
+            self._append(kind, values)
+            return
+
+        start_time = time.perf_counter()
+        try:
+            async with session(self.pool) as db:
+                await write(db)
+            committed = db.committed
+        except _DB_UNAVAILABLE_ERRORS:
+            log.exception(f"Error writing {kind} to the DB.")
+            committed = False
+
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        if not committed:
+            self._degrade(f"{kind} write failed")
+            self._append(kind, values)
+        elif elapsed_ms > self.latency_threshold_ms:
+            self._degrade(f"{kind} write took {elapsed_ms:.0f} ms")
+
+    # --- Write Interface --- #
+
+    async def cache_messages_bulk(self, records: List[tuple]) -> int:
+        """Used by MessageCacheBuffer.flush(). Returns how many rows made it into the DB (0 if they were spooled)."""
+        if not self.active:
+            start_time = time.perf_counter()
+            try:
+                written = await cache_messages_bulk(self.pool, records=records)
+            except _DB_UNAVAILABLE_ERRORS:
+                log.exception("Error writing message to the DB.")
+                written = None
+            elapsed_ms = (time.perf_counter() - start_time) * 1000
+            if written is not None:
+                if elapsed_ms > self.latency_threshold_ms:
+                    self._degrade(f"message cache write took {elapsed_ms:.0f} ms")
+                return written
+            self._degrade("message cache write failed")
+
+        for record in records:
+            self._append('message', list(record))
+        return 0
+
+    async def update_cached_message_pk_details(self, sid: int, message_id: int, system_pkid: str, member_pkid: str,
+                                               pk_system_account_id: int):
+        async def write(db):
+            await update_cached_message_pk_details(db, sid, message_id, system_pkid, member_pkid, pk_system_account_id)
+        await self._write('message_pk', [sid, message_id, system_pkid, member_pkid, pk_system_account_id], write)
+
+    async def delete_cached_message(self, sid: int, message_id: int):
+        async def write(db):
+            await delete_cached_message(db, sid, message_id)
+        await self._write('message_delete', [sid, message_id], write)
+
+    async def delete_cached_messages(self, sid: int, message_ids: List[int]):
+        async def write(db):
+            await delete_cached_messages(db, sid, message_ids)
+        await self._write('message_delete_bulk', [sid, message_ids], write)
+
+    async def add_join_event(self, guild_id: int, user_id: int, event_ts: Optional[datetime] = None):
+        if event_ts is None:
+            event_ts = datetime.utcnow()
+
+        async def write(db):
+            await add_join_event(db, guild_id, user_id, event_ts)
+        await self._write('join', [guild_id, user_id, _utc_ts(event_ts)], write)
+
+    # --- Draining --- #
+
+    def start(self):
+        """Starts the background fsync and drain loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._loop())
+
+    async def close(self):
+        """Stops the background loop and fsyncs the spool. Anything still in it is drained on the next start."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        async with self._drain_lock:
+            self.spool.close()
+
+    async def _loop(self):
+        next_drain = time.monotonic() + self.drain_interval
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            try:
+                await self.spool.sync()
+                if time.monotonic() >= next_drain:
+                    next_drain = time.monotonic() + self.drain_interval
+                    await self.drain()
+            except Exception:
+                log.exception("Error draining the write spool.")
+
+    async def drain(self):
+        """Replays the spool into the DB, oldest segment first. Stops at the first segment that can't be written."""
+        async with self._drain_lock:
+            while True:
+                if self._pool_exhausted():
+                    return
+
+                number = self.spool.oldest_segment()
+                if number is None:
+                    if self._degraded:
+                        log.info("Write spool drained. Writing to the DB directly again.")
+                        self._degraded = False
+                    return
+
+                records = self.spool.read_segment(number)
+                start_time = time.perf_counter()
+                try:
+                    replayed = await self._replay(records)
+                except _DB_UNAVAILABLE_ERRORS:
+                    log.warning(f"DB is still unavailable. {self.spool.depth} records remain spooled.")
+                    return
+                except Exception:
+                    log.exception(f"Error replaying spool segment {number}.")
+                    replayed = False
+
+                if replayed:
+                    self.spool.remove_segment(number)
+                    written = len(records)
+                else:
+                    # The DB is up but rejected the segment. Find the records it is rejecting instead of giving up on all of them.
+                    try:
+                        written = await self._replay_one_by_one(number, records)
+                    except _DB_UNAVAILABLE_ERRORS:
+                        log.warning(f"DB is unavailable again. {self.spool.depth} records remain spooled.")
+                        return
+
+                elapsed = time.perf_counter() - start_time
+                self.records_drained += written
+                self.drain_rate = written / elapsed if elapsed > 0 else 0.0
+                log.info(f"Replayed {written} spooled records in {elapsed * 1000:.0f} ms. {self.spool.depth} remain.")
+
+    async def _replay_one_by_one(self, number: int, records: List[Record]) -> int:
+        """
+        Replays a segment the DB rejected one record per transaction, trying each up to max_replay_attempts times.
+        Records it keeps rejecting are quarantined and the segment is removed. Returns how many records were written.
+        If the DB becomes unavailable partway through, the segment is cut down to the records that are left before raising.
+        """
+        written = 0
+        done = 0
+        rejected: List[Record] = []
+        try:
+            for record in records:
+                for _ in range(self.max_replay_attempts):
+                    try:
+                        replayed = await self._replay([record])
+                    except _DB_UNAVAILABLE_ERRORS:
+                        raise
+                    except Exception:
+                        log.exception(f"Error replaying a record from spool segment {number}.")
+                        replayed = False
+                    if replayed:
+                        written += 1
+                        break
+                else:
+                    rejected.append(record)
+                done += 1
+        except BaseException:
+            self.spool.rewrite_segment(number, records[done:])
+            raise
+        finally:
+            if len(rejected) > 0:
+                self.spool.quarantine_records(number, rejected)
+                self.records_quarantined += len(rejected)
+
+        self.spool.remove_segment(number)
+        return written
+
+    async def _replay(self, records: List[Record]) -> bool:
+        """Writes a segment's records in one transaction. Consecutive records of the same kind are batched."""
+        async with session(self.pool) as db:
+            for kind, run in itertools.groupby(records, key=lambda record: record[0]):
+                values = [record[1] for record in run]
+                if kind == 'message':
+                    await cache_messages_bulk(db, records=[tuple(value) for value in values])
+                elif kind == 'message_pk':
+                    for value in values:
+                        await update_cached_message_pk_details(db, *value)
+                elif kind == 'message_delete':
+                    for value in values:
+                        await delete_cached_message(db, *value)
+                elif kind == 'message_delete_bulk':
+                    for sid, message_ids in values:
+                        await delete_cached_messages(db, sid, message_ids)
+                elif kind == 'join':
+                    for guild_id, user_id, ts in values:
+                        await add_join_event(db, guild_id, user_id, datetime.utcfromtimestamp(ts))
+                else:
+                    log.error(f"Skipping {len(values)} spooled records of unknown kind {kind}")
+        if db.timed_out:
+            # The DB is too slow to take the segment right now, which is no reason to count it as rejected.
+            raise asyncio.TimeoutError()
+        return db.committed
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            **self.spool.stats(),
+            'active': self.active,
+            'records_spooled': self.records_spooled,
+            'records_drained': self.records_drained,
+            'drain_rate': self.drain_rate,
+            'records_quarantined': self.records_quarantined,
+        }
+
+# endregion
+
 # region React Roles Functions
 
 # @dataclass
@@ -998,198 +2589,393 @@ async def get_join_events(pool, guild_id: int, user_id: int) -> List[JoinLogEven
 
 # endregion
 # ---------- Table Creation ---------- #
-@db_deco
-async def create_tables(pool: asyncpg.pool.Pool):
-    async with pool.acquire() as conn:
-        conn: asyncpg.connection.Connection
-        # TODO: Move interview_type over to an int and use an enum?
+async def _create_base_tables(conn: asyncpg.connection.Connection):
+    """The original schema. Applied as migration 1 so existing databases are picked up without any changes."""
+    # TODO: Move interview_type over to an int and use an enum?
+
+    # ALTER TABLE interviews ADD COLUMN interview_type_msg_id BIGINT DEFAULT NULL;
+    await conn.execute('''
+                           CREATE TABLE if not exists interviews(
+                           guild_id                 BIGINT NOT NULL,
+                           member_id                BIGINT NOT NULL,
+                           user_name                TEXT NOT NULL,
+                           channel_id               BIGINT NOT NULL,
+                           question_number          INT DEFAULT 0,
+                           interview_finished       BOOLEAN default FALSE,
+                           paused                   BOOLEAN default FALSE,
+                           interview_type           TEXT default 'unknown',   
+                           read_rules               BOOLEAN default FALSE,
+                           join_ts                  BIGINT NOT NULL,
+                           interview_type_msg_id    BIGINT DEFAULT NULL,
+                           PRIMARY KEY              (member_id, channel_id)
+                          );
+                    ''')
+
+    # ALTER TABLE guild_settings ADD COLUMN welcome_back_react_msg_id BIGINT DEFAULT NULL;
+    await conn.execute('''
+                           CREATE TABLE if not exists guild_settings(
+                           guild_id                         BIGINT NOT NULL,
+                           raid_level                       INT DEFAULT 0,
+                           welcome_back_react_msg_id        BIGINT DEFAULT NULL,
+                           PRIMARY KEY              (guild_id)
+                          );
+                    ''')
+
+    await conn.execute('''
+                           CREATE TABLE if not exists role_categories(
+                           cat_id                   SERIAL PRIMARY KEY,
+                           guild_id                 BIGINT NOT NULL,
+                           cat_name                 TEXT default 'Other',
+                           description              TEXT DEFAULT NULL,
+                           cat_position             INT NOT NULL
+                          );
+                    ''')
+
+    await conn.execute('''
+                           CREATE TABLE if not exists allowed_roles(
+                           role_id                  BIGINT PRIMARY KEY,
+                           guild_id                 BIGINT NOT NULL,
+                           cat_id                   BIGINT NOT NULL REFERENCES role_categories(cat_id) ON DELETE CASCADE,
+                           description              TEXT DEFAULT NULL,
+                           emoji                    BIGINT DEFAULT NULL
+                          );
+                    ''')
+
+
+    """ -- Added 3/6/2021 -- """
+    await conn.execute('''
+                       CREATE TABLE if not exists messages(
+                           message_id           BIGINT PRIMARY KEY,
+                           guild_id             BIGINT NOT NULL,
+                           user_id              BIGINT NOT NULL,  --Could be a webhook id for PK messages?
+                           ts                   BIGINT NOT NULL,  --TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                           content              TEXT DEFAULT NULL,
+                           system_pkid          TEXT DEFAULT NULL,
+                           member_pkid          TEXT DEFAULT NULL,
+                           pk_system_account_id BIGINT DEFAULT NULL  --Discord ID associated with the PK System that sent the message.
+                       )
+                   ''')
+
+
+    """ -- Added 3/13/2021 -- """
 
-        # ALTER TABLE interviews ADD COLUMN interview_type_msg_id BIGINT DEFAULT NULL;
-        await conn.execute('''
-                               CREATE TABLE if not exists interviews(
-                               guild_id                 BIGINT NOT NULL,
-                               member_id                BIGINT NOT NULL,
-                               user_name                TEXT NOT NULL,
-                               channel_id               BIGINT NOT NULL,
-                               question_number          INT DEFAULT 0,
-                               interview_finished       BOOLEAN default FALSE,
-                               paused                   BOOLEAN default FALSE,
-                               interview_type           TEXT default 'unknown',   
-                               read_rules               BOOLEAN default FALSE,
-                               join_ts                  BIGINT NOT NULL,
-                               interview_type_msg_id    BIGINT DEFAULT NULL,
-                               PRIMARY KEY              (member_id, channel_id)
-                              );
-                        ''')
-
-        # ALTER TABLE guild_settings ADD COLUMN welcome_back_react_msg_id BIGINT DEFAULT NULL;
-        await conn.execute('''
-                               CREATE TABLE if not exists guild_settings(
-                               guild_id                         BIGINT NOT NULL,
-                               raid_level                       INT DEFAULT 0,
-                               welcome_back_react_msg_id        BIGINT DEFAULT NULL,
-                               PRIMARY KEY              (guild_id)
-                              );
-                        ''')
+    """
+    This table tracks details on each user who visits PN. 
+    """
+    await conn.execute('''
+                       CREATE TABLE if not exists members(
+                            user_id              BIGINT NOT NULL,       -- Discord User ID
+                            guild_id             BIGINT NOT NULL,       -- Discord Guild ID
+                            internal_user_id     BIGINT NOT NULL,       -- Internally Generated ID to link together alt accounts
+                            join_count           INT DEFAULT 1,         -- How many times has the user joined the server
+                            inactive_L1_count    INT DEFAULT 0,         -- How many times has the user went Inactive - Level One
+                            inactive_L2_count    INT DEFAULT 0,         -- How many times has the user went Inactive - Level Two
+                            post_count           INT DEFAULT 0,         -- Users Total post count
+                            became_member        BOOL DEFAULT FALSE,    -- Has this user ever been given membership
+                            soft_banned          BOOL DEFAULT FALSE,    -- Is the user `Soft Banned`
+                            PRIMARY KEY          (user_id, guild_id)
+                       )
+                   ''')
 
-        await conn.execute('''
-                               CREATE TABLE if not exists role_categories(
-                               cat_id                   SERIAL PRIMARY KEY,
-                               guild_id                 BIGINT NOT NULL,
-                               cat_name                 TEXT default 'Other',
-                               description              TEXT DEFAULT NULL,
-                               cat_position             INT NOT NULL
-                              );
-                        ''')
 
-        await conn.execute('''
-                               CREATE TABLE if not exists allowed_roles(
-                               role_id                  BIGINT PRIMARY KEY,
-                               guild_id                 BIGINT NOT NULL,
-                               cat_id                   BIGINT NOT NULL REFERENCES role_categories(cat_id) ON DELETE CASCADE,
-                               description              TEXT DEFAULT NULL,
-                               emoji                    BIGINT DEFAULT NULL
-                              );
-                        ''')
+    """
+    This table tracks details on each *instance* of a join event @ PN 
+    """
+    await conn.execute('''
+                          CREATE TABLE if not exists join_log(
+                              id                   SERIAL PRIMARY KEY,
+                              user_id              BIGINT NOT NULL,    -- Discord User ID
+                              guild_id             BIGINT NOT NULL,    -- Discord Guild ID
+                              ts                   BIGINT NOT NULL,    -- Timestamp of when the user joined
+                              
+                              inviter_id           BIGINT DEFAULT NULL,    -- Discord User ID of the person who created the invite (Most Recent)
+                              invite_id            TEXT DEFAULT NULL,      -- The Discord Invite Code / URL (Most Recent)
+                              invite_name          TEXT DEFAULT NULL   -- GG Name for the invite (Most Recent)
+                          )
+                      ''')
 
+    """
+    This table tracks each *instance* that a member was deemed to be Inactive or became active again.
+    """
+    await conn.execute('''
+                       CREATE TABLE if not exists inactivity_history(
+                            id                   SERIAL PRIMARY KEY,
+                            user_id              BIGINT NOT NULL,       -- Discord User ID
+                            guild_id             BIGINT NOT NULL,       -- Discord Guild ID
+                            current_level        INT NOT NULL,          -- The inactivity level the user is now at. 0: Active, 1: Inactive - One, 2: Inactive - Two
+                            previous_level       INT NOT NULL,          -- The inactivity level the user was previously at.  -1: None, 0: Active, 1: Inactive - One, 2: Inactive - Two
+                            reason               TEXT NOT NULL,         -- Why the user was marked active or inactive.
+                            ts                   BIGINT NOT NULL        -- Timestamp of when the user was marked as inactive or active.
+                        )
+                    ''')
 
-        """ -- Added 3/6/2021 -- """
-        await conn.execute('''
-                           CREATE TABLE if not exists messages(
-                               message_id           BIGINT PRIMARY KEY,
-                               guild_id             BIGINT NOT NULL,
-                               user_id              BIGINT NOT NULL,  --Could be a webhook id for PK messages?
-                               ts                   BIGINT NOT NULL,  --TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                               content              TEXT DEFAULT NULL,
-                               system_pkid          TEXT DEFAULT NULL,
-                               member_pkid          TEXT DEFAULT NULL,
-                               pk_system_account_id BIGINT DEFAULT NULL  --Discord ID associated with the PK System that sent the message.
-                           )
-                       ''')
+    """
+    This table tracks the users that are CURRENTLY marked Inactive, aka we have been given either the "Inactive Member - Level 1" or "Inactive Member - Level 2" roles to.
+    """
+    await conn.execute('''
+                       CREATE TABLE if not exists current_inactive_members(
+                           user_id              BIGINT NOT NULL,    -- Discord User ID
+                           guild_id             BIGINT NOT NULL,    -- Discord Guild ID
+                           inactivity_level     INT NOT NULL,       -- 1 or 2. Corresponds to which 'Inactivity Level' they are currently at.
+                           ts                   BIGINT NOT NULL,    -- Timestamp of when the user was marked as inactive
+                           PRIMARY KEY          (user_id, guild_id)
+                       )
+                   ''')
 
 
-        """ -- Added 3/13/2021 -- """
+    """
+    The temp_removed_member_roles table keeps track of the roles PNBot removed from a user when giving a inactive role or moving a user to #cooldown,
+     so that it can give those roles back when it subsequently removes the inactive role or removes them from #cooldown.
 
-        """
-        This table tracks details on each user who visits PN. 
-        """
-        await conn.execute('''
-                           CREATE TABLE if not exists members(
-                                user_id              BIGINT NOT NULL,       -- Discord User ID
-                                guild_id             BIGINT NOT NULL,       -- Discord Guild ID
-                                internal_user_id     BIGINT NOT NULL,       -- Internally Generated ID to link together alt accounts
-                                join_count           INT DEFAULT 1,         -- How many times has the user joined the server
-                                inactive_L1_count    INT DEFAULT 0,         -- How many times has the user went Inactive - Level One
-                                inactive_L2_count    INT DEFAULT 0,         -- How many times has the user went Inactive - Level Two
-                                post_count           INT DEFAULT 0,         -- Users Total post count
-                                became_member        BOOL DEFAULT FALSE,    -- Has this user ever been given membership
-                                soft_banned          BOOL DEFAULT FALSE,    -- Is the user `Soft Banned`
-                                PRIMARY KEY          (user_id, guild_id)
-                           )
-                       ''')
+    Be sure to remove all entries belonging to a **USER** when said user leaves the server. The entry will not be DELETE CASCADED as we are keeping member info indefinitely.
 
+    Be sure to remove all entries belonging to a **ROLE** when said role is deleted. We can not use the "allowed_roles" Table as we will be dealing with roles that can not be on that table (Such as the NSFW role).
+    """
+    await conn.execute('''
+                       CREATE TABLE if not exists temp_removed_member_roles(
+                           user_id              BIGINT NOT NULL,    -- Discord User ID
+                           guild_id             BIGINT NOT NULL,    -- Discord Guild ID
+                           role_id              BIGINT NOT NULL,    -- Discord Role ID
+                           PRIMARY KEY          (user_id, role_id)
+                       )
+                   ''')
+
+    #
+    # await conn.execute('''
+    #                       CREATE TABLE if not exists react_role_post(
+    #                           message_id           BIGINT NOT NULL,    -- Discord User ID
+    #                           guild_id             BIGINT NOT NULL,    -- Discord Guild ID
+    #                           role_id              BIGINT NOT NULL,
+    #                           emoji_id             TEXT NOT NULL,
+    #                           PRIMARY KEY          (message_id, guild_id, role_id, emoji_id)
+    #                       )
+    #                   ''')
+
+    # await conn.execute('''
+    #                        CREATE TABLE if not exists member_activity(
+    #                        member_id                BIGINT NOT NULL,
+    #                        guild_id                 BIGINT NOT NULL,
+    #                        ts                       TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    #                        PRIMARY KEY              (member_id, guild_id)
+    #                       );
+    #                 ''')
+
+    # await conn.execute('''
+    #                        CREATE TABLE if not exists user_profiles(
+    #                        member_id                BIGINT NOT NULL,
+    #                        guild_id                 BIGINT NOT NULL,
+    #                        profile_name             TEXT NOT NULL,
+    #                        profile_id               SERIAL UNIQUE,
+    #                        PRIMARY KEY          (member_id, guild_id, profile_name)
+    #                       );
+    #                 ''')
+    #
+    # await conn.execute('''
+    #                        CREATE TABLE if not exists role_profiles(
+    #                        profile_id               BIGINT NOT NULL REFERENCES user_profiles(profile_id) ON DELETE CASCADE,
+    #                        role_id                  BIGINT NOT NULL REFERENCES allowed_roles(role_id) ON DELETE CASCADE,
+    #                        PRIMARY KEY              (profile_id, role_id)
+    #                       );
+    #                 ''')
+
+
+# ---------- Schema Migrations ---------- #
 
-        """
-        This table tracks details on each *instance* of a join event @ PN 
-        """
-        await conn.execute('''
-                              CREATE TABLE if not exists join_log(
-                                  id                   SERIAL PRIMARY KEY,
-                                  user_id              BIGINT NOT NULL,    -- Discord User ID
-                                  guild_id             BIGINT NOT NULL,    -- Discord Guild ID
-                                  ts                   BIGINT NOT NULL,    -- Timestamp of when the user joined
-                                  
-                                  inviter_id           BIGINT DEFAULT NULL,    -- Discord User ID of the person who created the invite (Most Recent)
-                                  invite_id            TEXT DEFAULT NULL,      -- The Discord Invite Code / URL (Most Recent)
-                                  invite_name          TEXT DEFAULT NULL   -- GG Name for the invite (Most Recent)
-                              )
-                          ''')
+@dataclass
+class Migration:
+    """
+    A single versioned schema change.
 
-        """
-        This table tracks each *instance* that a member was deemed to be Inactive or became active again.
-        """
-        await conn.execute('''
-                           CREATE TABLE if not exists inactivity_history(
-                                id                   SERIAL PRIMARY KEY,
-                                user_id              BIGINT NOT NULL,       -- Discord User ID
-                                guild_id             BIGINT NOT NULL,       -- Discord Guild ID
-                                current_level        INT NOT NULL,          -- The inactivity level the user is now at. 0: Active, 1: Inactive - One, 2: Inactive - Two
-                                previous_level       INT NOT NULL,          -- The inactivity level the user was previously at.  -1: None, 0: Active, 1: Inactive - One, 2: Inactive - Two
-                                reason               TEXT NOT NULL,         -- Why the user was marked active or inactive.
-                                ts                   BIGINT NOT NULL        -- Timestamp of when the user was marked as inactive or active.
-                            )
-                        ''')
+    Concurrent migrations run outside of a transaction, which is required for CREATE INDEX CONCURRENTLY,
+    and must be safe to re-run if interrupted. Everything else runs in one transaction together with its schema_version entry.
+    """
+    version: int
+    description: str
+    statements: Tuple[str, ...] = ()
+    func: Optional[Callable[[asyncpg.connection.Connection], Awaitable[None]]] = None
+    concurrent: bool = False
+    index_name: Optional[str] = None  # For concurrent index builds. An INVALID index left by an interrupted build is dropped before retrying.
 
-        """
-        This table tracks the users that are CURRENTLY marked Inactive, aka we have been given either the "Inactive Member - Level 1" or "Inactive Member - Level 2" roles to.
-        """
-        await conn.execute('''
-                           CREATE TABLE if not exists current_inactive_members(
-                               user_id              BIGINT NOT NULL,    -- Discord User ID
-                               guild_id             BIGINT NOT NULL,    -- Discord Guild ID
-                               inactivity_level     INT NOT NULL,       -- 1 or 2. Corresponds to which 'Inactivity Level' they are currently at.
-                               ts                   BIGINT NOT NULL,    -- Timestamp of when the user was marked as inactive
-                               PRIMARY KEY          (user_id, guild_id)
-                           )
-                       ''')
 
+async def _partition_messages(conn: asyncpg.connection.Connection):
+    """
+    Converts messages into a table partitioned by month on ts without rewriting it.
 
-        """
-        The temp_removed_member_roles table keeps track of the roles PNBot removed from a user when giving a inactive role or moving a user to #cooldown,
-         so that it can give those roles back when it subsequently removes the inactive role or removes them from #cooldown.
+    The existing table becomes the messages_legacy partition, covering everything up to the first monthly boundary.
+    The bound is proven by a CHECK constraint that is validated up front (this only blocks DDL, not reads or writes),
+    which lets SET NOT NULL and ATTACH PARTITION skip their own full table scans while holding the exclusive lock.
+    """
+    relkind = await conn.fetchval("SELECT relkind FROM pg_class WHERE oid = 'messages'::regclass")
+    if relkind == 'p':
+        return
+
+    # Two months of slack so that a slow VALIDATE on a huge table can't run past the boundary.
+    boundary = _add_months(_month_start(datetime.now(timezone.utc)), 2)
+    boundary_ts = int(boundary.timestamp())
+
+    await conn.execute("ALTER TABLE messages DROP CONSTRAINT IF EXISTS messages_legacy_ts_bound")
+    await conn.execute(f"ALTER TABLE messages ADD CONSTRAINT messages_legacy_ts_bound CHECK (ts IS NOT NULL AND ts < {boundary_ts}) NOT VALID")
+    await conn.execute("ALTER TABLE messages VALIDATE CONSTRAINT messages_legacy_ts_bound")
+
+    async with conn.transaction():
+        await conn.execute("ALTER TABLE messages RENAME TO messages_legacy")
+        await conn.execute("ALTER INDEX messages_guild_user_ts_idx RENAME TO messages_legacy_guild_user_ts_idx")
+        await conn.execute("ALTER INDEX messages_guild_ts_idx RENAME TO messages_legacy_guild_ts_idx")
+        await conn.execute("ALTER TABLE messages_legacy ALTER COLUMN ts SET NOT NULL")
+        # A unique constraint on a partitioned table has to include the partition key.
+        await conn.execute("ALTER TABLE messages_legacy DROP CONSTRAINT messages_pkey")
+        await conn.execute("ALTER TABLE messages_legacy ADD CONSTRAINT messages_legacy_message_id_ts_key UNIQUE USING INDEX messages_message_id_ts_idx")
 
-        Be sure to remove all entries belonging to a **USER** when said user leaves the server. The entry will not be DELETE CASCADED as we are keeping member info indefinitely.
+        await conn.execute('''
+                           CREATE TABLE messages(
+                               message_id           BIGINT NOT NULL,
+                               guild_id             BIGINT NOT NULL,
+                               user_id              BIGINT NOT NULL,  --Could be a webhook id for PK messages?
+                               ts                   BIGINT NOT NULL,
+                               content              TEXT DEFAULT NULL,
+                               system_pkid          TEXT DEFAULT NULL,
+                               member_pkid          TEXT DEFAULT NULL,
+                               pk_system_account_id BIGINT DEFAULT NULL,  --Discord ID associated with the PK System that sent the message.
+                               CONSTRAINT messages_message_id_ts_key UNIQUE (message_id, ts)
+                           ) PARTITION BY RANGE (ts)
+                       ''')
+        await conn.execute("CREATE INDEX messages_guild_user_ts_idx ON messages (guild_id, user_id, ts)")
+        await conn.execute("CREATE INDEX messages_guild_ts_idx ON messages (guild_id, ts)")
+
+        # The legacy indexes match the ones above, so they are attached instead of rebuilt.
+        await conn.execute(f"ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (MINVALUE) TO ({boundary_ts})")
+        await conn.execute("ALTER TABLE messages_legacy DROP CONSTRAINT messages_legacy_ts_bound")
+
+        await _create_missing_message_partitions(conn, months_ahead=3)
+
+
+async def _create_member_daily_activity(conn: asyncpg.connection.Connection):
+    await conn.execute('''
+                       CREATE TABLE if not exists member_daily_activity(
+                           guild_id             BIGINT NOT NULL,
+                           user_id              BIGINT NOT NULL,
+                           day                  DATE NOT NULL,   -- UTC
+                           post_count           INT NOT NULL DEFAULT 0,
+                           PRIMARY KEY          (guild_id, user_id, day)
+                       )
+                   ''')
+    await conn.execute("CREATE INDEX if not exists member_daily_activity_guild_day_idx ON member_daily_activity (guild_id, day)")
+    await _fill_member_daily_activity(conn)
+
+
+def _concurrent_index(version: int, name: str, table: str, columns: str) -> Migration:
+    return Migration(version, f"Add index {name} on {table}({columns})",
+                     statements=(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})",),
+                     concurrent=True, index_name=name)
+
+
+# Append only! Never change or reorder a migration that has already been released.
+MIGRATIONS: List[Migration] = [
+    Migration(1, "Base schema", func=_create_base_tables),
+
+    # -- Added 10/18/2026 -- Indexes for every hot lookup. Built concurrently so writes are not blocked on large tables.
+    _concurrent_index(2, "messages_guild_user_ts_idx", "messages", "guild_id, user_id, ts"),
+    _concurrent_index(3, "messages_guild_ts_idx", "messages", "guild_id, ts"),
+    _concurrent_index(4, "inactivity_history_guild_user_idx", "inactivity_history", "guild_id, user_id, id"),
+    _concurrent_index(5, "join_log_guild_user_idx", "join_log", "guild_id, user_id"),
+    _concurrent_index(6, "temp_removed_member_roles_guild_user_idx", "temp_removed_member_roles", "guild_id, user_id"),
+    _concurrent_index(7, "temp_removed_member_roles_guild_role_idx", "temp_removed_member_roles", "guild_id, role_id"),
+    _concurrent_index(8, "allowed_roles_cat_idx", "allowed_roles", "cat_id"),
+    _concurrent_index(9, "allowed_roles_guild_idx", "allowed_roles", "guild_id"),
+    _concurrent_index(10, "role_categories_guild_idx", "role_categories", "guild_id"),
+    _concurrent_index(11, "members_guild_internal_user_idx", "members", "guild_id, internal_user_id"),
+
+    # -- Added 10/18/2026 -- Monthly partitions on messages.ts and per guild retention.
+    Migration(12, "Add unique index messages(message_id, ts)",
+              statements=("CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS messages_message_id_ts_idx ON messages (message_id, ts)",),
+              concurrent=True, index_name="messages_message_id_ts_idx"),
+    Migration(13, "Partition messages by month on ts", func=_partition_messages, concurrent=True),
+    Migration(14, "Add guild_settings.message_retention_days",
+              statements=("ALTER TABLE guild_settings ADD COLUMN IF NOT EXISTS message_retention_days INT DEFAULT NULL",)),
+
+    # -- Added 10/18/2026 -- Per user daily post count rollup, back filled from the existing cache.
+    Migration(15, "Add member_daily_activity", func=_create_member_daily_activity),
+
+    # -- Added 10/18/2026 -- Persisted PluralKit account lookups.
+    Migration(16, "Add pk_accounts",
+              statements=('''
+                          CREATE TABLE if not exists pk_accounts(
+                              account_id           BIGINT NOT NULL PRIMARY KEY,  -- Discord User ID
+                              system_pkid          TEXT DEFAULT NULL,            -- NULL if the account has no PK system.
+                              system               TEXT DEFAULT NULL,            -- PK API system object, as JSON.
+                              fetched_ts           BIGINT NOT NULL
+                          )
+                          ''',)),
+]
+
+MIGRATION_LOCK_ID = 7_263_401  # Arbitrary key for pg_advisory_lock so that two bot instances never migrate at the same time.
+
+
+async def _drop_invalid_index(conn: asyncpg.connection.Connection, index_name: str):
+    invalid = await conn.fetchval("""
+                                  SELECT NOT i.indisvalid FROM pg_index i
+                                  JOIN pg_class c ON c.oid = i.indexrelid
+                                  WHERE c.relname = $1 AND pg_catalog.pg_table_is_visible(c.oid)
+                                  """, index_name)
+    if invalid:
+        log.warning(f"Dropping invalid index {index_name} left behind by an interrupted build.")
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+
+
+async def run_migrations(pool: asyncpg.pool.Pool):
+    """
+    Brings the database schema up to date by applying every migration newer than the version recorded in schema_version.
+    Errors are NOT swallowed. The bot should not start against a schema it does not understand.
+    """
+    backend = _backend_for(pool)
+    if backend is not None:
+        await backend.run_migrations(pool)
+        return
 
-        Be sure to remove all entries belonging to a **ROLE** when said role is deleted. We can not use the "allowed_roles" Table as we will be dealing with roles that can not be on that table (Such as the NSFW role).
-        """
+    async with _acquire(pool) as conn:
+        conn: asyncpg.connection.Connection
         await conn.execute('''
-                           CREATE TABLE if not exists temp_removed_member_roles(
-                               user_id              BIGINT NOT NULL,    -- Discord User ID
-                               guild_id             BIGINT NOT NULL,    -- Discord Guild ID
-                               role_id              BIGINT NOT NULL,    -- Discord Role ID
-                               PRIMARY KEY          (user_id, role_id)
+                           CREATE TABLE if not exists schema_version(
+                               version              INT PRIMARY KEY,
+                               description          TEXT NOT NULL,
+                               applied_ts           BIGINT NOT NULL
                            )
                        ''')
 
-        #
-        # await conn.execute('''
-        #                       CREATE TABLE if not exists react_role_post(
-        #                           message_id           BIGINT NOT NULL,    -- Discord User ID
-        #                           guild_id             BIGINT NOT NULL,    -- Discord Guild ID
-        #                           role_id              BIGINT NOT NULL,
-        #                           emoji_id             TEXT NOT NULL,
-        #                           PRIMARY KEY          (message_id, guild_id, role_id, emoji_id)
-        #                       )
-        #                   ''')
-
-        # await conn.execute('''
-        #                        CREATE TABLE if not exists member_activity(
-        #                        member_id                BIGINT NOT NULL,
-        #                        guild_id                 BIGINT NOT NULL,
-        #                        ts                       TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-        #                        PRIMARY KEY              (member_id, guild_id)
-        #                       );
-        #                 ''')
-
-        # await conn.execute('''
-        #                        CREATE TABLE if not exists user_profiles(
-        #                        member_id                BIGINT NOT NULL,
-        #                        guild_id                 BIGINT NOT NULL,
-        #                        profile_name             TEXT NOT NULL,
-        #                        profile_id               SERIAL UNIQUE,
-        #                        PRIMARY KEY          (member_id, guild_id, profile_name)
-        #                       );
-        #                 ''')
-        #
-        # await conn.execute('''
-        #                        CREATE TABLE if not exists role_profiles(
-        #                        profile_id               BIGINT NOT NULL REFERENCES user_profiles(profile_id) ON DELETE CASCADE,
-        #                        role_id                  BIGINT NOT NULL REFERENCES allowed_roles(role_id) ON DELETE CASCADE,
-        #                        PRIMARY KEY              (profile_id, role_id)
-        #                       );
-        #                 ''')
-
-
-
-
-
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+        try:
+            applied = {row['version'] for row in await conn.fetch("SELECT version FROM schema_version")}
+
+            for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+                if migration.version in applied:
+                    continue
+
+                log.info(f"Applying DB migration {migration.version}: {migration.description}")
+                start_time = time.perf_counter()
+                if migration.concurrent:
+                    if migration.index_name is not None:
+                        await _drop_invalid_index(conn, migration.index_name)
+                    for statement in migration.statements:
+                        await conn.execute(statement)
+                    if migration.func is not None:
+                        await migration.func(conn)
+                    await _record_migration(conn, migration)
+                else:
+                    async with conn.transaction():
+                        for statement in migration.statements:
+                            await conn.execute(statement)
+                        if migration.func is not None:
+                            await migration.func(conn)
+                        await _record_migration(conn, migration)
+
+                log.info(f"DB migration {migration.version} applied in {time.perf_counter() - start_time:.3f} s.")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+
+    # Statements cached before the migrations ran can refer to tables they have since replaced.
+    await pool.expire_connections()
+
+
+async def _record_migration(conn: asyncpg.connection.Connection, migration: Migration):
+    await conn.execute("INSERT INTO schema_version(version, description, applied_ts) VALUES($1, $2, $3)",
+                       migration.version, migration.description, int(datetime.utcnow().timestamp()))
@@ -0,0 +1,1063 @@
+"""
+SQLite backend for pDB.
+Implements the same functions as pDB on top of a single long lived aiosqlite connection, for single node and test deployments.
+
+Selected with "db_backend": "sqlite" in config.json. Nothing outside of PNBot.py needs to know about it:
+every pDB function that is passed a SQLiteDB (or a SQLiteSession) in place of the pool is routed here.
+
+Differences from the Postgres backend:
+    - Post counts are counted straight from the messages table. There is no daily rollup, so they don't outlive message retention.
+    - There are no partitions. Retention deletes rows.
+    - There is no statement timeout, so QueryTimeoutError is never raised.
+
+Part of PNBot.
+"""
+
+import sys
+import time
+import asyncio
+import logging
+import sqlite3
+import functools
+
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone, timedelta
+from typing import Optional, List, Dict, Tuple, AsyncIterator
+
+import aiosqlite
+
+import pDB
+from pDB import (CachedMessage, DBMember, InactivityEvent, InactiveMember, AllowedRole, RoleCategory, RoleCategories,
+                 RoleRemovedFromUser, JoinLogEvent, GuildDBSettings, MessagePartition, MessageCacheBuffer, PKAccount,
+                 row_to_interview_dict)
+from utilities.latencyStats import LatencyHistogram
+
+log = logging.getLogger("PNBot.sqliteDB")
+
+
+# ---------- Connection ---------- #
+
+class SQLiteDB:
+    """
+    The one connection to the SQLite database. Used in place of the asyncpg pool.
+    The connection runs in autocommit mode. Calls take turns on it through `lock`, so a multi statement
+    transaction (or a Session) can never have someone else's statements land in the middle of it.
+    That also means a call made with bot.db from inside a session waits on the session forever. Pass the session.
+    """
+
+    def __init__(self, conn: aiosqlite.Connection, path: str):
+        self.conn = conn
+        self.path = path
+        self.lock = asyncio.Lock()
+
+        self.waiting = 0  # Callers currently waiting on the lock.
+        self.acquire_wait = LatencyHistogram()  # How long getting the lock took.
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[aiosqlite.Connection]:
+        self.waiting += 1
+        start_time = time.perf_counter()
+        try:
+            await self.lock.acquire()
+        finally:
+            self.waiting -= 1
+            self.acquire_wait.record((time.perf_counter() - start_time) * 1000)
+
+        try:
+            yield self.conn
+        finally:
+            self.lock.release()
+
+    async def close(self):
+        await self.conn.close()
+
+
+async def connect(path: str, cached_statements: int = 256) -> SQLiteDB:
+    """Opens the database in WAL mode. cached_statements is the size of sqlite3's per connection prepared statement cache."""
+    conn = await aiosqlite.connect(path, isolation_level=None, cached_statements=cached_statements)
+    await conn.execute("PRAGMA journal_mode = WAL")
+    await conn.execute("PRAGMA synchronous = NORMAL")  # Safe with WAL. Only the last few commits can be lost on power loss, the DB can't be corrupted.
+    await conn.execute("PRAGMA foreign_keys = ON")
+    await conn.execute("PRAGMA busy_timeout = 5000")
+    return SQLiteDB(conn, path)
+
+
+def get_pool_stats(db: SQLiteDB) -> Dict[str, float]:
+    """Same shape as pDB.get_pool_stats. There is only ever the one connection."""
+    acquired = 1 if db.lock.locked() else 0
+    return {
+        'min_size': 1,
+        'max_size': 1,
+        'size': 1,
+        'acquired': acquired,
+        'idle': 1 - acquired,
+        'waiting': db.waiting,
+        'acquire_count': db.acquire_wait.count,
+        'acquire_wait_p50_ms': db.acquire_wait.percentile(50),
+        'acquire_wait_p99_ms': db.acquire_wait.percentile(99),
+        'acquire_wait_max_ms': db.acquire_wait.max_ms,
+    }
+
+
+# ---------- Sessions ---------- #
+
+class SQLiteSession:
+    """
+    SQLite version of pDB.Session. Holds the connection (and a transaction) for the life of the session.
+    Writes that don't return anything are queued, and consecutive writes of the same statement go out as one executemany.
+    """
+
+    def __init__(self, db: SQLiteDB):
+        self.db = db
+        self.conn = db.conn
+        self.failed = False
+        self.committed = False
+        self.analytics_timeout = None
+        self.flush_error: Optional[BaseException] = None
+        self.timed_out = False  # Never set, SQLite has no statement timeout. Here for pDB.WriteSpool.
+        self._pending_query: Optional[str] = None
+        self._pending_args: List[tuple] = []
+        self._savepoints = 0
+
+    async def defer(self, query: str, args: tuple):
+        if self._pending_query is not query:
+            await self.flush()
+            self._pending_query = query
+        self._pending_args.append(args)
+
+    async def flush(self):
+        if self._pending_query is None:
+            return
+
+        query, pending_args = self._pending_query, self._pending_args
+        self._pending_query = None
+        self._pending_args = []
+        try:
+            await self.conn.executemany(query, pending_args)
+        except sqlite3.Error as e:
+            # Log it against the queued query, not whatever call triggered the flush. See pDB.Session.flush.
+            log.exception(f"Error attempting database query: {' '.join(query.split())} ({len(pending_args)} queued in a session)")
+            self.failed = True
+            self.flush_error = e
+            raise
+
+
+@asynccontextmanager
+async def session(db) -> AsyncIterator[SQLiteSession]:
+    """See pDB.session()."""
+    if isinstance(db, SQLiteSession):
+        yield db
+        return
+
+    async with db.acquire() as conn:
+        db_session = SQLiteSession(db)
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield db_session
+        except BaseException:
+            await conn.execute("ROLLBACK")
+            raise
+
+        if not db_session.failed:
+            try:
+                await db_session.flush()
+            except sqlite3.Error:
+                pass  # Logged by flush(), which also marks the session as failed.
+
+        if db_session.failed:
+            log.warning("Rolling back database session due to an earlier error.")
+            await conn.execute("ROLLBACK")
+        else:
+            await conn.execute("COMMIT")
+            db_session.committed = True
+
+
+# ---------- Query Helpers ---------- #
+
+def db_deco(func):
+    """Same as pDB.db_deco, for sqlite3 errors. Timings go into pDB.query_stats so the db_stats command sees both backends."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        error = True
+        try:
+            response = await func(*args, **kwargs)
+            error = False
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("DB Query {} in {:.3f} ms.".format(func.__name__, (time.perf_counter() - start_time) * 1000))
+            return response
+        except sqlite3.Error as e:
+            if len(args) > 0 and isinstance(args[0], SQLiteSession):
+                args[0].failed = True
+                if args[0].flush_error is e:
+                    return None  # A queued write failed. SQLiteSession.flush has already logged it.
+            if len(args) > 1:
+                log.exception("Error attempting database query: {} for server: {}".format(func.__name__, args[1]))
+            else:
+                log.exception("Error attempting database query: {}".format(func.__name__))
+        finally:
+            pDB.query_stats.record(func.__name__, (time.perf_counter() - start_time) * 1000, error)
+    return wrapper
+
+
+@asynccontextmanager
+async def _acquire(db) -> AsyncIterator[aiosqlite.Connection]:
+    """The connection, with everything a session has queued already written out."""
+    if isinstance(db, SQLiteSession):
+        await db.flush()
+        yield db.conn
+        return
+
+    async with db.acquire() as conn:
+        yield conn
+
+
+@asynccontextmanager
+async def _transaction(db) -> AsyncIterator[aiosqlite.Connection]:
+    """A transaction, or a savepoint if db is a session."""
+    if isinstance(db, SQLiteSession):
+        await db.flush()
+        db._savepoints += 1
+        name = f"sp_{db._savepoints}"
+        await db.conn.execute(f"SAVEPOINT {name}")
+        try:
+            yield db.conn
+            await db.flush()
+        except BaseException:
+            await db.conn.execute(f"ROLLBACK TO {name}")
+            await db.conn.execute(f"RELEASE {name}")
+            raise
+        await db.conn.execute(f"RELEASE {name}")
+        return
+
+    async with db.acquire() as conn:
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            await conn.execute("ROLLBACK")
+            raise
+        await conn.execute("COMMIT")
+
+
+async def _execute(db, query: str, args: tuple = ()) -> int:
+    """Runs a statement and returns the number of rows it changed."""
+    async with _acquire(db) as conn:
+        cursor = await conn.execute(query, args)
+        row_count = cursor.rowcount
+        await cursor.close()
+        return row_count
+
+
+async def _execute_batched(db, query: str, args: tuple):
+    """A write whose result isn't needed. In a session it is queued so it can be batched with other calls of the same statement."""
+    if isinstance(db, SQLiteSession):
+        await db.defer(query, args)
+    else:
+        async with db.acquire() as conn:
+            await conn.execute(query, args)
+
+
+async def _fetch(db, query: str, args: tuple = ()) -> List[sqlite3.Row]:
+    async with _acquire(db) as conn:
+        return list(await conn.execute_fetchall(query, args))
+
+
+async def _fetchrow(db, query: str, args: tuple = ()) -> Optional[sqlite3.Row]:
+    rows = await _fetch(db, query, args)
+    return rows[0] if len(rows) > 0 else None
+
+
+async def _fetchval(db, query: str, args: tuple = ()):
+    row = await _fetchrow(db, query, args)
+    return row[0] if row is not None else None
+
+
+def _utc_ts(timestamp: datetime) -> int:
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp())
+
+
+# ---------- Schema ---------- #
+# The SQLite schema is always created at its latest version, so there is no migration history to replay.
+# Bump SCHEMA_VERSION and add to _SCHEMA (IF NOT EXISTS / ALTER TABLE) when it changes.
+
+SCHEMA_VERSION = 2
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS interviews(
+           guild_id                 INTEGER NOT NULL,
+           member_id                INTEGER NOT NULL,
+           user_name                TEXT NOT NULL,
+           channel_id               INTEGER NOT NULL,
+           question_number          INTEGER DEFAULT 0,
+           interview_finished       BOOLEAN DEFAULT FALSE,
+           paused                   BOOLEAN DEFAULT FALSE,
+           interview_type           TEXT DEFAULT 'unknown',
+           read_rules               BOOLEAN DEFAULT FALSE,
+           join_ts                  REAL NOT NULL,
+           interview_type_msg_id    INTEGER DEFAULT NULL,
+           PRIMARY KEY              (member_id, channel_id)
+       )""",
+    """CREATE TABLE IF NOT EXISTS guild_settings(
+           guild_id                     INTEGER NOT NULL PRIMARY KEY,
+           raid_level                   INTEGER DEFAULT 0,
+           welcome_back_react_msg_id    INTEGER DEFAULT NULL,
+           message_retention_days       INTEGER DEFAULT NULL
+       )""",
+    """CREATE TABLE IF NOT EXISTS role_categories(
+           cat_id                   INTEGER PRIMARY KEY AUTOINCREMENT,
+           guild_id                 INTEGER NOT NULL,
+           cat_name                 TEXT DEFAULT 'Other',
+           description              TEXT DEFAULT NULL,
+           cat_position             INTEGER NOT NULL
+       )""",
+    """CREATE TABLE IF NOT EXISTS allowed_roles(
+           role_id                  INTEGER PRIMARY KEY,
+           guild_id                 INTEGER NOT NULL,
+           cat_id                   INTEGER NOT NULL REFERENCES role_categories(cat_id) ON DELETE CASCADE,
+           description              TEXT DEFAULT NULL,
+           emoji                    INTEGER DEFAULT NULL
+       )""",
+    """CREATE TABLE IF NOT EXISTS messages(
+           message_id               INTEGER PRIMARY KEY,
+           guild_id                 INTEGER NOT NULL,
+           user_id                  INTEGER NOT NULL,
+           ts                       INTEGER NOT NULL,
+           content                  TEXT DEFAULT NULL,
+           system_pkid              TEXT DEFAULT NULL,
+           member_pkid              TEXT DEFAULT NULL,
+           pk_system_account_id     INTEGER DEFAULT NULL
+       )""",
+    """CREATE TABLE IF NOT EXISTS members(
+           user_id                  INTEGER NOT NULL,
+           guild_id                 INTEGER NOT NULL,
+           internal_user_id         INTEGER NOT NULL,
+           join_count               INTEGER DEFAULT 1,
+           inactive_l1_count        INTEGER DEFAULT 0,
+           inactive_l2_count        INTEGER DEFAULT 0,
+           post_count               INTEGER DEFAULT 0,
+           became_member            BOOLEAN DEFAULT FALSE,
+           soft_banned              BOOLEAN DEFAULT FALSE,
+           PRIMARY KEY              (user_id, guild_id)
+       )""",
+    """CREATE TABLE IF NOT EXISTS join_log(
+           id                       INTEGER PRIMARY KEY AUTOINCREMENT,
+           user_id                  INTEGER NOT NULL,
+           guild_id                 INTEGER NOT NULL,
+           ts                       INTEGER NOT NULL,
+           inviter_id               INTEGER DEFAULT NULL,
+           invite_id                TEXT DEFAULT NULL,
+           invite_name              TEXT DEFAULT NULL
+       )""",
+    """CREATE TABLE IF NOT EXISTS inactivity_history(
+           id                       INTEGER PRIMARY KEY AUTOINCREMENT,
+           user_id                  INTEGER NOT NULL,
+           guild_id                 INTEGER NOT NULL,
+           current_level            INTEGER NOT NULL,
+           previous_level           INTEGER NOT NULL,
+           reason                   TEXT NOT NULL,
+           ts                       INTEGER NOT NULL
+       )""",
+    """CREATE TABLE IF NOT EXISTS current_inactive_members(
+           user_id                  INTEGER NOT NULL,
+           guild_id                 INTEGER NOT NULL,
+           inactivity_level         INTEGER NOT NULL,
+           ts                       INTEGER NOT NULL,
+           PRIMARY KEY              (user_id, guild_id)
+       )""",
+    """CREATE TABLE IF NOT EXISTS temp_removed_member_roles(
+           user_id                  INTEGER NOT NULL,
+           guild_id                 INTEGER NOT NULL,
+           role_id                  INTEGER NOT NULL,
+           PRIMARY KEY              (user_id, role_id)
+       )""",
+    """CREATE TABLE IF NOT EXISTS pk_accounts(
+           account_id               INTEGER PRIMARY KEY,
+           system_pkid              TEXT DEFAULT NULL,
+           system                   TEXT DEFAULT NULL,
+           fetched_ts               INTEGER NOT NULL
+       )""",
+    # Same indexes as the Postgres migrations.
+    "CREATE INDEX IF NOT EXISTS messages_guild_user_ts_idx ON messages (guild_id, user_id, ts)",
+    "CREATE INDEX IF NOT EXISTS messages_guild_ts_idx ON messages (guild_id, ts)",
+    "CREATE INDEX IF NOT EXISTS members_guild_internal_user_idx ON members (guild_id, internal_user_id)",
+    "CREATE INDEX IF NOT EXISTS inactivity_history_guild_user_idx ON inactivity_history (guild_id, user_id)",
+    "CREATE INDEX IF NOT EXISTS join_log_guild_user_idx ON join_log (guild_id, user_id)",
+    "CREATE INDEX IF NOT EXISTS temp_removed_member_roles_guild_user_idx ON temp_removed_member_roles (guild_id, user_id)",
+    "CREATE INDEX IF NOT EXISTS temp_removed_member_roles_guild_role_idx ON temp_removed_member_roles (guild_id, role_id)",
+    "CREATE INDEX IF NOT EXISTS allowed_roles_guild_idx ON allowed_roles (guild_id)",
+    "CREATE INDEX IF NOT EXISTS allowed_roles_cat_idx ON allowed_roles (cat_id)",
+    "CREATE INDEX IF NOT EXISTS role_categories_guild_idx ON role_categories (guild_id)",
+)
+
+
+async def run_migrations(db: SQLiteDB):
+    """Creates any missing tables and indexes."""
+    async with _transaction(db) as conn:
+        version = (await conn.execute_fetchall("PRAGMA user_version"))[0][0]
+        if version < SCHEMA_VERSION:
+            log.info(f"Creating SQLite schema version {SCHEMA_VERSION} in {db.path}")
+        for stmt in _SCHEMA:
+            await conn.execute(stmt)
+        await conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+# ---------- Interview Methods ---------- #
+
+# region Join Interview DB Functions
+
+_ADD_NEW_INTERVIEW = "INSERT INTO interviews(guild_id, member_id, user_name, channel_id, question_number, interview_finished, paused, interview_type, read_rules, join_ts, interview_type_msg_id) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+
+@db_deco
+async def add_new_interview(db, sid: int, member_id: int, username: str, channel_id: int,
+                            question_number: int = 0, interview_finished: bool = False, paused: bool = False,
+                            interview_type: str = 'unknown', read_rules: bool = False, join_ts: datetime = None,
+                            interview_type_msg_id=None):
+    if join_ts is None:
+        join_ts = datetime.utcnow()
+    ts = join_ts.timestamp()
+    await _execute_batched(db, _ADD_NEW_INTERVIEW, (sid, member_id, username, channel_id, question_number, interview_finished, paused, interview_type, read_rules, ts, interview_type_msg_id))
+
+
+_UPDATE_INTERVIEW_ALL_MUTABLE = "UPDATE interviews SET question_number = ?, interview_finished = ?, paused = ?, interview_type = ?, read_rules = ? WHERE channel_id = ? AND member_id = ? AND interview_type_msg_id = ?"
+
+
+@db_deco
+async def update_interview_all_mutable(db, cid: int, mid: int, question_number: int, interview_finished: bool, paused: bool, interview_type: str, read_rules: bool, interview_type_msg_id: Optional[int]):
+    await _execute_batched(db, _UPDATE_INTERVIEW_ALL_MUTABLE, (question_number, interview_finished, paused, interview_type, read_rules, cid, mid, interview_type_msg_id))
+
+
+_UPDATE_INTERVIEW_QUESTION_NUMBER = "UPDATE interviews SET question_number = ? WHERE channel_id = ? AND member_id = ?"
+
+
+@db_deco
+async def update_interview_question_number(db, cid: int, mid: int, question_number: int):
+    await _execute_batched(db, _UPDATE_INTERVIEW_QUESTION_NUMBER, (question_number, cid, mid))
+
+
+_UPDATE_INTERVIEW_FINISHED = "UPDATE interviews SET interview_finished = ? WHERE channel_id = ? AND member_id = ?"
+
+
+@db_deco
+async def update_interview_finished(db, cid: int, mid: int, interview_finished: bool):
+    await _execute_batched(db, _UPDATE_INTERVIEW_FINISHED, (interview_finished, cid, mid))
+
+
+_UPDATE_INTERVIEW_PAUSED = "UPDATE interviews SET paused = ? WHERE channel_id = ? AND member_id = ?"
+
+
+@db_deco
+async def update_interview_paused(db, cid: int, mid: int, paused: bool):
+    await _execute_batched(db, _UPDATE_INTERVIEW_PAUSED, (paused, cid, mid))
+
+
+_UPDATE_INTERVIEW_TYPE = "UPDATE interviews SET interview_type = ? WHERE channel_id = ? AND member_id = ?"
+
+
+@db_deco
+async def update_interview_type(db, cid: int, mid: int, interview_type: str):
+    await _execute_batched(db, _UPDATE_INTERVIEW_TYPE, (interview_type, cid, mid))
+
+
+_UPDATE_INTERVIEW_READ_RULES = "UPDATE interviews SET read_rules = ? WHERE channel_id = ? AND member_id = ?"
+
+
+@db_deco
+async def update_interview_read_rules(db, cid: int, mid: int, read_rules: bool):
+    await _execute_batched(db, _UPDATE_INTERVIEW_READ_RULES, (read_rules, cid, mid))
+
+
+_UPDATE_INTERVIEW_TYPE_MSG_ID = "UPDATE interviews SET interview_type_msg_id = ? WHERE channel_id = ? AND member_id = ?"
+
+
+@db_deco
+async def update_interview_type_msg_id(db, cid: int, mid: int, interview_type_msg_id: int):
+    await _execute_batched(db, _UPDATE_INTERVIEW_TYPE_MSG_ID, (interview_type_msg_id, cid, mid))
+
+
+_GET_ALL_INTERVIEWS = "SELECT guild_id, member_id, user_name, channel_id, question_number, interview_finished, paused, interview_type, read_rules, join_ts, interview_type_msg_id FROM interviews"
+
+
+@db_deco
+async def get_all_interviews(db) -> List[Dict]:
+    return [row_to_interview_dict(row) for row in await _fetch(db, _GET_ALL_INTERVIEWS)]
+
+
+_DELETE_INTERVIEW = "DELETE FROM interviews WHERE channel_id = ? AND member_id = ?"
+
+
+@db_deco
+async def delete_interview(db, cid: int, mid: int):
+    await _execute_batched(db, _DELETE_INTERVIEW, (cid, mid))
+
+# endregion
+
+
+# region Guild Settings DB Functions
+
+# ON CONFLICT ... DO UPDATE needs SQLite 3.24+, which every supported Python ships with.
+_UPSERT_RAID_LEVEL = """
+    INSERT INTO guild_settings(guild_id, raid_level) VALUES(?, ?)
+    ON CONFLICT(guild_id)
+    DO UPDATE SET raid_level = excluded.raid_level
+"""
+
+
+@db_deco
+async def upsert_raid_level(db, sid: int, raid_level: int):
+    await _execute_batched(db, _UPSERT_RAID_LEVEL, (sid, raid_level))
+
+
+_GET_RAID_LEVEL = "SELECT raid_level FROM guild_settings WHERE guild_id = ?"
+
+
+@db_deco
+async def get_raid_level(db, sid: int) -> int:
+    raid_level = await _fetchval(db, _GET_RAID_LEVEL, (sid,))
+    return raid_level if raid_level is not None else 0
+
+
+_UPSERT_WELCOME_BACK_REACT_MSG_ID = """
+    INSERT INTO guild_settings(guild_id, welcome_back_react_msg_id) VALUES(?, ?)
+    ON CONFLICT(guild_id)
+    DO UPDATE SET welcome_back_react_msg_id = excluded.welcome_back_react_msg_id
+"""
+
+
+@db_deco
+async def upsert_welcome_back_react_msg_id(db, guild_id: int, message_id: Optional[int]):
+    await _execute_batched(db, _UPSERT_WELCOME_BACK_REACT_MSG_ID, (guild_id, message_id))
+
+
+_GET_GUILD_SETTINGS = "SELECT guild_id, raid_level, welcome_back_react_msg_id, message_retention_days FROM guild_settings WHERE guild_id = ?"
+
+
+@db_deco
+async def get_guild_settings(db, guild_id: int) -> Optional[GuildDBSettings]:
+    row = await _fetchrow(db, _GET_GUILD_SETTINGS, (guild_id,))
+    return GuildDBSettings(*row) if row is not None else None
+
+# endregion
+
+
+# region Role DB Functions
+
+_GET_ROLE_CATS = f"SELECT {RoleCategory.columns} FROM role_categories WHERE guild_id = ?"
+
+
+@db_deco
+async def get_role_cats(db, gid: int) -> RoleCategories:
+    raw_rows = await _fetch(db, _GET_ROLE_CATS, (gid,))
+    cats = RoleCategories(cats=[RoleCategory(*row, db) for row in raw_rows], guild_id=gid, pool=db)
+    cats.sort()
+    return cats
+
+
+_GET_ROLES_IN_CAT = f"SELECT {AllowedRole.columns} FROM allowed_roles WHERE cat_id = ?"
+
+
+@db_deco
+async def get_roles_in_cat(db, cat_id: int) -> List[AllowedRole]:
+    return [AllowedRole(*row) for row in await _fetch(db, _GET_ROLES_IN_CAT, (cat_id,))]
+
+
+_GET_ROLES_IN_GUILD = f"SELECT {AllowedRole.columns} FROM allowed_roles WHERE guild_id = ?"
+
+
+@db_deco
+async def get_roles_in_guild(db, gid: int) -> List[AllowedRole]:
+    return [AllowedRole(*row) for row in await _fetch(db, _GET_ROLES_IN_GUILD, (gid,))]
+
+
+_UPSERT_ROLE = """
+    INSERT INTO allowed_roles(role_id, guild_id, cat_id, description) VALUES(?, ?, ?, ?)
+    ON CONFLICT(role_id)
+    DO UPDATE SET cat_id = excluded.cat_id, description = excluded.description
+"""
+
+
+@db_deco
+async def upsert_role(db, gid: int, role_id: int, cat_id: int, desc: Optional[str]):
+    await _execute_batched(db, _UPSERT_ROLE, (role_id, gid, cat_id, desc))
+
+
+_MOVE_ROLE = "UPDATE allowed_roles SET cat_id = ? WHERE role_id = ? AND guild_id = ?"
+
+
+@db_deco
+async def move_role(db, gid: int, role_id: int, new_cat_id: int):
+    await _execute_batched(db, _MOVE_ROLE, (new_cat_id, role_id, gid))
+
+
+_DELETE_ROLE = "DELETE FROM allowed_roles WHERE role_id = ? AND guild_id = ?"
+
+
+@db_deco
+async def delete_role(db, gid: int, role_id: int):
+    await _execute_batched(db, _DELETE_ROLE, (role_id, gid))
+
+
+_ADD_ROLE_CAT = "INSERT INTO role_categories(guild_id, cat_name, description, cat_position) VALUES(?, ?, ?, ?)"
+
+
+@db_deco
+async def add_role_cat(db, gid: int, name: str, description: str, position: int):
+    await _execute_batched(db, _ADD_ROLE_CAT, (gid, name, description, position))
+
+
+_RENAME_ROLE_CAT = "UPDATE role_categories SET cat_name = ? WHERE cat_id = ?"
+
+
+@db_deco
+async def rename_role_cat(db, cat_id: int, cat_name: str):
+    await _execute_batched(db, _RENAME_ROLE_CAT, (cat_name, cat_id))
+
+
+_CHANGE_DESCRIPTION_ROLE_CAT = "UPDATE role_categories SET description = ? WHERE cat_id = ?"
+
+
+@db_deco
+async def change_description_role_cat(db, cat_id: int, description: str):
+    await _execute_batched(db, _CHANGE_DESCRIPTION_ROLE_CAT, (description, cat_id))
+
+
+_MOVE_ROLE_CAT = "UPDATE role_categories SET cat_position = ? WHERE cat_id = ?"
+
+
+@db_deco
+async def move_role_cat(db, cat_id: int, cat_pos: int):
+    await _execute_batched(db, _MOVE_ROLE_CAT, (cat_pos, cat_id))
+
+
+_DELETE_ROLE_CAT = "DELETE FROM role_categories WHERE cat_id = ?"
+
+
+@db_deco
+async def delete_role_cat(db, gid: int, cat_id: int):
+    await _execute_batched(db, _DELETE_ROLE_CAT, (cat_id,))
+
+# endregion
+
+
+# region Cached Messages DB Functions
+
+_INSERT_MESSAGE = "INSERT INTO messages(message_id, guild_id, user_id, ts, content, system_pkid, member_pkid) VALUES(?, ?, ?, ?, ?, ?, ?) ON CONFLICT(message_id) DO NOTHING"
+
+
+@db_deco
+async def cache_message(db, sid: int, message_id: int, author_id: int, content: str):
+    await _execute_batched(db, _INSERT_MESSAGE, (message_id, sid, author_id, pDB.ts_from_snowflake(message_id), content, None, None))
+
+
+@db_deco
+async def cache_pk_message(db, sid: int, message_id: int, author_id: int, content: str, system_pkid: str, member_pkid: str):
+    """Only use for history population."""
+    await _execute_batched(db, _INSERT_MESSAGE, (message_id, sid, author_id, pDB.ts_from_snowflake(message_id), content, system_pkid, member_pkid))
+
+
+@db_deco
+async def cache_messages_bulk(db, records: List[tuple]) -> int:
+    """Writes a batch of message rows (in MessageCacheBuffer.columns order) with one executemany, in one transaction."""
+    assert len(MessageCacheBuffer.columns) == 7  # _INSERT_MESSAGE has to line up with the buffer's rows.
+    async with _transaction(db) as conn:
+        await conn.executemany(_INSERT_MESSAGE, records)
+    return len(records)
+
+
+_GET_CACHED_MESSAGE = f"SELECT {CachedMessage.columns} FROM messages WHERE message_id = ?"
+
+
+@db_deco
+async def get_cached_message(db, sid: int, message_id: int) -> Optional[CachedMessage]:
+    row = await _fetchrow(db, _GET_CACHED_MESSAGE, (message_id,))
+    return CachedMessage(*row) if row is not None else None
+
+
+_GET_CACHED_MESSAGES_AFTER_TIMESTAMP = f"SELECT {CachedMessage.columns} FROM messages WHERE ts > ? AND guild_id = ? AND user_id = ?"
+
+
+@db_deco
+async def get_cached_messages_after_timestamp(db, timestamp: datetime, sid: int, user_id: int) -> List[CachedMessage]:
+    """ Timestamp must be in UTC"""
+    rows = await _fetch(db, _GET_CACHED_MESSAGES_AFTER_TIMESTAMP, (_utc_ts(timestamp), sid, user_id))
+    return [CachedMessage(*row) for row in rows]
+
+
+_GET_ALL_CACHED_MESSAGES_AFTER_TIMESTAMP = f"SELECT {CachedMessage.columns} FROM messages WHERE ts > ? AND guild_id = ?"
+
+
+@db_deco
+async def get_all_cached_messages_after_timestamp(db, timestamp: datetime, sid: int) -> List[CachedMessage]:
+    """ Timestamp must be in UTC"""
+    rows = await _fetch(db, _GET_ALL_CACHED_MESSAGES_AFTER_TIMESTAMP, (_utc_ts(timestamp), sid))
+    return [CachedMessage(*row) for row in rows]
+
+
+# Keyset pagination rather than a cursor, so the connection is free for everyone else between batches.
+_ITER_GUILD_CACHED_MESSAGES = f"""
+    SELECT {CachedMessage.columns} FROM messages
+    WHERE guild_id = ? AND (ts > ? OR (ts = ? AND message_id > ?))
+    ORDER BY ts, message_id LIMIT ?
+"""
+_ITER_USER_CACHED_MESSAGES = f"""
+    SELECT {CachedMessage.columns} FROM messages
+    WHERE guild_id = ? AND user_id = ? AND (ts > ? OR (ts = ? AND message_id > ?))
+    ORDER BY ts, message_id LIMIT ?
+"""
+
+
+async def iter_cached_messages_after_timestamp(db, timestamp: datetime, sid: int, user_id: Optional[int] = None,
+                                              batch_size: int = 1000) -> AsyncIterator[List[CachedMessage]]:
+    """See pDB.iter_cached_messages_after_timestamp. Timestamp must be in UTC"""
+    start_time = time.perf_counter()
+    row_count = 0
+    last_ts, last_id = _utc_ts(timestamp), sys.maxsize  # Nothing at exactly `timestamp` is included, same as Postgres.
+    while True:
+        if user_id is None:
+            rows = await _fetch(db, _ITER_GUILD_CACHED_MESSAGES, (sid, last_ts, last_ts, last_id, batch_size))
+        else:
+            rows = await _fetch(db, _ITER_USER_CACHED_MESSAGES, (sid, user_id, last_ts, last_ts, last_id, batch_size))
+        if len(rows) == 0:
+            break
+        row_count += len(rows)
+        batch = [CachedMessage(*row) for row in rows]
+        last_ts, last_id = batch[-1].ts, batch[-1].message_id
+        yield batch
+
+    pDB.query_stats.record("iter_cached_messages_after_timestamp", (time.perf_counter() - start_time) * 1000)
+    log.debug(f"Streamed {row_count} cached messages in {(time.perf_counter() - start_time) * 1000:.3f} ms.")
+
+
+_UPDATE_CACHED_MESSAGE_PK_DETAILS = "UPDATE messages SET system_pkid = ?, member_pkid = ?, user_id = ? WHERE message_id = ?"
+
+
+@db_deco
+async def update_cached_message_pk_details(db, sid: int, message_id: int, system_pkid: str, member_pkid: str,
+                                           pk_system_account_id: int):
+    await _execute_batched(db, _UPDATE_CACHED_MESSAGE_PK_DETAILS, (system_pkid, member_pkid, pk_system_account_id, message_id))
+
+
+_DELETE_CACHED_MESSAGE = "DELETE FROM messages WHERE message_id = ?"
+
+
+@db_deco
+async def delete_cached_message(db, sid: int, message_id: int):
+    await _execute_batched(db, _DELETE_CACHED_MESSAGE, (message_id,))
+
+
+@db_deco
+async def delete_cached_messages(db, sid: int, message_ids: List[int]):
+    """SQLite has no arrays, so this is one executemany in one transaction."""
+    async with _transaction(db) as conn:
+        await conn.executemany(_DELETE_CACHED_MESSAGE, [(message_id,) for message_id in message_ids])
+
+
+@db_deco
+async def rebuild_member_daily_activity(db, guild_id: Optional[int] = None) -> int:
+    """There is no rollup to rebuild on SQLite, post counts come straight from messages."""
+    return 0
+
+
+_COUNT_POSTS_SINCE = "SELECT COUNT(*) FROM messages WHERE guild_id = ? AND user_id = ? AND ts > ?"
+
+
+@db_deco
+async def count_posts_since(db, guild_id: int, user_id: int, timestamp: datetime) -> int:
+    """ Number of cached messages a user has posted since timestamp. Timestamp must be in UTC"""
+    return await _fetchval(db, _COUNT_POSTS_SINCE, (guild_id, user_id, _utc_ts(timestamp)))
+
+
+_USER_ID_CHUNK_SIZE = 500  # Keeps the IN list well under SQLite's bound parameter limit.
+
+
+@db_deco
+async def post_counts_for_users_since(db, guild_id: int, user_ids: List[int], timestamp: datetime) -> Dict[int, int]:
+    """See pDB.post_counts_for_users_since. Timestamp must be in UTC"""
+    since_ts = _utc_ts(timestamp)
+    post_counts = {user_id: 0 for user_id in user_ids}
+    for i in range(0, len(user_ids), _USER_ID_CHUNK_SIZE):
+        chunk = user_ids[i:i + _USER_ID_CHUNK_SIZE]
+        query = f"SELECT user_id, COUNT(*) FROM messages WHERE guild_id = ? AND ts > ? AND user_id IN ({', '.join('?' * len(chunk))}) GROUP BY user_id"
+        for row in await _fetch(db, query, (guild_id, since_ts, *chunk)):
+            post_counts[row[0]] = row[1]
+    return post_counts
+
+
+_GET_NUMBER_OF_ROWS_IN_MESSAGES = "SELECT COUNT(*) FROM messages"
+
+
+@db_deco
+async def get_number_of_rows_in_messages(db, table: str = "messages") -> int:
+    return await _fetchval(db, _GET_NUMBER_OF_ROWS_IN_MESSAGES)
+
+# endregion
+
+
+# region Message Retention Functions
+
+@db_deco
+async def get_message_partitions(db) -> List[MessagePartition]:
+    return []  # SQLite doesn't partition.
+
+
+@db_deco
+async def ensure_message_partitions(db, months_ahead: int = 3) -> List[str]:
+    return []
+
+
+_UPSERT_MESSAGE_RETENTION_DAYS = """
+    INSERT INTO guild_settings(guild_id, message_retention_days) VALUES(?, ?)
+    ON CONFLICT(guild_id)
+    DO UPDATE SET message_retention_days = excluded.message_retention_days
+"""
+
+
+@db_deco
+async def upsert_message_retention_days(db, guild_id: int, retention_days: Optional[int]):
+    await _execute_batched(db, _UPSERT_MESSAGE_RETENTION_DAYS, (guild_id, retention_days))
+
+
+_GET_MESSAGE_RETENTION_OVERRIDES = "SELECT guild_id, message_retention_days FROM guild_settings WHERE message_retention_days IS NOT NULL"
+_DELETE_EXPIRED_GUILD_MESSAGES = "DELETE FROM messages WHERE guild_id = ? AND ts < ?"
+
+
+@db_deco
+async def apply_message_retention(db, default_retention_days: Optional[int], detach: bool = False,
+                                  delete_batch_size: int = 10000) -> Tuple[List[str], int]:
+    """
+    See pDB.apply_message_retention. Everything is deleted row by row, so `detach` does nothing and no partitions are ever returned.
+    There is only ever one writer, so the deletes aren't split into batches either.
+    """
+    now = datetime.now(timezone.utc)
+    overrides: Dict[int, int] = {row[0]: row[1] for row in await _fetch(db, _GET_MESSAGE_RETENTION_OVERRIDES)}
+
+    deleted_rows = 0
+    if default_retention_days is not None:
+        # Not limited to one guild, so none of the (guild_id, ...) indexes apply. message_id is the rowid though, and
+        # message ids are snowflakes that start with their creation time, so the cutoff becomes a rowid range instead of a full scan.
+        default_cutoff = pDB.snowflake_from_datetime(now - timedelta(days=default_retention_days))
+        query = f"DELETE FROM messages WHERE message_id < ? AND guild_id NOT IN ({', '.join('?' * len(overrides))})"
+        deleted_rows += await _execute(db, query, (default_cutoff, *overrides.keys()))
+
+    for guild_id, retention_days in overrides.items():
+        guild_cutoff = int((now - timedelta(days=retention_days)).timestamp())
+        deleted_rows += await _execute(db, _DELETE_EXPIRED_GUILD_MESSAGES, (guild_id, guild_cutoff))
+
+    return [], deleted_rows
+
+# endregion
+
+
+# region Members DB Functions
+
+_UPSERT_NEW_MEMBER = """
+    INSERT INTO members(user_id, guild_id, internal_user_id) VALUES(?, ?, ?)
+    ON CONFLICT(guild_id, user_id)
+    DO UPDATE SET join_count = members.join_count + 1
+"""
+
+
+@db_deco
+async def upsert_new_member(db, guild_id: int, user_id: int, pn_user_id: int):
+    await _execute_batched(db, _UPSERT_NEW_MEMBER, (user_id, guild_id, pn_user_id))
+
+
+def _member_from_row(row) -> DBMember:
+    return DBMember(*row[:7], bool(row[7]), bool(row[8]))
+
+
+_GET_MEMBER = f"SELECT {DBMember.columns} FROM members WHERE guild_id = ? AND user_id = ?"
+
+
+@db_deco
+async def get_member(db, guild_id: int, user_id: int) -> Optional[DBMember]:
+    row = await _fetchrow(db, _GET_MEMBER, (guild_id, user_id))
+    return _member_from_row(row) if row is not None else None
+
+
+_GET_LINKED_MEMBERS = f"SELECT {DBMember.columns} FROM members WHERE guild_id = ? AND internal_user_id = ?"
+
+
+@db_deco
+async def get_linked_members(db, guild_id: int, pn_user_id: int) -> List[DBMember]:
+    return [_member_from_row(row) for row in await _fetch(db, _GET_LINKED_MEMBERS, (guild_id, pn_user_id))]
+
+
+_UPDATE_MEMBER = """
+    UPDATE members SET inactive_l1_count = inactive_l1_count + ?,
+                       inactive_l2_count = inactive_l2_count + ?,
+                       post_count = post_count + ?,
+                       became_member = became_member OR ?
+    WHERE guild_id = ? AND user_id = ?
+"""
+
+
+@db_deco
+async def update_member(db, guild_id: int, user_id: int, increment_L1_count: bool = False, increment_L2_count: bool = False,
+                        increase_post_count: int = 0, set_membership: bool = False):
+    if not (increment_L1_count or increment_L2_count or increase_post_count or set_membership):
+        return
+
+    await _execute_batched(db, _UPDATE_MEMBER, (int(increment_L1_count), int(increment_L2_count), increase_post_count,
+                                                set_membership, guild_id, user_id))
+
+
+_UPDATE_MEMBER_SOFTBAN = "UPDATE members SET soft_banned = ? WHERE guild_id = ? AND user_id = ?"
+
+
+@db_deco
+async def update_member_softban(db, guild_id: int, user_id: int, ban: bool):
+    await _execute_batched(db, _UPDATE_MEMBER_SOFTBAN, (ban, guild_id, user_id))
+
+# endregion
+
+
+# region Inactivity History DB Functions
+
+_ADD_INACTIVITY_EVENT = "INSERT INTO inactivity_history(user_id, guild_id, current_level, previous_level, reason, ts) VALUES(?, ?, ?, ?, ?, ?)"
+
+
+@db_deco
+async def add_inactivity_event(db, guild_id: int, user_id: int, current_level: int, previous_level: int,
+                               reason: Optional[str] = None, event_ts: Optional[datetime] = None):
+    if event_ts is None:
+        event_ts = datetime.utcnow()
+    if reason is None:
+        reason = "No Reason Given"
+    await _execute_batched(db, _ADD_INACTIVITY_EVENT, (user_id, guild_id, current_level, previous_level, reason, _utc_ts(event_ts)))
+
+
+_GET_INACTIVITY_EVENTS = f"SELECT {InactivityEvent.columns} FROM inactivity_history WHERE guild_id = ? AND user_id = ? ORDER BY id"
+
+
+@db_deco
+async def get_inactivity_events(db, guild_id: int, user_id: int) -> List[InactivityEvent]:
+    return [InactivityEvent(*row) for row in await _fetch(db, _GET_INACTIVITY_EVENTS, (guild_id, user_id))]
+
+
+_UPSERT_INACTIVE_USER = """
+    INSERT INTO current_inactive_members(user_id, guild_id, inactivity_level, ts) VALUES(?, ?, ?, ?)
+    ON CONFLICT(guild_id, user_id)
+    DO UPDATE SET inactivity_level = excluded.inactivity_level, ts = excluded.ts
+"""
+
+
+@db_deco
+async def upsert_inactive_user(db, guild_id: int, user_id: int, inactivity_level: int,
+                               event_ts: Optional[datetime] = None):
+    if event_ts is None:
+        event_ts = datetime.utcnow()
+    await _execute_batched(db, _UPSERT_INACTIVE_USER, (user_id, guild_id, inactivity_level, _utc_ts(event_ts)))
+
+
+_GET_INACTIVE_USER = f"SELECT {InactiveMember.columns} FROM current_inactive_members WHERE guild_id = ? AND user_id = ?"
+
+
+@db_deco
+async def get_inactive_user(db, guild_id: int, user_id: int) -> Optional[InactiveMember]:
+    row = await _fetchrow(db, _GET_INACTIVE_USER, (guild_id, user_id))
+    return InactiveMember(*row) if row is not None else None
+
+
+_REMOVE_INACTIVE_USER = "DELETE FROM current_inactive_members WHERE guild_id = ? AND user_id = ?"
+
+
+@db_deco
+async def remove_inactive_user(db, guild_id: int, user_id: int):
+    await _execute_batched(db, _REMOVE_INACTIVE_USER, (guild_id, user_id))
+
+# endregion
+
+
+# region Temp Removed Roles DB Functions
+
+_ADD_ROLE_TMP_REMOVED_FROM_USER = "INSERT INTO temp_removed_member_roles(user_id, guild_id, role_id) VALUES(?, ?, ?) ON CONFLICT(user_id, role_id) DO NOTHING"
+
+
+@db_deco
+async def add_role_tmp_removed_from_user(db, guild_id: int, user_id: int, role_id: int):
+    await _execute_batched(db, _ADD_ROLE_TMP_REMOVED_FROM_USER, (user_id, guild_id, role_id))
+
+
+_GET_ROLES_TMP_REMOVED_FROM_USER = f"SELECT {RoleRemovedFromUser.columns} FROM temp_removed_member_roles WHERE guild_id = ? AND user_id = ?"
+
+
+@db_deco
+async def get_roles_tmp_removed_from_user(db, guild_id: int, user_id: int) -> List[RoleRemovedFromUser]:
+    return [RoleRemovedFromUser(*row) for row in await _fetch(db, _GET_ROLES_TMP_REMOVED_FROM_USER, (guild_id, user_id))]
+
+
+_DELETE_ROLE_TMP_REMOVED_FROM_ALL_USER = "DELETE FROM temp_removed_member_roles WHERE guild_id = ? AND role_id = ?"
+
+
+@db_deco
+async def delete_role_tmp_removed_from_all_user(db, guild_id: int, role_id: int):
+    await _execute_batched(db, _DELETE_ROLE_TMP_REMOVED_FROM_ALL_USER, (guild_id, role_id))
+
+
+_DELETE_INACTIVE_MEMBER_REMOVED_ROLES = "DELETE FROM temp_removed_member_roles WHERE guild_id = ? AND user_id = ?"
+
+
+@db_deco
+async def delete_inactive_member_removed_roles(db, guild_id: int, user_id: int):
+    await _execute_batched(db, _DELETE_INACTIVE_MEMBER_REMOVED_ROLES, (guild_id, user_id))
+
+# endregion
+
+
+# region Join Log DB Functions
+
+_ADD_JOIN_EVENT = "INSERT INTO join_log(user_id, guild_id, ts) VALUES(?, ?, ?)"
+
+
+@db_deco
+async def add_join_event(db, guild_id: int, user_id: int, event_ts: Optional[datetime] = None):
+    if event_ts is None:
+        event_ts = datetime.utcnow()
+    await _execute_batched(db, _ADD_JOIN_EVENT, (user_id, guild_id, _utc_ts(event_ts)))
+
+
+_UPDATE_JOIN_EVENT = "UPDATE join_log SET inviter_id = ?, invite_id = ?, invite_name = ? WHERE guild_id = ? AND user_id = ?"
+
+
+@db_deco
+async def update_join_event(db, guild_id: int, user_id: int, inviter_id: int, invite_id: str,
+                            invite_name: Optional[str] = None):
+    await _execute_batched(db, _UPDATE_JOIN_EVENT, (inviter_id, invite_id, invite_name, guild_id, user_id))
+
+
+_GET_JOIN_EVENTS = f"SELECT {JoinLogEvent.columns} FROM join_log WHERE guild_id = ? AND user_id = ?"
+
+
+@db_deco
+async def get_join_events(db, guild_id: int, user_id: int) -> List[JoinLogEvent]:
+    return [JoinLogEvent(*row) for row in await _fetch(db, _GET_JOIN_EVENTS, (guild_id, user_id))]
+
+# endregion
+
+
+# region PluralKit Account DB Functions
+
+_GET_PK_ACCOUNT = f"SELECT {PKAccount.columns} FROM pk_accounts WHERE account_id = ?"
+
+
+@db_deco
+async def get_pk_account(db, account_id: int) -> Optional[PKAccount]:
+    row = await _fetchrow(db, _GET_PK_ACCOUNT, (account_id,))
+    return PKAccount(*row) if row is not None else None
+
+
+_UPSERT_PK_ACCOUNT = "INSERT OR REPLACE INTO pk_accounts(account_id, system_pkid, system, fetched_ts) VALUES(?, ?, ?, ?)"
+
+
+@db_deco
+async def upsert_pk_account(db, account_id: int, system_pkid: Optional[str], system: Optional[str], fetched_ts: int):
+    await _execute_batched(db, _UPSERT_PK_ACCOUNT, (account_id, system_pkid, system, fetched_ts))
+
+# endregion
+
+
+pDB.register_backend(sys.modules[__name__], SQLiteDB, SQLiteSession)
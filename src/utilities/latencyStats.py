@@ -0,0 +1,116 @@
+"""
+In memory latency histograms.
+Used to keep per-query (and per-request) timing stats without logging every call.
+
+Part of PNBot.
+"""
+
+import math
+from typing import Dict, List, Optional
+
+
+class LatencyHistogram:
+    """
+    Fixed size, log bucketed latency histogram.
+
+    Every sample lands in a bucket that is ~5% wider than the one below it, so percentiles are accurate to within ~5%
+    while memory stays constant no matter how many samples are recorded. The max is kept exactly.
+    """
+
+    growth = 1.05
+    min_ms = 0.01  # Everything faster than this lands in the first bucket.
+    bucket_count = 400  # 0.01 ms * 1.05^400 ~= 3 hours. Anything slower lands in the last bucket.
+
+    __slots__ = ('count', 'errors', 'total_ms', 'max_ms', '_buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self._buckets: List[int] = [0] * self.bucket_count
+
+    def _bucket_index(self, ms: float) -> int:
+        if ms <= self.min_ms:
+            return 0
+        return min(int(math.log(ms / self.min_ms, self.growth)) + 1, self.bucket_count - 1)
+
+    def _bucket_upper_ms(self, index: int) -> float:
+        return self.min_ms * self.growth ** index
+
+    def record(self, ms: float, error: bool = False):
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+        self._buckets[self._bucket_index(ms)] += 1
+
+    def percentile(self, pct: float) -> float:
+        """Returns the upper bound of the bucket holding the given percentile (0-100), capped at the real max."""
+        if self.count == 0:
+            return 0.0
+
+        target = math.ceil(self.count * pct / 100)
+        seen = 0
+        for index, bucket in enumerate(self._buckets):
+            seen += bucket
+            if seen >= target:
+                return min(self._bucket_upper_ms(index), self.max_ms)
+        return self.max_ms
+
+    @property
+    def mean_ms(self) -> float:
+        return self.total_ms / self.count if self.count else 0.0
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'mean_ms': self.mean_ms,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'max_ms': self.max_ms,
+        }
+
+
+class LatencyStats:
+    """A set of named LatencyHistograms."""
+
+    def __init__(self):
+        self._histograms: Dict[str, LatencyHistogram] = {}
+
+    def record(self, name: str, ms: float, error: bool = False):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = LatencyHistogram()
+        histogram.record(ms, error)
+
+    def get(self, name: str) -> Optional[LatencyHistogram]:
+        return self._histograms.get(name)
+
+    def reset(self):
+        self._histograms.clear()
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """Stats for every name, as plain dicts so they can be serialised by whatever is scraping them."""
+        return {name: histogram.snapshot() for name, histogram in self._histograms.items()}
+
+    def format_table(self, sort_by: str = 'total') -> str:
+        """Plain text table, busiest first (by total time spent unless sort_by is one of the snapshot keys)."""
+        if sort_by == 'total':
+            items = sorted(self._histograms.items(), key=lambda item: item[1].total_ms, reverse=True)
+        else:
+            items = sorted(self._histograms.items(), key=lambda item: item[1].snapshot()[sort_by], reverse=True)
+
+        if len(items) == 0:
+            return "No samples recorded yet."
+
+        name_width = max(len("Name"), *(len(name) for name, _ in items))
+        lines = [f"{'Name':<{name_width}} {'Count':>8} {'Err':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'Max ms':>9}"]
+        for name, histogram in items:
+            lines.append(f"{name:<{name_width}} {histogram.count:>8} {histogram.errors:>5} {histogram.percentile(50):>9.2f} "
+                         f"{histogram.percentile(95):>9.2f} {histogram.percentile(99):>9.2f} {histogram.max_ms:>9.2f}")
+        return "\n".join(lines)
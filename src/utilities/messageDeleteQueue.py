@@ -0,0 +1,157 @@
+"""
+Background queue for deleted messages.
+Lets the message delete event handlers hand deletions off without waiting on the PluralKit API or the DB.
+See UserManagement.on_raw_message_delete.
+
+Part of PNBot.
+"""
+
+import time
+import asyncio
+import logging
+
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from utilities.latencyStats import LatencyHistogram
+
+log = logging.getLogger(__name__)
+
+Resolver = Callable[[int, int], Awaitable[None]]  # (guild_id, message_id)
+Cleaner = Callable[[int, List[int]], Awaitable[None]]  # (guild_id, message_ids)
+
+
+class MessageDeleteQueue:
+    """
+    add() only records the deletion and returns. A background task waits `batch_delay` seconds for a burst (e.g. a purge)
+    to pile up, then takes up to `batch_size` deletions at a time. The ones that were added with resolve=True are passed
+    to `resolve` (the PK lookup), at most `concurrency` at once. Then the whole batch is passed to `cleanup`, one call per guild.
+
+    A message that is deleted again while it is still queued or being handled is only handled once.
+    Once `max_size` deletions are waiting, new ones skip `resolve` and are only cleaned up, so a PK outage or a
+    huge purge can't build an unbounded backlog of lookups.
+    """
+
+    def __init__(self, resolve: Resolver, cleanup: Cleaner, max_size: int = 10000, concurrency: int = 4,
+                 batch_size: int = 100, batch_delay: float = 0.5):
+        self.resolve = resolve
+        self.cleanup = cleanup
+        self.max_size = max_size
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+
+        self._queue: Dict[int, Tuple[int, bool, float]] = {}  # message_id -> (guild_id, resolve, queued at). Dicts keep insertion order.
+        self._in_flight: Dict[int, Tuple[int, bool, float]] = {}
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._task: Optional[asyncio.Task] = None
+
+        self.added = 0
+        self.coalesced = 0  # Deletions of a message that was already queued.
+        self.shed = 0  # Deletions that skipped resolve because the queue was full.
+        self.resolved = 0
+        self.resolve_errors = 0
+        self.cleaned = 0
+        self.cleanup_errors = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.queue_delay = LatencyHistogram()  # From add() to the end of cleanup.
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue) + len(self._in_flight)
+
+    def add(self, guild_id: int, message_id: int, resolve: bool = True):
+        if message_id in self._queue or message_id in self._in_flight:
+            self.coalesced += 1
+            return
+
+        if resolve and self.depth >= self.max_size:
+            self.shed += 1
+            resolve = False
+
+        self._queue[message_id] = (guild_id, resolve, time.perf_counter())
+        self.added += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """Stops the background task. Whatever is left is cleaned up without being resolved, so shutting down doesn't wait on PK."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        remaining = {**self._in_flight, **self._queue}
+        self._in_flight, self._queue = {}, {}
+        if len(remaining) > 0:
+            log.info(f"Cleaning up {len(remaining)} queued message deletions before shutting down.")
+            await self._cleanup_batch(remaining)
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.batch_delay)
+            self._wakeup.clear()
+            while len(self._queue) > 0:
+                for message_id in list(self._queue)[:self.batch_size]:
+                    self._in_flight[message_id] = self._queue.pop(message_id)
+                try:
+                    await self._process(self._in_flight)
+                except Exception:
+                    log.exception("Error handling a batch of deleted messages.")
+                finally:
+                    self._in_flight = {}
+
+    async def _process(self, batch: Dict[int, Tuple[int, bool, float]]):
+        self.batches += 1
+        to_resolve = [(guild_id, message_id) for message_id, (guild_id, resolve, _) in batch.items() if resolve]
+        if len(to_resolve) > 0:
+            await asyncio.gather(*(self._resolve_one(guild_id, message_id) for guild_id, message_id in to_resolve))
+        await self._cleanup_batch(batch)
+
+    async def _resolve_one(self, guild_id: int, message_id: int):
+        async with self._semaphore:
+            try:
+                await self.resolve(guild_id, message_id)
+                self.resolved += 1
+            except Exception:
+                self.resolve_errors += 1
+                log.exception(f"Error resolving deleted message {message_id}.")
+
+    async def _cleanup_batch(self, batch: Dict[int, Tuple[int, bool, float]]):
+        by_guild: Dict[int, List[int]] = {}
+        for message_id, (guild_id, _, _) in batch.items():
+            by_guild.setdefault(guild_id, []).append(message_id)
+
+        for guild_id, message_ids in by_guild.items():
+            try:
+                await self.cleanup(guild_id, message_ids)
+                self.cleaned += len(message_ids)
+            except Exception:
+                self.cleanup_errors += len(message_ids)
+                log.exception(f"Error cleaning up {len(message_ids)} deleted messages.")
+
+        now = time.perf_counter()
+        for _, _, queued_at in batch.values():
+            self.queue_delay.record((now - queued_at) * 1000)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'added': self.added,
+            'coalesced': self.coalesced,
+            'shed': self.shed,
+            'resolved': self.resolved,
+            'resolve_errors': self.resolve_errors,
+            'cleaned': self.cleaned,
+            'cleanup_errors': self.cleanup_errors,
+            'batches': self.batches,
+            'delay_p50_ms': self.queue_delay.percentile(50),
+            'delay_p95_ms': self.queue_delay.percentile(95),
+            'delay_max_ms': self.queue_delay.max_ms,
+        }
@@ -0,0 +1,172 @@
+"""
+In memory index of recently cached message IDs.
+Lets the message delete path tell whether a message is in the cache without asking the DB. See pDB.MessageCacheBuffer.
+
+Part of PNBot.
+"""
+
+import math
+import logging
+
+from datetime import datetime
+from collections import OrderedDict
+from typing import Optional, Dict, List, NamedTuple
+
+import discord
+
+log = logging.getLogger(__name__)
+
+_MASK_64 = (1 << 64) - 1
+
+
+def _mix(value: int) -> int:
+    """splitmix64 finalizer. Snowflakes share most of their high bits, so they need a real mix before being used as hashes."""
+    value = (value + 0x9E3779B97F4A7C15) & _MASK_64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK_64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK_64
+    return value ^ (value >> 31)
+
+
+class BloomFilter:
+    """
+    Set of ints that can answer "definitely not in the set" or "probably in the set".
+    Sized up front for `capacity` items at `false_positive_rate`. Going over capacity raises the false positive rate.
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float = 0.01):
+        self.capacity = capacity
+        self.size_bits = max(8, math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.size_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: int):
+        hashed = _mix(item)
+        first, second = hashed & 0xFFFFFFFF, (hashed >> 32) | 1
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.size_bits
+
+    def add(self, item: int):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: int) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+
+class IndexedMessage(NamedTuple):
+    guild_id: int
+    author_id: int
+    webhook_id: Optional[int]
+    author_is_bot: bool
+    channel_id: Optional[int] = None
+
+
+class RecentMessageIndex:
+    """
+    The last `capacity` cached messages are kept exactly, with their author info.
+    Messages that age out of that are added to a bloom filter, which can still say that a message was never cached.
+
+    The index only knows about messages cached since it was created, so message IDs from before then (`covers_from`)
+    always have to be looked up in the DB. Once the newest filter is full, a new one is started. When a third one is
+    needed, the oldest is dropped and covers_from moves up past everything that was in it. This way a full filter
+    never turns into wrong answers, just into more DB lookups.
+    """
+
+    # Results of check()
+    HIT = "hit"                # Cached, and still held in the index.
+    NOT_CACHED = "not cached"  # Definitely never cached (or already deleted).
+    MAYBE = "maybe"            # The filter thinks it was cached. Could be a false positive.
+    UNKNOWN = "unknown"        # From before covers_from. Only the DB knows.
+
+    def __init__(self, capacity: int = 50000, filter_capacity: int = 1000000, false_positive_rate: float = 0.01):
+        self.capacity = capacity
+        self.filter_capacity = filter_capacity
+        self.false_positive_rate = false_positive_rate
+
+        self.covers_from = discord.utils.time_snowflake(datetime.utcnow())
+        self._recent: 'OrderedDict[int, IndexedMessage]' = OrderedDict()
+        self._filter = BloomFilter(filter_capacity, false_positive_rate)
+        self._filter_max_id = 0
+        self._old_filter: Optional[BloomFilter] = None
+        self._old_filter_max_id = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.filter_hits = 0
+        self.false_positives = 0
+        self.unknown = 0
+
+    def __len__(self):
+        return len(self._recent)
+
+    def add(self, message_id: int, entry: IndexedMessage):
+        self._recent[message_id] = entry
+        self._recent.move_to_end(message_id)
+        if len(self._recent) > self.capacity:
+            old_id, _ = self._recent.popitem(last=False)
+            self._remember(old_id)
+
+    def _remember(self, message_id: int):
+        if self._filter.full:
+            if self._old_filter is not None:
+                self.covers_from = max(self.covers_from, self._old_filter_max_id + 1)
+                log.info(f"Recent message index filter is full. Now only covers messages after {self.covers_from}")
+            self._old_filter, self._old_filter_max_id = self._filter, self._filter_max_id
+            self._filter = BloomFilter(self.filter_capacity, self.false_positive_rate)
+            self._filter_max_id = 0
+        self._filter.add(message_id)
+        self._filter_max_id = max(self._filter_max_id, message_id)
+
+    def get(self, message_id: int) -> Optional[IndexedMessage]:
+        return self._recent.get(message_id)
+
+    def channel_message_ids(self, channel_id: int) -> List[int]:
+        """IDs of the messages from a channel that are still held in the index. Walks the whole index, so keep it to rare events like a channel being deleted."""
+        return [message_id for message_id, entry in self._recent.items() if entry.channel_id == channel_id]
+
+    def discard(self, message_id: int):
+        """Forgets a deleted message. It stays in the filter, which will report it as MAYBE from then on if it had aged out."""
+        self._recent.pop(message_id, None)
+
+    def peek(self, message_id: int) -> str:
+        """Like check(), without counting towards the stats."""
+        if message_id in self._recent:
+            return self.HIT
+        if message_id < self.covers_from:
+            return self.UNKNOWN
+        if message_id in self._filter or (self._old_filter is not None and message_id in self._old_filter):
+            return self.MAYBE
+        return self.NOT_CACHED
+
+    def check(self, message_id: int) -> str:
+        result = self.peek(message_id)
+        if result == self.HIT:
+            self.hits += 1
+        elif result == self.NOT_CACHED:
+            self.misses += 1
+        elif result == self.MAYBE:
+            self.filter_hits += 1
+        else:
+            self.unknown += 1
+        return result
+
+    def record_false_positive(self):
+        """Call when a MAYBE turned out not to be in the DB."""
+        self.false_positives += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._recent),
+            'filtered': self._filter.count + (self._old_filter.count if self._old_filter is not None else 0),
+            'hits': self.hits,
+            'misses': self.misses,
+            'filter_hits': self.filter_hits,
+            'false_positives': self.false_positives,
+            'unknown': self.unknown,
+        }
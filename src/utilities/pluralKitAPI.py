@@ -4,19 +4,35 @@ API Endpoint functions include:
     get_pk_system_from_userid -> /a/
     get_pk_message -> /msg/
 
+The functions go through a shared PKClient. The bot creates one on startup and sets it with set_default_client().
+PKClient remembers responses, including 404s, for a while. See PKClient for the TTLs.
+It also rate limits, retries and stops calling the API while it is down. See PKClient._get.
+
 Part of the Gabby Gums Discord Logger.
 """
 
+import time
+import json
+import asyncio
 import logging
 from typing import TYPE_CHECKING, Optional, Dict, List, Union, Tuple, NamedTuple
 
 import aiohttp
 
+import pDB
+from utilities.latencyStats import LatencyStats
+from utilities.ttlCache import TTLCache
+from utilities.rateLimit import TokenBucket, CircuitBreaker, backoff_delay, parse_retry_after
+
 log = logging.getLogger(__name__)
 
+DEFAULT_BASE_URL = "https://api.pluralkit.me/v1"  # Override with "base_url" in the "pk_api" config section, e.g. to use benchmarks/pk_standin.py.
+
 
 class PKAPIUnavailable(Exception):
-    pass
+    def __init__(self, *args, retry_after: Optional[float] = None):
+        super().__init__(*args)
+        self.retry_after = retry_after  # Seconds, from the response's Retry-After header.
 
 
 class CouldNotConnectToPKAPI(PKAPIUnavailable):
@@ -38,70 +54,250 @@ class PK500PKServerError(PKAPIUnavailable):
     pass
 
 
-class UnknownPKError(Exception):
+class PK429RateLimitedError(PKAPIUnavailable):
+    """429 (Too Many Requests)"""
     pass
 
 
-async def get_pk_system_from_userid(user_id: int) -> Optional[Dict]:
-    """Gets a PK system from the PluralKit API using a Discord UserID"""
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f'https://api.pluralkit.me/v1/a/{user_id}') as r:
-                if r.status == 200:  # We received a valid response from the PK API.
-                    logging.debug(f"User has an associated PK Account linked to their Discord Account.")
-
-                    # Convert the JSON response to a dict
-                    pk_response = await r.json()
-                    logging.debug(f"Got system: {pk_response}")
-
-                    return pk_response
-                elif r.status == 404:
-                    # No PK Account found.
-                    log.debug("No PK Account found.")
-                    return None
-
-                elif r.status == 500:
-                    raise PK500PKServerError("Could not reach the Plural Kit API due to a Plural Kit Server Error.")
-
-                elif r.status == 502:
-                    raise PK502BadGatewayError("Could not reach the Plural Kit API due to a Gateway Error.")
+class PKCircuitOpenError(PKAPIUnavailable):
+    """The PK API has been failing, so PKClient isn't calling it for now."""
+    pass
 
-                elif r.status == 503:
-                    raise PkApi503Error("Could not reach the Plural Kit API as it is Temporarily Unavailable.")
-                else:
-                    raise UnknownPKError(f"Could not reach the Plural Kit API due to the following error: {r.status} ({r.reason}) for /a/")
 
-    except aiohttp.ClientError as e:
-        raise CouldNotConnectToPKAPI  # Really not strictly necessary, but it makes the code a bit nicer I think.
+class UnknownPKError(Exception):
+    pass
 
 
-async def get_pk_message(message_id: int) -> Optional[Dict]:
-    """Attempts to retrieve details on a proxied/pre-proxied message"""
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get('https://api.pluralkit.me/v1/msg/{}'.format(message_id)) as r:
-                if r.status == 200:  # We received a valid response from the PK API. The message is probably a pre-proxied message.
-                    logging.debug(f"Message {message_id} is still on the PK api.")
-                    # Convert the JSON response to a dict, Cache the details of the proxied message, and then bail.
+class PKClient:
+    """
+    Long lived client for the PluralKit API.
+
+    Keeps one aiohttp session, and with it a pool of keep-alive connections and a DNS cache, so lookups after the
+    first one don't have to do a new TCP and TLS handshake. Create one for the bot and close() it on shutdown.
+
+    /msg/ and /a/ responses are kept in LRU caches for `message_ttl` and `account_ttl` seconds.
+    404s are kept too, for the shorter `*_negative_ttl`s: a message PK hasn't logged yet can still turn up, and an
+    account can still register a system. Systems seen in /msg/ responses fill in the /a/ cache for their sender.
+    If `db` is given, /a/ results are also stored in the pk_accounts table and used for up to `persisted_account_ttl`
+    seconds, so they survive restarts.
+
+    Requests share a token bucket (`rate_limit` per second, bursts of `rate_burst`), so callers don't need to sleep
+    between lookups to be nice to PK. See _get for retries and the circuit breaker.
+    """
+
+    def __init__(self, base_url: str = DEFAULT_BASE_URL, max_connections: int = 20,
+                 keepalive_timeout: float = 30, dns_cache_ttl: int = 300, timeout: float = 10, connect_timeout: float = 5,
+                 cache_size: int = 10000, message_ttl: float = 3600, message_negative_ttl: float = 60,
+                 account_ttl: float = 3600, account_negative_ttl: float = 600, persisted_account_ttl: float = 7 * 86400,
+                 db=None, rate_limit: float = 5, rate_burst: int = 5, max_retries: int = 2, retry_base_delay: float = 0.5,
+                 retry_max_delay: float = 10, breaker_failure_threshold: int = 5, breaker_reset_timeout: float = 30):
+        self.base_url = base_url.rstrip('/')
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.stats = LatencyStats()  # Per endpoint request latency.
+
+        self.message_ttl = message_ttl
+        self.message_negative_ttl = message_negative_ttl
+        self.account_ttl = account_ttl
+        self.account_negative_ttl = account_negative_ttl
+        self.persisted_account_ttl = persisted_account_ttl
+        self.message_cache = TTLCache(cache_size)
+        self.account_cache = TTLCache(cache_size)
+        self.db = db
+        self.persisted_hits = 0
+
+        self.limiter = TokenBucket(rate_limit, rate_burst)
+        self.breaker = CircuitBreaker("The PluralKit API", breaker_failure_threshold, breaker_reset_timeout)
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.retries = 0
+
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Made on first use rather than in __init__, as aiohttp wants to be set up from inside the event loop.
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=self.keepalive_timeout,
+                                             ttl_dns_cache=self.dns_cache_ttl)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _get(self, endpoint: str, key: int) -> Optional[Dict]:
+        """
+        GETs /endpoint/key, through the rate limiter and the circuit breaker. Returns the JSON response, or None on a 404.
+
+        5xx responses and connection errors are retried up to `max_retries` times with jittered exponential backoff,
+        or after the Retry-After the response asked for (unless that is longer than `retry_max_delay`). A 429 pauses the rate limiter for every caller and is retried
+        the same way, but doesn't count against the circuit breaker. Raises PKCircuitOpenError without calling the API
+        while the breaker is open.
+        """
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise PKCircuitOpenError(f"Not calling the Plural Kit API for another {self.breaker.retry_in:.1f} s, as it has been failing.")
+
+            await self.limiter.acquire()
+            try:
+                pk_response = await self._request(endpoint, key)
+            except PK429RateLimitedError as e:
+                delay = e.retry_after if e.retry_after is not None else backoff_delay(attempt, self.retry_base_delay, self.retry_max_delay)
+                self.limiter.pause(delay)
+                error = e
+            except PKAPIUnavailable as e:
+                self.breaker.record_failure()
+                delay = e.retry_after if e.retry_after is not None else backoff_delay(attempt, self.retry_base_delay, self.retry_max_delay)
+                error = e
+            except UnknownPKError:
+                self.breaker.record_success()  # PK answered, we just didn't like the answer. Retrying won't help.
+                raise
+            else:
+                self.breaker.record_success()
+                return pk_response
+
+            if attempt >= self.max_retries or delay > self.retry_max_delay:
+                raise error
+            attempt += 1
+            self.retries += 1
+            log.info(f"Retrying /{endpoint}/{key} in {delay:.2f} s after: {error}")
+            await asyncio.sleep(delay)
+
+    async def _request(self, endpoint: str, key: int) -> Optional[Dict]:
+        """A single GET of /endpoint/key."""
+        start_time = time.perf_counter()
+        error = True
+        try:
+            async with self._get_session().get(f"{self.base_url}/{endpoint}/{key}") as r:
+                if r.status == 200:  # We received a valid response from the PK API.
                     pk_response = await r.json()
+                    error = False
                     return pk_response
+
                 elif r.status == 404:
-                    # msg was not a proxied message
+                    error = False
                     return None
 
+                retry_after = parse_retry_after(r.headers.get('Retry-After'))
+                if r.status == 429:
+                    raise PK429RateLimitedError("The Plural Kit API is rate limiting us.", retry_after=retry_after)
+
                 elif r.status == 500:
-                    raise PK500PKServerError("Could not reach the Plural Kit API due to a Plural Kit Server Error.")
+                    raise PK500PKServerError("Could not reach the Plural Kit API due to a Plural Kit Server Error.", retry_after=retry_after)
 
                 elif r.status == 502:
-                    raise PK502BadGatewayError("Could not reach the Plural Kit API due to a Gateway Error.")
+                    raise PK502BadGatewayError("Could not reach the Plural Kit API due to a Gateway Error.", retry_after=retry_after)
 
                 elif r.status == 503:
-                    raise PkApi503Error("Could not reach the Plural Kit API as it is Temporarily Unavailable.")
+                    raise PkApi503Error("Could not reach the Plural Kit API as it is Temporarily Unavailable.", retry_after=retry_after)
+
+                elif r.status > 500:
+                    raise PKAPIUnavailable(f"Could not reach the Plural Kit API due to a server error: {r.status} ({r.reason}) for /{endpoint}/", retry_after=retry_after)
                 else:
-                    raise UnknownPKError(f"Could not reach the Plural Kit API due to the following error: {r.status} ({r.reason}) for /msg/")
+                    raise UnknownPKError(f"Could not reach the Plural Kit API due to the following error: {r.status} ({r.reason}) for /{endpoint}/")
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise CouldNotConnectToPKAPI(f"Could not connect to the Plural Kit API: {e!r}") from e
+        finally:
+            self.stats.record(f"/{endpoint}/", (time.perf_counter() - start_time) * 1000, error)
+
+    async def get_system_from_userid(self, user_id: int) -> Optional[Dict]:
+        """Gets a PK system from the PluralKit API using a Discord UserID"""
+        cached = self.account_cache.get(user_id)
+        if cached is not TTLCache.MISSING:
+            return cached
+
+        persisted = await self._get_persisted_account(user_id)
+        if persisted is not TTLCache.MISSING:
+            return persisted
+
+        pk_response = await self._get('a', user_id)
+        if pk_response is not None:
+            log.debug(f"Got system: {pk_response}")
+        else:
+            log.debug("No PK Account found.")
+        await self._remember_account(user_id, pk_response)
+        return pk_response
+
+    async def get_message(self, message_id: int) -> Optional[Dict]:
+        """Attempts to retrieve details on a proxied/pre-proxied message. None if it was not a proxied message."""
+        cached = self.message_cache.get(message_id)
+        if cached is not TTLCache.MISSING:
+            return cached
+
+        pk_response = await self._get('msg', message_id)
+        if pk_response is not None:
+            log.debug(f"Message {message_id} is still on the PK api.")
+            self.message_cache.set(message_id, pk_response, self.message_ttl)
+            if 'sender' in pk_response and isinstance(pk_response.get('system'), dict):
+                sender_id = int(pk_response['sender'])
+                if sender_id not in self.account_cache:
+                    await self._remember_account(sender_id, pk_response['system'])
+        else:
+            self.message_cache.set(message_id, None, self.message_negative_ttl)
+        return pk_response
+
+    async def _get_persisted_account(self, user_id: int):
+        """The system stored in pk_accounts for user_id (None if it has none) or MISSING if there isn't a fresh enough row."""
+        if self.db is None:
+            return TTLCache.MISSING
+
+        account = await pDB.get_pk_account(self.db, user_id)
+        if account is None:
+            return TTLCache.MISSING
+
+        ttl = self.persisted_account_ttl if account.system is not None else self.account_negative_ttl
+        remaining = account.fetched_ts + ttl - time.time()
+        if remaining <= 0:
+            return TTLCache.MISSING
+
+        system = json.loads(account.system) if account.system is not None else None
+        self.persisted_hits += 1
+        self.account_cache.set(user_id, system, min(remaining, self.account_ttl if system is not None else self.account_negative_ttl))
+        return system
+
+    async def _remember_account(self, user_id: int, system: Optional[Dict]):
+        self.account_cache.set(user_id, system, self.account_ttl if system is not None else self.account_negative_ttl)
+        if self.db is not None:
+            system_pkid = system.get('id') if system is not None else None
+            await pDB.upsert_pk_account(self.db, user_id, system_pkid, json.dumps(system) if system is not None else None,
+                                        int(time.time()))
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            '/msg/': self.message_cache.stats(),
+            '/a/': {**self.account_cache.stats(), 'persisted_hits': self.persisted_hits},
+        }
+
+
+_default_client: Optional[PKClient] = None
+
+
+def set_default_client(client: Optional[PKClient]):
+    """Sets the client the module level functions use."""
+    global _default_client
+    _default_client = client
+
+
+def get_default_client() -> PKClient:
+    """The client set with set_default_client(). Scripts that never set one get a client with the default settings."""
+    global _default_client
+    if _default_client is None:
+        _default_client = PKClient()
+    return _default_client
 
-    except aiohttp.ClientError as e:
-        raise CouldNotConnectToPKAPI
 
+async def get_pk_system_from_userid(user_id: int) -> Optional[Dict]:
+    """Gets a PK system from the PluralKit API using a Discord UserID"""
+    return await get_default_client().get_system_from_userid(user_id)
 
 
+async def get_pk_message(message_id: int) -> Optional[Dict]:
+    """Attempts to retrieve details on a proxied/pre-proxied message"""
+    return await get_default_client().get_message(message_id)
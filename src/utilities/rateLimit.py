@@ -0,0 +1,184 @@
+"""
+Rate limiting, retry backoff and circuit breaking for calls to outside APIs.
+Used by pluralKitAPI.PKClient.
+
+Part of PNBot.
+"""
+
+import time
+import random
+import asyncio
+import logging
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional, Union
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second on average, with bursts of up to `burst`.
+    Waiters are let through in the order they called acquire(). pause() holds everyone back, e.g. for a Retry-After.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+        self.acquired = 0
+        self.delayed = 0  # Calls that had to wait.
+        self.total_wait = 0.0  # Seconds.
+        self.pauses = 0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            start = self._clock()
+            waited = False
+            while True:
+                now = self._clock()
+                if now < self._paused_until:
+                    waited = True
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                waited = True
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+            self.acquired += 1
+            if waited:
+                self.delayed += 1
+                self.total_wait += self._clock() - start
+
+    def pause(self, seconds: float):
+        """Lets nothing through for the next `seconds`."""
+        self._paused_until = max(self._paused_until, self._clock() + seconds)
+        self.pauses += 1
+
+    def stats(self) -> Dict[str, float]:
+        now = self._clock()
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'tokens': min(self.burst, self._tokens + (now - self._updated) * self.rate),
+            'paused_for': max(0.0, self._paused_until - now),
+            'acquired': self.acquired,
+            'delayed': self.delayed,
+            'total_wait': self.total_wait,
+            'pauses': self.pauses,
+        }
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a service that keeps failing, so callers fail fast instead of each waiting on it.
+
+    After `failure_threshold` failures in a row the circuit opens and allow() returns False. Once `reset_timeout`
+    seconds have passed, a single call is let through as a probe (half open). If it succeeds the circuit closes again,
+    if it fails the circuit stays open for another `reset_timeout`. A probe that never reports back is replaced by a
+    new one after `reset_timeout`.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30,
+                 clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_started: Optional[float] = None
+
+        self.times_opened = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+
+        now = self._clock()
+        if self.state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._probe_started = None
+
+        if self.state == self.HALF_OPEN and (self._probe_started is None or now - self._probe_started >= self.reset_timeout):
+            self._probe_started = now
+            return True
+
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            log.info(f"{self.name} is answering again. Closing its circuit breaker.")
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._probe_started = None
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold):
+            if self.state == self.CLOSED:
+                log.warning(f"{self.name} failed {self.consecutive_failures} times in a row. Opening its circuit breaker for {self.reset_timeout} s.")
+                self.times_opened += 1
+            self.state = self.OPEN
+            self._opened_at = self._clock()
+            self._probe_started = None
+
+    @property
+    def retry_in(self) -> float:
+        """Seconds until the next probe is let through. 0 when closed."""
+        if self.state == self.CLOSED:
+            return 0.0
+        return max(0.0, self._opened_at + self.reset_timeout - self._clock())
+
+    def stats(self) -> Dict[str, Union[str, float]]:
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'retry_in': self.retry_in,
+            'times_opened': self.times_opened,
+            'rejected': self.rejected,
+        }
+
+
+def backoff_delay(attempt: int, base: float, maximum: float) -> float:
+    """Exponential backoff with full jitter: a random delay between 0 and base * 2^attempt, capped at maximum."""
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, which is either a number of seconds or an HTTP date. None if missing or invalid."""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
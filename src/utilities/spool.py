@@ -0,0 +1,172 @@
+"""
+Append only on disk spool.
+Holds records that could not be written to the DB (yet) so they survive a restart. See pDB.WriteSpool.
+
+Records are stored as JSON lines in numbered segment files. New records always go to the newest segment.
+Once a segment is full (or the reader asks for it) it is closed and a new one is started.
+Closed segments are read oldest first and deleted once whatever was in them has been dealt with.
+Records that can't be written out are moved to a .failed file next to their segment.
+
+Part of PNBot.
+"""
+
+import os
+import json
+import asyncio
+import logging
+
+from typing import Optional, List, Dict, Tuple, Any
+
+log = logging.getLogger(__name__)
+
+Record = Tuple[str, list]  # (kind, values)
+
+
+class Spool:
+    """
+    Writes are buffered by the OS and only fsynced by sync(), so a crash can lose at most the records since the last sync.
+    Call sync() on a timer (and before shutting down) to batch the fsyncs.
+    """
+
+    segment_suffix = ".spool"
+    failed_suffix = ".failed"
+
+    def __init__(self, directory: str, segment_max_records: int = 10000):
+        self.directory = directory
+        self.segment_max_records = segment_max_records
+
+        os.makedirs(directory, exist_ok=True)
+
+        self._segments: Dict[int, int] = {}  # segment number -> records in it. Dicts keep insertion order, oldest first.
+        last_number = 0
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith(self.segment_suffix):
+                number = int(file_name[:-len(self.segment_suffix)])
+                self._segments[number] = self._count_records(self._segment_path(number))
+            elif file_name.endswith(self.segment_suffix + self.failed_suffix):
+                number = int(file_name[:-len(self.segment_suffix + self.failed_suffix)])
+            else:
+                continue
+            last_number = max(last_number, number)
+
+        self._current: Optional[int] = None  # Segment that is open for appends. Never one left over from before a restart.
+        self._file = None
+        self._unsynced = 0
+        self._next_number = last_number + 1  # Quarantined segments keep their numbers, so don't reuse them.
+
+        if self.depth > 0:
+            log.info(f"Found {self.depth} spooled records in {len(self._segments)} segments in {directory}")
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"{number:012d}{self.segment_suffix}")
+
+    @staticmethod
+    def _count_records(path: str) -> int:
+        with open(path, 'rb') as segment_file:
+            return sum(1 for line in segment_file if line.strip())
+
+    @property
+    def depth(self) -> int:
+        """The number of records waiting in the spool."""
+        return sum(self._segments.values())
+
+    @property
+    def segment_count(self) -> int:
+        return len(self._segments)
+
+    def append(self, kind: str, values: list):
+        """Adds a record to the spool. values must be JSON serialisable."""
+        if self._current is None or self._segments[self._current] >= self.segment_max_records:
+            self._close_current()
+            self._current = self._next_number
+            self._next_number += 1
+            self._segments[self._current] = 0
+            self._file = open(self._segment_path(self._current), 'a', encoding='utf-8')
+
+        self._file.write(json.dumps([kind, values], separators=(',', ':')) + '\n')
+        self._segments[self._current] += 1
+        self._unsynced += 1
+
+    async def sync(self):
+        """fsyncs everything appended since the last sync. The fsync itself runs in a thread so it doesn't stall the event loop."""
+        if self._file is None or self._unsynced == 0:
+            return
+
+        self._file.flush()
+        self._unsynced = 0
+        await asyncio.get_event_loop().run_in_executor(None, os.fsync, self._file.fileno())
+
+    def _close_current(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+            self._unsynced = 0
+        self._current = None
+
+    def oldest_segment(self) -> Optional[int]:
+        """
+        The oldest segment that isn't being appended to any more.
+        If the only records left are in the open segment, it is closed so they can be read.
+        """
+        for number in self._segments:
+            if number != self._current:
+                return number
+
+        if self._current is not None and self._segments[self._current] > 0:
+            number = self._current
+            self._close_current()
+            return number
+        return None
+
+    def read_segment(self, number: int) -> List[Record]:
+        records = []
+        with open(self._segment_path(number), 'r', encoding='utf-8') as segment_file:
+            for line_number, line in enumerate(segment_file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    kind, values = json.loads(line)
+                except ValueError:
+                    # Most likely the last line of a segment that was being written when the bot died.
+                    log.warning(f"Skipping unreadable record on line {line_number} of spool segment {number}")
+                    continue
+                records.append((kind, values))
+        return records
+
+    def remove_segment(self, number: int):
+        """Deletes a segment once everything in it has been written out."""
+        os.remove(self._segment_path(number))
+        del self._segments[number]
+
+    def rewrite_segment(self, number: int, records: List[Record]):
+        """Replaces the contents of a closed segment with `records`, once the ones before them have been dealt with."""
+        path = self._segment_path(number)
+        with open(path + ".tmp", 'w', encoding='utf-8') as segment_file:
+            for kind, values in records:
+                segment_file.write(json.dumps([kind, values], separators=(',', ':')) + '\n')
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+        os.replace(path + ".tmp", path)
+        self._segments[number] = len(records)
+
+    def quarantine_records(self, number: int, records: List[Record]):
+        """Sets records from a segment that can't be written out aside, so they stop blocking the rest. Kept for a human to look at."""
+        path = self._segment_path(number) + self.failed_suffix
+        with open(path, 'a', encoding='utf-8') as failed_file:
+            for kind, values in records:
+                failed_file.write(json.dumps([kind, values], separators=(',', ':')) + '\n')
+            failed_file.flush()
+            os.fsync(failed_file.fileno())
+        log.error(f"Gave up on {len(records)} records from spool segment {number}. Moved them to {path}")
+
+    def close(self):
+        self._close_current()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'depth': self.depth,
+            'segments': self.segment_count,
+            'unsynced': self._unsynced,
+        }
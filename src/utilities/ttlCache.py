@@ -0,0 +1,88 @@
+"""
+Bounded in memory cache where entries also expire.
+Used to remember PluralKit API responses, see pluralKitAPI.PKClient.
+
+Part of PNBot.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class TTLCache:
+    """
+    LRU cache where every entry also expires `ttl` seconds after it was set. The least recently used entry is evicted
+    once there are more than `max_size`.
+
+    None is cached like any other value, so "this doesn't exist" answers can be remembered too (negative caching).
+    That is why get() returns TTLCache.MISSING rather than None when there is nothing cached.
+    """
+
+    MISSING = object()
+
+    def __init__(self, max_size: int = 10000, clock: Callable[[], float] = time.monotonic):
+        self.max_size = max_size
+        self._clock = clock
+        self._entries: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()  # key -> (expires at, value)
+
+        self.hits = 0
+        self.negative_hits = 0  # Hits on a cached None.
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """True if key has an unexpired entry. Doesn't count towards the stats or the LRU order."""
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] > self._clock()
+
+    def get(self, key: Hashable) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return self.MISSING
+
+        expires_at, value = entry
+        if expires_at <= self._clock():
+            del self._entries[key]
+            self.expired += 1
+            self.misses += 1
+            return self.MISSING
+
+        self._entries.move_to_end(key)
+        if value is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float):
+        if ttl <= 0:
+            self._entries.pop(key, None)
+            return
+
+        self._entries[key] = (self._clock() + ttl, value)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evictions': self.evictions,
+        }
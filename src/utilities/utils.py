@@ -65,8 +65,8 @@ def save_settings(settings, settings_file_path: str = 'guildSettings.json'):
 
 
 # ---------- DB Methods ---------- #
-async def backup_interviews_to_db(interviews):
-    await interviews.save_to_db()
+async def backup_interviews_to_db(interviews, db=None):
+    await interviews.save_to_db(db)
     log.info("{} interviews backed up".format(len(interviews.interviews)))
 
 